@@ -1,6 +1,28 @@
 import sqlite3
-import csv
-import json
+import array
+import atexit
+import bisect
+import collections
+import contextlib
+import functools
+import heapq
+import io
+import itertools
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+
+IMPORT_TIME = time.perf_counter()
+
+# Modules only some paths need (csv and json for loading and output
+# formats, hashlib for the build manifest, argparse, logging, asyncio and
+# concurrent.futures, mmap and zlib for column snapshots) are imported
+# where they are used, so a start that finds choc.db up to date does not
+# pay for them.
 
 # proj3_choc.py
 # You can change anything in this file you want as long as you pass the tests
@@ -12,7 +34,53 @@ DBNAME = 'choc.db'
 BARSCSV = 'flavors_of_cacao_cleaned.csv'
 COUNTRIESJSON = 'countries.json'
 
-def init_db_tables():
+# Bulk loading: rows per executemany() batch, and the PRAGMAs applied to the
+# loading connection for the duration of the load window
+LOAD_BATCH_SIZE = 5000
+LOAD_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "OFF",
+    "cache_size": -65536,
+}
+
+# rows/sec figures of the most recent load of each source file
+LOAD_STATS = {}
+
+def connect_for_load(pragmas=None):
+    if pragmas is None:
+        pragmas = LOAD_PRAGMAS
+    conn = sqlite3.connect(DBNAME)
+    for name, value in pragmas.items():
+        conn.execute("PRAGMA {} = {}".format(name, value))
+    return conn
+
+def batched(iterable, batch_size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def load_report(source, rows, start, verbose=False):
+    seconds = time.perf_counter() - start
+    stats = {
+        "source": source,
+        "rows": rows,
+        "seconds": seconds,
+        "rows_per_sec": rows / seconds if seconds > 0 else float("inf"),
+    }
+    LOAD_STATS[source] = stats
+    if verbose:
+        print("Loaded {} rows from {} in {:.3f}s ({:.0f} rows/sec)".format(rows, source, seconds, stats["rows_per_sec"]))
+    return stats
+
+# indexes=False leaves the secondary indexes to be built after a bulk load
+def init_db_tables(indexes=True):
+    invalidate_result_cache()
+
     # Create db
     try:
         conn = sqlite3.connect(DBNAME)
@@ -29,6 +97,21 @@ def init_db_tables():
         DROP TABLE IF EXISTS 'Countries';
     '''
     cur.execute(statement)
+    statement = '''
+        DROP TABLE IF EXISTS 'BuildManifest';
+    '''
+    cur.execute(statement)
+    statement = '''
+        DROP TABLE IF EXISTS 'CountryAliases';
+    '''
+    cur.execute(statement)
+    for table in SUMMARY_TABLES:
+        cur.execute("DROP TABLE IF EXISTS '{}';".format(table))
+    try:
+        cur.execute("DROP TABLE IF EXISTS 'BarsSearch';")
+    except sqlite3.OperationalError:
+        # a BarsSearch left by an SQLite with FTS5 cannot be dropped without it
+        pass
     conn.commit()
 
     # -- Create tables: Bars --
@@ -45,7 +128,8 @@ def init_db_tables():
             'Rating' REAL,
             'BeanType' TEXT,
             'BroadBeanOrigin' TEXT,
-            'BroadBeanOriginId' INTEGER
+            'BroadBeanOriginId' INTEGER,
+            'RowDigest' TEXT
         );
     '''
     try:
@@ -73,8 +157,319 @@ def init_db_tables():
         print("Failure. Please try again.")
     conn.commit()
 
-def read_csv_file_and_insert_data(FILENAME):
+    # -- Create tables: CountryAliases --
+    # alternative spellings of Countries.EnglishName found in the bar reviews
+    statement = '''
+        CREATE TABLE 'CountryAliases' (
+            'Alias' TEXT PRIMARY KEY,
+            'EnglishName' TEXT NOT NULL
+        );
+    '''
+    try:
+        cur.execute(statement)
+    except:
+        print("Failure. Please try again.")
+    cur.executemany("INSERT INTO CountryAliases(Alias, EnglishName) VALUES (?, ?)", sorted(COUNTRY_ALIASES.items()))
+    conn.commit()
+
+    # -- Create tables: CompanySummary / CountrySummary / RegionSummary --
+    # per-group aggregates of Bars, maintained by refresh_summaries()
+    statement = '''
+        CREATE TABLE 'CompanySummary' (
+            'Located' INTEGER NOT NULL,
+            'Company' TEXT NOT NULL,
+            'CompanyLocation' TEXT,
+            'Alpha2' TEXT,
+            'Region' TEXT,
+            'AvgRating' REAL,
+            'AvgCocoa' REAL,
+            'BarCount' INTEGER NOT NULL,
+            'MinRating' REAL,
+            'MaxRating' REAL,
+            'StdRating' REAL,
+            'MinCocoa' REAL,
+            'MaxCocoa' REAL,
+            'StdCocoa' REAL,
+            'FirstBarId' INTEGER NOT NULL,
+            PRIMARY KEY ('Located', 'Company')
+        );
+    '''
+    try:
+        cur.execute(statement)
+    except:
+        print("Failure. Please try again.")
+    statement = '''
+        CREATE TABLE 'CountrySummary' (
+            'Side' TEXT NOT NULL,
+            'CountryId' INTEGER NOT NULL,
+            'EnglishName' TEXT,
+            'Alpha2' TEXT,
+            'Region' TEXT,
+            'AvgRating' REAL,
+            'AvgCocoa' REAL,
+            'BarCount' INTEGER NOT NULL,
+            'MinRating' REAL,
+            'MaxRating' REAL,
+            'StdRating' REAL,
+            'MinCocoa' REAL,
+            'MaxCocoa' REAL,
+            'StdCocoa' REAL,
+            PRIMARY KEY ('Side', 'CountryId')
+        );
+    '''
+    try:
+        cur.execute(statement)
+    except:
+        print("Failure. Please try again.")
+    statement = '''
+        CREATE TABLE 'RegionSummary' (
+            'Side' TEXT NOT NULL,
+            'Region' TEXT,
+            'AvgRating' REAL,
+            'AvgCocoa' REAL,
+            'BarCount' INTEGER NOT NULL,
+            'MinRating' REAL,
+            'MaxRating' REAL,
+            'StdRating' REAL,
+            'MinCocoa' REAL,
+            'MaxCocoa' REAL,
+            'StdCocoa' REAL,
+            PRIMARY KEY ('Side', 'Region')
+        );
+    '''
+    try:
+        cur.execute(statement)
+    except:
+        print("Failure. Please try again.")
+    conn.commit()
+
+    # -- Create tables: BuildManifest --
+    # one row per source file that went into the database
+    statement = '''
+        CREATE TABLE 'BuildManifest' (
+            'Source' TEXT PRIMARY KEY,
+            'Hash' TEXT NOT NULL,
+            'MTime' REAL NOT NULL,
+            'Size' INTEGER NOT NULL,
+            'Rows' INTEGER NOT NULL
+        );
+    '''
+    try:
+        cur.execute(statement)
+    except:
+        print("Failure. Please try again.")
+
+    # the schema version is only stamped once a build completes
+    cur.execute("PRAGMA user_version = 0")
+    conn.commit()
+
+    # WAL lets the pooled read-only query connections read while a load
+    # is writing
+    cur.execute("PRAGMA journal_mode = WAL")
+    conn.close()
+
+    if indexes:
+        create_indexes()
+
+# Secondary indexes, one per filter/join/group pattern of the query
+# functions. The Bars indexes on the country IDs and on Company also carry
+# the aggregated columns, so the GROUP BY queries never touch the table.
+INDEX_STATEMENTS = [
+    # top/bottom by rating or cocoa without a filter
+    "CREATE INDEX IF NOT EXISTS 'BarsByRating' ON 'Bars' ('Rating')",
+    "CREATE INDEX IF NOT EXISTS 'BarsByCocoa' ON 'Bars' ('CocoaPercent')",
+    # sellcountry/sellregion filters and the sellers aggregates
+    "CREATE INDEX IF NOT EXISTS 'BarsByLocation' ON 'Bars' ('CompanyLocationId', 'Rating', 'CocoaPercent', 'SpecificBeanBarName')",
+    # sourcecountry/sourceregion filters and the sources aggregates
+    "CREATE INDEX IF NOT EXISTS 'BarsByOrigin' ON 'Bars' ('BroadBeanOriginId', 'Rating', 'CocoaPercent', 'SpecificBeanBarName')",
+    # year= ranges of compound bars filters
+    "CREATE INDEX IF NOT EXISTS 'BarsByReviewDate' ON 'Bars' ('ReviewDate')",
+    # per-country top/bottom by cocoa (bars_top; by rating uses the two
+    # above); covering the listed columns also makes them wider than those,
+    # so the planner keeps using those for everything else
+    "CREATE INDEX IF NOT EXISTS 'BarsByLocationCocoa' ON 'Bars' ('CompanyLocationId', 'CocoaPercent', 'Rating', 'SpecificBeanBarName', 'Company', 'CompanyLocation', 'BroadBeanOrigin')",
+    "CREATE INDEX IF NOT EXISTS 'BarsByOriginCocoa' ON 'Bars' ('BroadBeanOriginId', 'CocoaPercent', 'Rating', 'SpecificBeanBarName', 'Company', 'CompanyLocation', 'BroadBeanOrigin')",
+    # companies: GROUP BY Company
+    "CREATE INDEX IF NOT EXISTS 'BarsByCompany' ON 'Bars' ('Company', 'CompanyLocation', 'Rating', 'CocoaPercent', 'SpecificBeanBarName')",
+    # country/region keywords, and the location name join of companies
+    "CREATE INDEX IF NOT EXISTS 'CountriesByAlpha2' ON 'Countries' ('Alpha2')",
+    "CREATE INDEX IF NOT EXISTS 'CountriesByRegion' ON 'Countries' ('Region')",
+    "CREATE UNIQUE INDEX IF NOT EXISTS 'CountriesByEnglishName' ON 'Countries' ('EnglishName')",
+    # country/region keywords of the aggregate commands
+    "CREATE INDEX IF NOT EXISTS 'CompanySummaryByAlpha2' ON 'CompanySummary' ('Located', 'Alpha2')",
+    "CREATE INDEX IF NOT EXISTS 'CompanySummaryByRegion' ON 'CompanySummary' ('Located', 'Region')",
+    "CREATE INDEX IF NOT EXISTS 'CountrySummaryByAlpha2' ON 'CountrySummary' ('Side', 'Alpha2')",
+    "CREATE INDEX IF NOT EXISTS 'CountrySummaryByRegion' ON 'CountrySummary' ('Side', 'Region')",
+]
+
+def create_indexes():
+    conn = sqlite3.connect(DBNAME)
+    with conn:
+        for statement in INDEX_STATEMENTS:
+            conn.execute(statement)
+    create_search_index(conn)
+    # statistics of the Bars indexes for the query planner (the summary
+    # tables are small enough to keep to their indexes)
+    conn.execute("ANALYZE Bars")
+    conn.close()
+
+# --- search index ---
+# BarsSearch is an FTS5 index over the text columns of Bars, with Bars as
+# its external content, kept in sync by triggers on Bars. It is created
+# (and filled from Bars) with the other indexes. Without FTS5 there is no
+# BarsSearch, and searches fall back to SEARCH_MATCH (see search_match) over
+# the same columns: the same bars match, but they are not ranked.
+SEARCH_COLUMNS = collections.OrderedDict([
+    ("bar", "SpecificBeanBarName"),
+    ("company", "Company"),
+    ("origin", "BroadBeanOrigin"),
+    ("type", "BeanType"),
+])
+
+SEARCH_INDEX_STATEMENTS = [
+    """
+        CREATE VIRTUAL TABLE IF NOT EXISTS 'BarsSearch' USING fts5(
+            SpecificBeanBarName, Company, BroadBeanOrigin, BeanType,
+            content='Bars', content_rowid='Id',
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        )
+    """,
+    """
+        CREATE TRIGGER IF NOT EXISTS 'BarsSearchInsert' AFTER INSERT ON 'Bars' BEGIN
+            INSERT INTO BarsSearch(rowid, SpecificBeanBarName, Company, BroadBeanOrigin, BeanType)
+            VALUES (new.Id, new.SpecificBeanBarName, new.Company, new.BroadBeanOrigin, new.BeanType);
+        END
+    """,
+    """
+        CREATE TRIGGER IF NOT EXISTS 'BarsSearchDelete' AFTER DELETE ON 'Bars' BEGIN
+            INSERT INTO BarsSearch(BarsSearch, rowid, SpecificBeanBarName, Company, BroadBeanOrigin, BeanType)
+            VALUES ('delete', old.Id, old.SpecificBeanBarName, old.Company, old.BroadBeanOrigin, old.BeanType);
+        END
+    """,
+    """
+        CREATE TRIGGER IF NOT EXISTS 'BarsSearchUpdate' AFTER UPDATE OF SpecificBeanBarName, Company, BroadBeanOrigin, BeanType ON 'Bars' BEGIN
+            INSERT INTO BarsSearch(BarsSearch, rowid, SpecificBeanBarName, Company, BroadBeanOrigin, BeanType)
+            VALUES ('delete', old.Id, old.SpecificBeanBarName, old.Company, old.BroadBeanOrigin, old.BeanType);
+            INSERT INTO BarsSearch(rowid, SpecificBeanBarName, Company, BroadBeanOrigin, BeanType)
+            VALUES (new.Id, new.SpecificBeanBarName, new.Company, new.BroadBeanOrigin, new.BeanType);
+        END
+    """,
+]
+
+def create_search_index(conn):
+    if has_table(conn, "BarsSearch"):
+        return
+    try:
+        with conn:
+            for statement in SEARCH_INDEX_STATEMENTS:
+                conn.execute(statement)
+            conn.execute("INSERT INTO BarsSearch(BarsSearch) VALUES ('rebuild')")
+    except sqlite3.OperationalError:
+        # no FTS5 in this SQLite
+        pass
+
+def has_table(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", [name]).fetchone() is not None
+
+# whether the database has BarsSearch; cleared with the result cache
+SEARCH_INDEX = {}
+
+def search_index_available():
+    available = SEARCH_INDEX.get(DBNAME)
+    if available is None:
+        available = SEARCH_INDEX[DBNAME] = has_table(get_connection(), "BarsSearch")
+    return available
+
+# A search= term: [<column>:]<word>[*], where <column> is one of
+# SEARCH_COLUMNS (default: all of them) and * makes <word> a prefix.
+# Returns the normalized term, or raises ValueError.
+def search_term(term):
+    (column, _, word) = term.rpartition(":")
+    if column != "" and column not in SEARCH_COLUMNS:
+        raise ValueError("Unknown search column: {}".format(column))
+    if word.rstrip("*") == "" or "*" in word.rstrip("*"):
+        raise ValueError("Not a search term: {}".format(term))
+    return term
+
+# (column of the term or None, word, prefix) of a normalized term
+def split_search_term(term):
+    (column, _, word) = term.rpartition(":")
+    return (SEARCH_COLUMNS.get(column), word.rstrip("*"), word.endswith("*"))
+
+# How a statement searches: "fts", or ("match", column or None); the SQL
+# of a search depends on it, its parameters on the term.
+def search_shape(term):
+    if term == "":
+        return None
+    if search_index_available():
+        return "fts"
+    return ("match", split_search_term(term)[0])
+
+def search_params(term):
+    (column, word, prefix) = split_search_term(term)
+    if search_index_available():
+        expression = '"{}"'.format(word.replace('"', '""'))
+        if prefix:
+            expression += "*"
+        if column is not None:
+            expression = "{} : {}".format(column, expression)
+        return [expression]
+
+    params = [word, prefix]
+    if column is not None:
+        return params
+    return params * len(SEARCH_COLUMNS)
+
+# the WHERE condition of a search shape, on the table alias
+def search_condition(shape, alias="Bars"):
+    if shape == "fts":
+        return "BarsSearch MATCH ?"
+    (_, column) = shape
+    columns = [column] if column is not None else list(SEARCH_COLUMNS.values())
+    return "({})".format(" OR ".join("SEARCH_MATCH({}.{}, ?, ?)".format(alias, name) for name in columns))
+
+# The words of a text as BarsSearch splits them (the unicode61 tokenizer
+# with remove_diacritics): runs of letters and digits, lower case, without
+# accents.
+@functools.lru_cache(maxsize=4096)
+def search_words(text):
+    import unicodedata
+    decomposed = unicodedata.normalize("NFKD", text)
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return tuple(re.findall(r"[^\W_]+", stripped.lower()))
+
+# SEARCH_MATCH(text, word, prefix): whether text has the words of word in a
+# row (the last one as a prefix when prefix is true), like a BarsSearch
+# MATCH of the quoted word.
+def search_match(text, word, prefix):
+    if text is None:
+        return 0
+    words = search_words(text)
+    terms = search_words(word)
+    if not terms:
+        return 0
+    for start in range(len(words) - len(terms) + 1):
+        window = words[start:start + len(terms)]
+        last = window[-1].startswith(terms[-1]) if prefix else window[-1] == terms[-1]
+        if last and window[:-1] == terms[:-1]:
+            return 1
+    return 0
+
+# Bars get the next AUTOINCREMENT Ids, or, when ids ({row position: Id})
+# is given, only the rows of those positions are inserted, with those Ids
+# (see BAR_ID_SPACING).
+def read_csv_file_and_insert_data(FILENAME, batch_size=LOAD_BATCH_SIZE, pragmas=None, verbose=False, ids=None):
+    invalidate_result_cache()
+    start = time.perf_counter()
+    conn = connect_for_load(pragmas)
+
+    insert_statement = '''
+        INSERT INTO Bars(Id, Company, SpecificBeanBarName, REF, ReviewDate, CocoaPercent, CompanyLocation, Rating, BeanType, BroadBeanOrigin, RowDigest) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+    '''
+
     # read data from CSV
+    import csv
+    rows = 0
     with open(FILENAME, 'r') as csv_f:
         csv_data = csv.reader(csv_f)
 
@@ -82,137 +477,985 @@ def read_csv_file_and_insert_data(FILENAME):
         # csvreader.next() also works in Python 2.
         next(csv_data)
 
-        for row in csv_data:
-            (Company, SpecificBeanBarName, REF, ReviewDate, CocoaPercent, CompanyLocation, Rating, BeanType, BroadBeanOrigin) = row
+        # insert in batches, all inside a single transaction
+        with conn:
+            for batch in batched(csv_rows(csv_data, ids), batch_size):
+                conn.executemany(insert_statement, batch)
+                rows += len(batch)
+    conn.close()
+
+    return load_report(FILENAME, rows, start, verbose)
+
+# Bars are listed in Id order wherever the sort leaves a tie, and a
+# company's location comes from its first bar (see refresh_summaries), both
+# as in the CSV, so build_db() gives a bar the Id of its row position. The
+# Ids are BAR_ID_SPACING apart, which leaves room for the rows appended
+# later (see new_bar_ids).
+BAR_ID_SPACING = 1024
+
+def csv_rows(csv_data, ids=None):
+    for (position, row) in enumerate(csv_data):
+        # rows that are already loaded
+        if ids is not None and position not in ids:
+            continue
 
-            CocoaPercent = float(CocoaPercent.strip('%'))
+        (Company, SpecificBeanBarName, REF, ReviewDate, CocoaPercent, CompanyLocation, Rating, BeanType, BroadBeanOrigin) = row
 
-            try:
-                conn = sqlite3.connect(DBNAME)
-                cur = conn.cursor()
-            except:
-                print("Failure. Please try again.")
+        CocoaPercent = float(CocoaPercent.strip('%'))
 
-            insert_statement = '''
-                INSERT INTO Bars(Company, SpecificBeanBarName, REF, ReviewDate, CocoaPercent, CompanyLocation, Rating, BeanType, BroadBeanOrigin) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
-            '''
+        if ids is None:
+            Id = None
+        else:
+            Id = ids[position]
 
-            # execute and commit
-            cur.execute(insert_statement, [Company, SpecificBeanBarName, REF, ReviewDate, CocoaPercent, CompanyLocation, Rating, BeanType, BroadBeanOrigin])
-            conn.commit()
+        yield (Id, Company, SpecificBeanBarName, REF, ReviewDate, CocoaPercent, CompanyLocation, Rating, BeanType, BroadBeanOrigin, row_digest(row))
 
-def read_json_file_and_insert_data(FILENAME):
-    # read data from JSON
-    json_f = open(FILENAME, 'r')
-    json_f_content = json_f.read()
-    json_data = json.loads(json_f_content)
+# A digest of the fields of a CSV row, stored with its bar (RowDigest), by
+# which build_db() tells the loaded rows from new or edited ones.
+def row_digest(row):
+    import hashlib
+    return hashlib.blake2b("\x1f".join(row).encode("utf-8"), digest_size=8).hexdigest()
 
-    try:
-        conn = sqlite3.connect(DBNAME)
-        cur = conn.cursor()
-    except:
-        print("Failure. Please try again.")
+def read_json_file_and_insert_data(FILENAME, batch_size=LOAD_BATCH_SIZE, pragmas=None, verbose=False):
+    invalidate_result_cache()
+    start = time.perf_counter()
+    conn = connect_for_load(pragmas)
+
+    insert_statement = '''
+        INSERT INTO Countries(Alpha2, Alpha3, EnglishName, Region, Subregion, Population, Area) VALUES (?, ?, ?, ?, ?, ?, ?);
+    '''
+
+    # stream the top-level array one country at a time
+    rows = 0
+    with open(FILENAME, 'r') as json_f:
+        with conn:
+            for batch in batched(country_rows(iter_json_array(json_f)), batch_size):
+                conn.executemany(insert_statement, batch)
+                rows += len(batch)
+    conn.close()
 
+    return load_report(FILENAME, rows, start, verbose)
+
+# keep only the columns stored in Countries
+def country_rows(json_data):
     for row in json_data:
-        Alpha2 = row["alpha2Code"]
-        Alpha3 = row["alpha3Code"]
-        EnglishName = row["name"]
-        Region = row["region"]
-        Subregion = row["subregion"]
-        Population = row["population"]
-        Area = row["area"]
-
-        insert_statement = '''
-            INSERT INTO Countries(Alpha2, Alpha3, EnglishName, Region, Subregion, Population, Area) VALUES (?, ?, ?, ?, ?, ?, ?);
-        '''
+        Alpha2 = row.get("alpha2Code")
+        Alpha3 = row.get("alpha3Code")
+        EnglishName = row.get("name")
+        Region = row.get("region")
+        Subregion = row.get("subregion")
+        Population = row.get("population")
+        Area = row.get("area")
+
+        yield (Alpha2, Alpha3, EnglishName, Region, Subregion, Population, Area)
+
+# Yield the elements of a top-level JSON array without reading the whole
+# document: only one element (plus one chunk of lookahead) is held in memory.
+# Anything json.load() would reject is a ValueError, as it is there: the
+# elements must be separated by exactly one comma, and only whitespace may
+# follow the closing bracket.
+JSON_CHUNK_SIZE = 65536
+JSON_WHITESPACE = " \t\r\n"
+
+def iter_json_array(json_f, chunk_size=JSON_CHUNK_SIZE):
+    import json
+    decoder = json.JSONDecoder()
+    source = getattr(json_f, "name", "the JSON document")
+    buffer = ""
+    pos = 0
+    eof = False
+    # what comes next: "[", "first" (an element or "]"), "element",
+    # "separator" ("," or "]") or "end" (nothing)
+    expect = "["
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in JSON_WHITESPACE:
+            pos += 1
+
+        if pos == len(buffer):
+            if eof:
+                if expect == "end":
+                    return
+                raise ValueError("Unexpected end of JSON array in {}".format(source))
+            buffer = json_f.read(chunk_size)
+            pos = 0
+            eof = buffer == ""
+            continue
+
+        char = buffer[pos]
+        if expect == "end":
+            raise ValueError("Extra data after the JSON array in {}".format(source))
+        if expect == "[":
+            if char != "[":
+                raise ValueError("Expected a top-level JSON array in {}".format(source))
+            expect = "first"
+            pos += 1
+            continue
+        if char == "]" and expect in ("first", "separator"):
+            expect = "end"
+            pos += 1
+            continue
+        if expect == "separator":
+            if char != ",":
+                raise ValueError("Expected ',' or ']' after an element of the JSON array in {}".format(source))
+            expect = "element"
+            pos += 1
+            continue
+        if char in ",]":
+            raise ValueError("Expected an element of the JSON array in {}".format(source))
 
-        # execute and commit
-        cur.execute(insert_statement, [Alpha2, Alpha3, EnglishName, Region, Subregion, Population, Area])
-        conn.commit()
+        try:
+            element, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # the element continues past the end of the buffer
+            if eof:
+                raise
+            more = json_f.read(chunk_size)
+            eof = more == ""
+            buffer = buffer[pos:] + more
+            pos = 0
+            continue
+
+        # a scalar that ends exactly at the buffer boundary may be truncated
+        if end == len(buffer) and not eof and not isinstance(element, (dict, list)):
+            more = json_f.read(chunk_size)
+            eof = more == ""
+            buffer = buffer[pos:] + more
+            pos = 0
+            continue
+
+        yield element
+        pos = end
+        expect = "separator"
+
+# Spellings used for CompanyLocation / BroadBeanOrigin in the reviews that
+# differ from Countries.EnglishName. Seeds the CountryAliases table.
+COUNTRY_ALIASES = {
+    "Amsterdam": "Netherlands",
+    "Bolivia": "Bolivia (Plurinational State of)",
+    "Domincan Republic": "Dominican Republic",
+    "Eucador": "Ecuador",
+    "Holland": "Netherlands",
+    "Iran": "Iran (Islamic Republic of)",
+    "Ivory Coast": "C\u00f4te d'Ivoire",
+    "Niacragua": "Nicaragua",
+    "Russia": "Russian Federation",
+    "Sao Tome": "Sao Tome and Principe",
+    "Scotland": "United Kingdom of Great Britain and Northern Ireland",
+    "South Korea": "Korea (Republic of)",
+    "St. Lucia": "Saint Lucia",
+    "Tanzania": "Tanzania, United Republic of",
+    "Trinidad": "Trinidad and Tobago",
+    "U.K.": "United Kingdom of Great Britain and Northern Ireland",
+    "U.S.A.": "United States of America",
+    "UK": "United Kingdom of Great Britain and Northern Ireland",
+    "USA": "United States of America",
+    "Venezuela": "Venezuela (Bolivarian Republic of)",
+    "Vietnam": "Viet Nam",
+    "Wales": "United Kingdom of Great Britain and Northern Ireland",
+}
+
+def country_name_key(name):
+    if name is None:
+        return None
+    return name.strip().casefold()
+
+# name -> Countries.Id for every EnglishName and alias
+def country_id_lookup(cur):
+    lookup = {}
+    for (country_id, name) in cur.execute("SELECT Id, EnglishName FROM Countries"):
+        lookup[country_name_key(name)] = country_id
+    aliases = cur.execute('''
+        SELECT a.Alias, c.Id
+        FROM CountryAliases AS a
+        JOIN Countries AS c ON a.EnglishName = c.EnglishName
+    ''').fetchall()
+    for (alias, country_id) in aliases:
+        # an exact EnglishName match always wins over an alias
+        lookup.setdefault(country_name_key(alias), country_id)
+    return lookup
+
+# bar_ids: only resolve the bars of these Ids (the appended ones)
+def update_tables(bar_ids=None, batch_size=LOAD_BATCH_SIZE):
+    invalidate_result_cache()
 
-def update_tables():
     try:
         conn = sqlite3.connect(DBNAME)
         cur = conn.cursor()
     except:
         print("Failure. Please try again.")
 
-    # set CompanyLocationId &
-    update_CompanyLocationId = '''
-        UPDATE Bars
-        SET (CompanyLocationId) = (SELECT c.ID FROM Countries c WHERE Bars.CompanyLocation = c.EnglishName)
-    '''
+    lookup = country_id_lookup(cur)
+    since_id = 0
 
-    update_BroadBeanOriginId = '''
-        UPDATE Bars
-        SET (BroadBeanOriginId) = (SELECT c.ID FROM Countries c WHERE Bars.BroadBeanOrigin = c.EnglishName)
+    # set CompanyLocationId & BroadBeanOriginId in one pass over Bars,
+    # walking it in Id order one batch at a time
+    select_statement = '''
+        SELECT Id, CompanyLocation, BroadBeanOrigin FROM Bars WHERE Id > ? ORDER BY Id LIMIT ?
+    '''
+    if bar_ids is not None:
+        create_new_bars(cur, bar_ids)
+        select_statement = '''
+            SELECT Id, CompanyLocation, BroadBeanOrigin FROM Bars WHERE Id > ? AND Id IN (SELECT Id FROM NewBars) ORDER BY Id LIMIT ?
+        '''
+    update_statement = '''
+        UPDATE Bars SET CompanyLocationId = ?, BroadBeanOriginId = ? WHERE Id = ?
     '''
 
     # execute and commit
-    cur.execute(update_CompanyLocationId)
-    cur.execute(update_BroadBeanOriginId)
+    while True:
+        rows = cur.execute(select_statement, [since_id, batch_size]).fetchall()
+        if not rows:
+            break
+        resolved = [
+            (lookup.get(country_name_key(location)), lookup.get(country_name_key(origin)), bar_id)
+            for (bar_id, location, origin) in rows
+        ]
+        cur.executemany(update_statement, resolved)
+        since_id = rows[-1][0]
     conn.commit()
-
-# Queries
-# --- bars ---
-def bars_query(specification="", keyword="", criteria="ratings", sorting_order="top", limit="10"):
-    # connect db
+    conn.close()
+
+    refresh_summaries(bar_ids)
+
+# the temporary table NewBars of the given bar Ids, on the connection of cur
+def create_new_bars(cur, bar_ids):
+    cur.execute("CREATE TEMP TABLE NewBars ('Id' INTEGER PRIMARY KEY)")
+    cur.executemany("INSERT INTO NewBars(Id) VALUES (?)", ((bar_id,) for bar_id in bar_ids))
+
+# --- summary tables ---
+# CompanySummary, CountrySummary and RegionSummary hold the per-group
+# averages and counts the companies, countries and regions commands sort
+# on, so those commands read one row per group instead of aggregating Bars.
+#   CompanySummary.Located = 0: all bars of the company;
+#                            1: only bars whose location resolved to a country
+#   Side = 'sellers' (CompanyLocationId) or 'sources' (BroadBeanOriginId)
+# CompanyLocation, Alpha2 and Region of a company come from its first bar.
+SUMMARY_TABLES = ["CompanySummary", "CountrySummary", "RegionSummary"]
+SUMMARY_SIDES = [("sellers", "CompanyLocationId"), ("sources", "BroadBeanOriginId")]
+
+# The metrics of a group, in summary column order: criteria -> (summary
+# column, aggregate over Bars). Any of them can be sorted on; a report
+# (see parse_command) lists them all.
+SUMMARY_METRICS = collections.OrderedDict([
+    ("ratings", ("AvgRating", "AVG(Rating)")),
+    ("cocoa", ("AvgCocoa", "AVG(CocoaPercent)")),
+    ("bars_sold", ("BarCount", "COUNT(SpecificBeanBarName)")),
+    ("min_rating", ("MinRating", "MIN(Rating)")),
+    ("max_rating", ("MaxRating", "MAX(Rating)")),
+    ("stddev_rating", ("StdRating", "STDDEV_POP(Rating)")),
+    ("min_cocoa", ("MinCocoa", "MIN(CocoaPercent)")),
+    ("max_cocoa", ("MaxCocoa", "MAX(CocoaPercent)")),
+    ("stddev_cocoa", ("StdCocoa", "STDDEV_POP(CocoaPercent)")),
+])
+SUMMARY_METRIC_COLUMNS = ", ".join(column for (column, _) in SUMMARY_METRICS.values())
+SUMMARY_METRIC_AGGREGATES = ", ".join("{} AS {}".format(aggregate, column) for (column, aggregate) in SUMMARY_METRICS.values())
+
+# population standard deviation, which SQLite does not have
+class StdDevPop:
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.squares = 0.0
+
+    def step(self, value):
+        if value is not None:
+            self.count += 1
+            self.total += value
+            self.squares += value * value
+
+    def finalize(self):
+        return stddev_pop(self.count, self.total, self.squares)
+
+def stddev_pop(count, total, squares):
+    if count == 0:
+        return None
+    mean = total / count
+    return max(squares / count - mean * mean, 0.0) ** 0.5
+
+def register_functions(conn):
+    conn.create_aggregate("STDDEV_POP", 1, StdDevPop)
+    conn.create_function("SEARCH_MATCH", 3, search_match)
+
+# Recompute the summary rows of every group that has one of the bars of
+# bar_ids (all groups when bar_ids is None).
+def refresh_summaries(bar_ids=None):
     conn = sqlite3.connect(DBNAME)
+    register_functions(conn)
     cur = conn.cursor()
 
-    # form the statement
-    if "c1" in specification:
-        statement = "SELECT SpecificBeanBarName, Company, CompanyLocation, Rating, CocoaPercent, BroadBeanOrigin "
+    if bar_ids is None:
+        for table in SUMMARY_TABLES:
+            cur.execute("DELETE FROM {}".format(table))
+        company_filter = "1"
+    else:
+        create_new_bars(cur, bar_ids)
+        company_filter = "Company IN (SELECT Company FROM Bars WHERE Id IN (SELECT Id FROM NewBars))"
+        cur.execute("DELETE FROM CompanySummary WHERE " + company_filter)
+
+    # the location columns come from the company's first bar (FirstBarId)
+    for (located, join) in [(0, ""), (1, "JOIN Countries AS c1 ON Bars.CompanyLocationId = c1.Id")]:
+        statement = '''
+            INSERT INTO CompanySummary(Located, Company, CompanyLocation, Alpha2, Region, {0}, FirstBarId)
+            SELECT {1}, Groups.Company, First.CompanyLocation, c1.Alpha2, c1.Region, {0}, Groups.FirstBarId
+            FROM (
+                SELECT Company, {2}, MIN(Bars.Id) AS FirstBarId
+                FROM Bars
+                {3}
+                WHERE {4}
+                GROUP BY Company
+            ) AS Groups
+            JOIN Bars AS First ON First.Id = Groups.FirstBarId
+            LEFT JOIN Countries AS c1 ON First.CompanyLocationId = c1.Id
+        '''.format(SUMMARY_METRIC_COLUMNS, located, SUMMARY_METRIC_AGGREGATES, join, company_filter)
+        cur.execute(statement)
+
+    for (side, column) in SUMMARY_SIDES:
+        if bar_ids is None:
+            country_filter = "1"
+            region_filter = "1"
+        else:
+            country_filter = "Countries.Id IN (SELECT {} FROM Bars WHERE Id IN (SELECT Id FROM NewBars))".format(column)
+            region_filter = '''Region IN (
+                SELECT c.Region FROM Bars AS b JOIN Countries AS c ON b.{} = c.Id WHERE b.Id IN (SELECT Id FROM NewBars))'''.format(column)
+            cur.execute("DELETE FROM CountrySummary WHERE Side = ? AND CountryId IN (SELECT {} FROM Bars WHERE Id IN (SELECT Id FROM NewBars))".format(column), [side])
+            cur.execute("DELETE FROM RegionSummary WHERE Side = ? AND " + region_filter, [side])
+
+        statement = '''
+            INSERT INTO CountrySummary(Side, CountryId, EnglishName, Alpha2, Region, {})
+            SELECT ?, Countries.Id, EnglishName, Alpha2, Region, {}
+            FROM Countries
+            JOIN Bars ON Countries.Id = Bars.{}
+            WHERE {}
+            GROUP BY EnglishName
+        '''.format(SUMMARY_METRIC_COLUMNS, SUMMARY_METRIC_AGGREGATES, column, country_filter)
+        cur.execute(statement, [side])
+
+        statement = '''
+            INSERT INTO RegionSummary(Side, Region, {})
+            SELECT ?, Region, {}
+            FROM Countries
+            JOIN Bars ON Countries.Id = Bars.{}
+            WHERE {}
+            GROUP BY Region
+        '''.format(SUMMARY_METRIC_COLUMNS, SUMMARY_METRIC_AGGREGATES, column, region_filter)
+        cur.execute(statement, [side])
+
+    conn.commit()
+    conn.close()
+
+# --- incremental build ---
+# Bump whenever the schema created by init_db_tables changes; a database
+# stamped with another version is rebuilt from scratch.
+SCHEMA_VERSION = 11
+
+def file_fingerprint(FILENAME):
+    import hashlib
+    digest = hashlib.sha256()
+    with open(FILENAME, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    stat = os.stat(FILENAME)
+    return {"Hash": digest.hexdigest(), "MTime": stat.st_mtime, "Size": stat.st_size}
+
+def read_manifest(conn):
+    try:
+        rows = conn.execute("SELECT Source, Hash, MTime, Size, Rows FROM BuildManifest").fetchall()
+    except sqlite3.OperationalError:
+        return {}
+    return {source: {"Hash": h, "MTime": m, "Size": s, "Rows": r} for (source, h, m, s, r) in rows}
+
+def write_manifest(conn, source, fingerprint, rows):
+    conn.execute(
+        "INSERT OR REPLACE INTO BuildManifest(Source, Hash, MTime, Size, Rows) VALUES (?, ?, ?, ?, ?)",
+        [source, fingerprint["Hash"], fingerprint["MTime"], fingerprint["Size"], rows])
+
+# Returns the fingerprint of a source when it changed since the manifest
+# entry was written, or None when it did not. The hash is only computed
+# when size or mtime differ.
+def changed_source(conn, manifest, source):
+    entry = manifest.get(source)
+    stat = os.stat(source)
+    if entry is not None and entry["Size"] == stat.st_size and entry["MTime"] == stat.st_mtime:
+        return None
+    fingerprint = file_fingerprint(source)
+    if entry is not None and entry["Hash"] == fingerprint["Hash"]:
+        # touched but identical: remember the new mtime
+        with conn:
+            write_manifest(conn, source, fingerprint, entry["Rows"])
+        return None
+    return fingerprint
+
+# the row_digest() of every CSV row, in order
+def csv_digests(FILENAME):
+    import csv
+    with open(FILENAME, 'r') as csv_f:
+        csv_data = csv.reader(csv_f)
+        next(csv_data)
+        return [row_digest(row) for row in csv_data]
+
+# {row position: Id} for the CSV rows (digests, the row_digest() of each
+# row) not loaded yet, or None when they cannot be appended. Every loaded
+# bar (loaded: (Id, RowDigest) in Id order) must still be a row of the
+# CSV, unchanged and in the same order: an edited row does not match its
+# bar any more. The new rows between two loaded bars are spread over the
+# Ids between theirs, and the ones after the last loaded bar are
+# BAR_ID_SPACING apart, so Id order stays the row order, as after a
+# rebuild.
+def new_bar_ids(digests, loaded):
+    loaded_digests = {digest for (_, digest) in loaded}
+    loaded = iter(loaded)
+    ids = {}
+    gap = []
+    previous_id = 0
+    for (position, digest) in enumerate(digests):
+        if digest not in loaded_digests:
+            gap.append(position)
+            continue
+        (bar_id, loaded_digest) = next(loaded, (None, None))
+        if loaded_digest != digest:
+            return None
+        if bar_id - previous_id <= len(gap):
+            # no Ids left in between
+            return None
+        for (k, gap_position) in enumerate(gap):
+            ids[gap_position] = previous_id + (k + 1) * (bar_id - previous_id) // (len(gap) + 1)
+        gap = []
+        previous_id = bar_id
+    if next(loaded, None) is not None:
+        return None
+    for (k, gap_position) in enumerate(gap):
+        ids[gap_position] = previous_id + (k + 1) * BAR_ID_SPACING
+    return ids
+
+def rebuild_db(verbose=False):
+    init_db_tables(indexes=False)
+    bars = read_csv_file_and_insert_data(BARSCSV, verbose=verbose, ids=new_bar_ids(csv_digests(BARSCSV), []))
+    countries = read_json_file_and_insert_data(COUNTRIESJSON, verbose=verbose)
+    update_tables()
+    create_indexes()
+
+    conn = sqlite3.connect(DBNAME)
+    with conn:
+        write_manifest(conn, BARSCSV, file_fingerprint(BARSCSV), bars["rows"])
+        write_manifest(conn, COUNTRIESJSON, file_fingerprint(COUNTRIESJSON), countries["rows"])
+        conn.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+    conn.close()
+
+# Bring choc.db up to date with the source files: nothing is reloaded when
+# they are unchanged, and new rows in the CSV (new review batches) are
+# appended, with the Ids a rebuild would put in the same order (see
+# new_bar_ids). Anything else, such as an edited or removed row, triggers a
+# full rebuild.
+# Returns "unchanged", "appended" or "rebuilt".
+def build_db(verbose=False):
+    conn = sqlite3.connect(DBNAME)
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    manifest = read_manifest(conn)
+
+    if version != SCHEMA_VERSION or BARSCSV not in manifest or COUNTRIESJSON not in manifest \
+            or changed_source(conn, manifest, COUNTRIESJSON) is not None:
+        conn.close()
+        rebuild_db(verbose)
+        return "rebuilt"
+
+    fingerprint = changed_source(conn, manifest, BARSCSV)
+    if fingerprint is None:
+        conn.close()
+        return "unchanged"
+
+    # every row already loaded must be unchanged in the CSV
+    loaded = conn.execute("SELECT Id, RowDigest FROM Bars ORDER BY Id").fetchall()
+    digests = csv_digests(BARSCSV)
+    ids = new_bar_ids(digests, loaded)
+    conn.close()
+    if ids is None:
+        rebuild_db(verbose)
+        return "rebuilt"
+
+    read_csv_file_and_insert_data(BARSCSV, verbose=verbose, ids=ids)
+    update_tables(bar_ids=ids.values())
+
+    conn = sqlite3.connect(DBNAME)
+    with conn:
+        write_manifest(conn, BARSCSV, fingerprint, len(digests))
+    conn.close()
+    return "appended"
+
+# --- connections ---
+# Queries share one read-only connection per thread and database file,
+# opened on first use. close_connections() closes every one of them (or
+# those of the given threads), and runs at exit; the connections of threads
+# that have finished are closed whenever a new one is opened.
+READ_PRAGMAS = {
+    "mmap_size": 268435456,
+    "cache_size": -16384,
+    "temp_store": "MEMORY",
+}
+
+THREAD_CONNECTIONS = threading.local()
+# (thread, connections of the thread, filename, connection) of every open one
+POOLED_CONNECTIONS = []
+POOL_LOCK = threading.Lock()
+
+def open_read_connection(filename):
+    uri = "file:{}?mode=ro".format(urllib.parse.quote(os.path.abspath(filename)))
+    # check_same_thread=False only so close_connections() can close it from
+    # another thread; each connection is used by the thread that opened it
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+    register_functions(conn)
+    for name, value in READ_PRAGMAS.items():
+        conn.execute("PRAGMA {} = {}".format(name, value))
+    return conn
+
+def get_connection():
+    connections = getattr(THREAD_CONNECTIONS, "connections", None)
+    if connections is None:
+        connections = THREAD_CONNECTIONS.connections = {}
+
+    conn = connections.get(DBNAME)
+    if conn is None:
+        close_connections(threads=())
+        conn = open_read_connection(DBNAME)
+        connections[DBNAME] = conn
+        with POOL_LOCK:
+            POOLED_CONNECTIONS.append((threading.current_thread(), connections, DBNAME, conn))
+    return conn
+
+# threads: only close the connections of these threads (which must not be
+# using them any more) and of the finished ones
+def close_connections(threads=None):
+    with POOL_LOCK:
+        kept = []
+        for (thread, connections, filename, conn) in POOLED_CONNECTIONS:
+            if threads is None or thread in threads or not thread.is_alive():
+                connections.pop(filename, None)
+                conn.close()
+            else:
+                kept.append((thread, connections, filename, conn))
+        POOLED_CONNECTIONS[:] = kept
+
+atexit.register(close_connections)
+
+# Queries
+# Each query type has a *_statement function that forms the SQL template
+# for a command shape, and a *_query function that binds the keyword and
+# limit to it and runs it. Templates are cached, and the pooled connections
+# keep the compiled statements in their own statement cache, so a repeated
+# command shape is neither rebuilt nor re-parsed.
+STATEMENT_CACHE_SIZE = 256
+
+# the only values a specification may take; it is formed into the SQL
+# (the country ID columns are the per-country statements of bars_top())
+SPECIFICATIONS = ["", "c1.Alpha2", "c2.Alpha2", "c1.Region", "c2.Region", "Alpha2", "Region",
+                  "CompanyLocationId", "BroadBeanOriginId"]
+
+def check_specification(specification):
+    if specification not in SPECIFICATIONS:
+        raise ValueError("Unknown specification: {}".format(specification))
+
+def limit_param(limit):
+    return int(limit)
+
+def execute_query(statement, params=()):
+    with trace_stage("connect"):
+        cur = get_connection().cursor()
+
+    trace = current_trace()
+    if trace is not None:
+        trace.statements.append((statement, list(params)))
+
+    # excute the statement
+    with trace_stage("execute"):
+        cur.execute(statement, params)
+    with trace_stage("fetch"):
+        results = cur.fetchall()
+    cur.close()
+
+    return results
+
+# Rows of a statement as they are fetched, FETCH_SIZE at a time, so a huge
+# result set is never held in memory as a whole.
+FETCH_SIZE = 1000
+
+def iter_query(statement, params=(), fetch_size=FETCH_SIZE):
+    cur = get_connection().cursor()
+    try:
+        cur.execute(statement, params)
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        cur.close()
+
+# EXPLAIN QUERY PLAN rows of a statement, as (id, parent, detail)
+def query_plan(statement, params=()):
+    conn = get_connection()
+    return [(row[0], row[1], row[3]) for row in conn.execute("EXPLAIN QUERY PLAN " + statement, params)]
+
+# plan steps that read a whole table without going through an index
+def full_table_scans(statement, params=()):
+    return [detail for (_, _, detail) in query_plan(statement, params)
+            if detail.startswith("SCAN") and " USING " not in detail]
+
+# --- bars ---
+# metric column of the bars, per criteria
+BARS_COLUMNS = {
+    "ratings": "Rating",
+    "cocoa": "CocoaPercent",
+}
+
+# keyset: also select Bars.Id, for bars_page(); after: only list the bars
+# that come after a (metric, Id) key in the sorting order
+# search: the search_shape() of a search= term; matches are listed by
+# relevance first (with the search index)
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def bars_statement(specification="", criteria="ratings", sorting_order="top", keyset=False, after=False, search=None):
+    check_specification(specification)
+
+    # form the statement (BarsSearch has columns of the same names)
+    table = "Bars." if search == "fts" else ""
+    columns = [table + column for column in RESULT_COLUMNS["bars"]]
+    if keyset:
+        columns.append("Bars.Id")
+    statement = "SELECT {} ".format(", ".join(columns))
+    if search == "fts":
+        statement += "FROM BarsSearch JOIN Bars ON Bars.Id = BarsSearch.rowid "
+    else:
         statement += "FROM Bars "
+    if "c1" in specification:
         statement += "JOIN Countries AS c1 ON Bars.CompanyLocationId = c1.Id "
     elif "c2" in specification:
-        statement = "SELECT SpecificBeanBarName, Company, CompanyLocation, Rating, CocoaPercent, BroadBeanOrigin "
-        statement += "FROM Bars "
         statement += "JOIN Countries AS c2 ON Bars.BroadBeanOriginId = c2.Id "
-    else:
-        statement = "SELECT SpecificBeanBarName, Company, CompanyLocation, Rating, CocoaPercent, BroadBeanOrigin "
-        statement += "FROM Bars "
+
+    # top: DESC / bottom ASC
+    direction = ""
+    if sorting_order == "top":
+        direction = "DESC"
+        comparison = "<"
+    elif sorting_order == "bottom":
+        direction = "ASC"
+        comparison = ">"
 
     # specifications
+    conditions = []
+    if specification != "":
+        conditions.append("{} = ?".format(specification))
+    if search is not None:
+        conditions.append(search_condition(search))
+    if after:
+        # the (metric, Id) seek, written so the metric index bounds the range
+        conditions.append("{0} {1}= ? AND ({0} {1} ? OR Bars.Id > ?)".format(BARS_COLUMNS[criteria], comparison))
+    if conditions:
+        statement += "WHERE {} ".format(" AND ".join(conditions))
+
+    # ratings / cocoa, ties listed in Id order
+    order = []
+    if search == "fts":
+        order.append("BarsSearch.rank")
+    if criteria in BARS_COLUMNS:
+        order.append("{} {}, Bars.Id ASC".format(BARS_COLUMNS[criteria], direction))
+    if order:
+        statement += "ORDER BY {} ".format(", ".join(order))
+
+    # limit
+    statement += "LIMIT ?" #list the top <limit> matches or the bottom <limit> matches.
+
+    return statement
+
+def bars_params(specification="", keyword="", limit="10", search=""):
+    params = []
     if specification != "":
         if "Alpha2" in specification:
             keyword = keyword.upper()
-        try:
-            statement += "WHERE {} = '{}' ".format(specification , keyword)
-        except:
-            print("Failure. Please try again.")
+        params.append(keyword)
+    if search != "":
+        params.extend(search_params(search))
+    params.append(limit_param(limit))
+    return params
+
+# filters: further (specification, keyword) pairs; ranges: (column, low,
+# high) of RANGE_COLUMNS (see bars_filter_statement)
+def bars_query(specification="", keyword="", criteria="ratings", sorting_order="top", limit="10", search="", filters=(), ranges=()):
+    check_bars_specification(specification)
+    if filters or ranges:
+        if specification != "":
+            filters = ((specification, keyword),) + tuple(filters)
+        return execute_query(*bars_filter(filters, ranges, criteria, sorting_order, limit))
+    if specification != "" and search == "" and criteria in BARS_COLUMNS and limit_param(limit) >= 0:
+        counts = country_bar_counts(specification, bars_params(specification, keyword, limit)[0], limit_param(limit))
+        if per_country_cheaper(counts):
+            return bars_top(specification, keyword, criteria, sorting_order, limit)
+    statement = bars_statement(specification, criteria, sorting_order, search=search_shape(search))
+    return execute_query(statement, bars_params(specification, keyword, limit, search))
+
+# Top-k of a country or region filter, one country at a time: the index
+# on (country ID, metric) lists a country's bars in (metric, Id) order, so
+# each per-country statement stops after limit rows, and the sorted lists
+# are merged up to the limit. That reads at most limit rows per country,
+# instead of every bar of the region going through the sorter; it is
+# chosen when that is fewer rows, counting TOPK_QUERY_ROWS per statement.
+TOPK_QUERY_ROWS = 256
+
+BARS_SIDES = {
+    "c1": "sellers",
+    "c2": "sources",
+}
+
+# a specification of the bars command: none, or a country or region of
+# either side
+def check_bars_specification(specification):
+    check_specification(specification)
+    if specification != "" and specification.partition(".")[0] not in BARS_SIDES:
+        raise ValueError("Unknown specification for bars: {}".format(specification))
+
+# (countries, bars, rows bars_top reads) of the countries of a filter that
+# have bars, from the summary table
+def country_bar_counts(specification, keyword, limit):
+    (side, _, column) = specification.partition(".")
+    statement = "SELECT COUNT(*), TOTAL(BarCount), TOTAL(MIN(BarCount, ?)) FROM CountrySummary WHERE Side = ? AND {} = ?".format(column)
+    return execute_query(statement, [limit, BARS_SIDES[side], keyword])[0]
+
+def per_country_cheaper(counts):
+    (countries, bars, reads) = counts
+    return countries * TOPK_QUERY_ROWS + reads < bars
+
+# IDs of the countries of a filter that have bars
+def country_ids(specification, keyword):
+    (side, _, column) = specification.partition(".")
+    statement = "SELECT CountryId FROM CountrySummary WHERE Side = ? AND {} = ? ORDER BY CountryId".format(column)
+    return [row[0] for row in execute_query(statement, [BARS_SIDES[side], keyword])]
+
+# merge key of a metric, with NULLs where ORDER BY puts them (first when
+# ascending, last when descending)
+def metric_key(value, descending):
+    if value is None:
+        return (descending, 0)
+    return (not descending, -value if descending else value)
+
+# (a negative limit means no limit, as in the statements)
+def bars_top(specification, keyword, criteria="ratings", sorting_order="top", limit="10"):
+    check_bars_specification(specification)
+    side = BARS_SIDES[specification.split(".")[0]]
+    statement = bars_statement(dict(SUMMARY_SIDES)[side], criteria, sorting_order, keyset=True)
+    keyword = bars_params(specification, keyword, limit)[0]
+    limit = limit_param(limit)
+
+    metric = RESULT_COLUMNS["bars"].index(BARS_COLUMNS[criteria])
+    descending = sorting_order == "top"
+    per_country = [execute_query(statement, [country, limit]) for country in country_ids(specification, keyword)]
+    merged = heapq.merge(*per_country, key=lambda row: (metric_key(row[metric], descending), row[6]))
+    return [row[:6] for row in itertools.islice(merged, limit if limit >= 0 else None)]
+
+# --- compound bars filters ---
+# Several country and region filters (filters: (specification, keyword)
+# pairs) and ranges of CocoaPercent, Rating and ReviewDate (ranges:
+# (column, low, high), None for an open end) in one statement. Each one is
+# a condition on one column of Bars, and bars_plan() picks the condition
+# whose index the bars are looked up through: the most selective one, or
+# none, when the metric index reaches the limit sooner by listing the bars
+# in order. The index of every other condition is turned off with a unary +.
+RANGE_COLUMNS = {
+    "cocoa": "CocoaPercent",
+    "rating": "Rating",
+    "year": "ReviewDate",
+}
+
+# ranges: (column, has a low end, has a high end) of each range
+# driver: position of the indexed condition (filters first), or None
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def bars_filter_statement(specifications, ranges, driver=None, criteria="ratings", sorting_order="top"):
+    conditions = []
+    for specification in specifications:
+        check_bars_specification(specification)
+        (side, _, column) = specification.partition(".")
+        conditions.append(("Bars." + dict(SUMMARY_SIDES)[BARS_SIDES[side]], "IN (SELECT Id FROM Countries WHERE {} = ?)".format(column)))
+    for (column, low, high) in ranges:
+        if column not in RANGE_COLUMNS.values():
+            raise ValueError("Unknown range column: {}".format(column))
+        bounds = []
+        if low:
+            bounds.append(">= ?")
+        if high:
+            bounds.append("<= ?")
+        conditions.append(("Bars." + column, bounds))
+
+    where = []
+    for (position, (column, condition)) in enumerate(conditions):
+        if position != driver:
+            column = "+" + column
+        if isinstance(condition, list):
+            where.extend("{} {}".format(column, bound) for bound in condition)
+        else:
+            where.append("{} {}".format(column, condition))
+
+    direction = "DESC" if sorting_order == "top" else "ASC"
+    statement = "SELECT {} FROM Bars WHERE {} ".format(", ".join(RESULT_COLUMNS["bars"]), " AND ".join(where))
+    if criteria in BARS_COLUMNS:
+        statement += "ORDER BY {} {}, Bars.Id ASC ".format(BARS_COLUMNS[criteria], direction)
+    statement += "LIMIT ?"
+    return statement
+
+def bars_filter_params(filters, ranges, limit="10"):
+    params = []
+    for (specification, keyword) in filters:
+        params.append(bars_params(specification, keyword, limit)[0])
+    for (column, low, high) in ranges:
+        params.extend(bound for bound in (low, high) if bound is not None)
+    params.append(limit_param(limit))
+    return params
+
+# per column, (distinct values in order, running count of the bars up to
+# each one); cleared with the result cache
+COLUMN_HISTOGRAMS = {}
+
+def column_histogram(column):
+    histogram = COLUMN_HISTOGRAMS.get((DBNAME, column))
+    if histogram is None:
+        rows = execute_query("SELECT {0}, COUNT(*) FROM Bars WHERE {0} IS NOT NULL GROUP BY {0} ORDER BY {0}".format(column))
+        histogram = ([value for (value, _) in rows], [0] + list(itertools.accumulate(count for (_, count) in rows)))
+        COLUMN_HISTOGRAMS[(DBNAME, column)] = histogram
+    return histogram
+
+def range_rows(column, low, high):
+    (values, counts) = column_histogram(column)
+    start = 0 if low is None else bisect.bisect_left(values, low)
+    end = len(values) if high is None else bisect.bisect_right(values, high)
+    return counts[max(start, end)] - counts[start]
+
+# whether a value is between low and high (None for an open end), as a
+# range condition holds; never for a NULL
+def in_range(value, low, high):
+    return value is not None and (low is None or value >= low) and (high is None or value <= high)
+
+# Position of the condition to look the bars up by (see above), from the
+# estimated bars of each: CountrySummary for the filters, the histograms
+# for the ranges.
+def bars_plan(filters, ranges, criteria, limit):
+    estimates = [country_bar_counts(specification, bars_params(specification, keyword, limit)[0], 0)[1] for (specification, keyword) in filters]
+    estimates += [range_rows(column, low, high) for (column, low, high) in ranges]
+    driver = min(range(len(estimates)), key=estimates.__getitem__)
+
+    # in metric order, about limit / selectivity bars are read to fill the limit
+    bars = column_histogram("Rating")[1][-1]
+    selectivity = 1.0
+    for estimate in estimates:
+        selectivity *= min(1.0, estimate / bars) if bars else 0.0
+    if criteria in BARS_COLUMNS and limit >= 0 and selectivity > 0 and limit / selectivity < estimates[driver]:
+        return None
+    return driver
+
+# statement and parameters of a compound filter
+def bars_filter(filters, ranges, criteria="ratings", sorting_order="top", limit="10"):
+    driver = bars_plan(filters, ranges, criteria, limit_param(limit))
+    statement = bars_filter_statement(tuple(specification for (specification, _) in filters),
+                                      tuple((column, low is not None, high is not None) for (column, low, high) in ranges),
+                                      driver, criteria, sorting_order)
+    return (statement, bars_filter_params(filters, ranges, limit))
+
+# Keyset (seek) pagination: one page of bars, and the key to pass as after
+# for the next one (None after the last page). Each page seeks to the key
+# through the index instead of skipping the earlier rows with OFFSET.
+def bars_page(specification="", keyword="", criteria="ratings", sorting_order="top", page_size=100, after=None):
+    statement = bars_statement(specification, criteria, sorting_order, keyset=True, after=after is not None)
+    params = bars_params(specification, keyword, page_size)
+    if after is not None:
+        (value, bar_id) = after
+        params[-1:-1] = [value, value, bar_id]
+
+    rows = execute_query(statement, params)
+    next_key = None
+    if len(rows) == limit_param(page_size):
+        last = rows[-1]
+        next_key = (last[3] if criteria == "ratings" else last[4], last[6])
+    return ([row[:6] for row in rows], next_key)
 
-    # ratings / cocoa
-    if criteria == "ratings":
-        statement += "ORDER BY {} ".format("Rating")
-    elif criteria == "cocoa":
-        statement += "ORDER BY {} ".format("CocoaPercent")
+# --- companies ---
+# aggregated columns of the summary tables, per criteria
+SUMMARY_COLUMNS = {criteria: column for (criteria, (column, _)) in SUMMARY_METRICS.items()}
+
+# the aggregated columns a statement selects: the criteria's, or with report
+# all of them
+def metric_columns(criteria, report=False):
+    if report:
+        return SUMMARY_METRIC_COLUMNS
+    return SUMMARY_COLUMNS[criteria]
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def companies_statement(specification="", criteria="ratings", sorting_order="top", report=False, search=None):
+    check_specification(specification)
+
+    # sourcecountry / sourceregion are not summarized
+    if "c2" in specification:
+        if search is not None:
+            raise ValueError("search= does not combine with sourcecountry/sourceregion for companies")
+        if report or criteria not in ("ratings", "cocoa", "bars_sold"):
+            return companies_origin_metrics_statement(specification, criteria, sorting_order, report)
+        return companies_origin_statement(specification, criteria, sorting_order)
+
+    # form the statement
+    statement = "SELECT CompanySummary.Company, CompanyLocation, {} ".format(metric_columns(criteria, report))
+    statement += "FROM CompanySummary "
+
+    # search: the companies with a matching bar, with the rank of their best match
+    if search is not None:
+        statement += "JOIN ("
+        if search == "fts":
+            statement += "SELECT Bars.Company, MIN(BarsSearch.rank) AS SearchRank "
+            statement += "FROM BarsSearch JOIN Bars ON Bars.Id = BarsSearch.rowid "
+        else:
+            statement += "SELECT Bars.Company, 0 AS SearchRank "
+            statement += "FROM Bars "
+        statement += "WHERE {} ".format(search_condition(search))
+        statement += "GROUP BY Bars.Company"
+        statement += ") AS Matches ON Matches.Company = CompanySummary.Company "
+
+    # with a country or region, only bars from a known location count
+    if specification == "":
+        statement += "WHERE Located = 0 "
+    else:
+        statement += "WHERE Located = 1 "
+    statement += "AND BarCount > 4 "
+
+    # specifications
+    if specification != "":
+        statement += "AND {} = ? ".format(specification.split(".")[-1])
 
     # top: DESC / bottom ASC
+    direction = ""
     if sorting_order == "top":
-        statement += "{} ".format("DESC")
+        direction = "DESC"
     elif sorting_order == "bottom":
-        statement += "{} ".format("ASC")
+        direction = "ASC"
 
-    # limit
-    statement += "LIMIT {}".format(limit) #list the top <limit> matches or the bottom <limit> matches.
-
-    # excute the statement
-    # print(statement)
-    results = []
-    rows = cur.execute(statement).fetchall()
-    for row in rows:
-        results.append(row)
-    conn.commit()
-
-    return results
-
-# --- companies ---
-def companies_query(specification="", keyword="", criteria="ratings", sorting_order="top", limit="10"):
-    # connect db
-    conn = sqlite3.connect(DBNAME)
-    cur = conn.cursor()
+    # the metric, ties ordered by Company in the same direction
+    statement += "ORDER BY "
+    if search == "fts":
+        statement += "Matches.SearchRank, "
+    statement += "{} {}, CompanySummary.Company {} ".format(SUMMARY_COLUMNS[criteria], direction, direction)
 
+    # limit
+    statement += "LIMIT ?" #list the top <limit> matches or the bottom <limit> matches.
+
+    return statement
+
+# A filter on the bean origin of a company's first bar only passes
+# companies with some bar from that origin. Restricting the rows to those
+# companies keeps or drops each company's rows as a whole, so it is safe in
+# WHERE: the groups (and their aggregates) are the same, only the other
+# companies are no longer grouped, and the origin is found through
+# BarsByOrigin. The first bar itself is still checked after grouping.
+def origin_companies_condition(specification):
+    statement = "Bars.Company IN (SELECT Origins.Company FROM Bars AS Origins "
+    statement += "JOIN Countries AS OriginCountries ON Origins.BroadBeanOriginId = OriginCountries.Id "
+    statement += "WHERE OriginCountries.{} = ?) ".format(specification.split(".")[-1])
+    return statement
+
+# companies filtered on the bean origin of their first bar, aggregated from Bars
+def companies_origin_statement(specification, criteria, sorting_order):
     # form the statement
     if criteria == "ratings":
         statement = "SELECT Company, CompanyLocation, AVG(Rating) "
@@ -221,179 +1464,1031 @@ def companies_query(specification="", keyword="", criteria="ratings", sorting_or
     elif criteria == "bars_sold":
         statement = "SELECT Company, CompanyLocation, COUNT(SpecificBeanBarName) "
 
+    # (MIN(Bars.Id) makes CompanyLocation and the country columns come from
+    # the company's first bar)
     statement += "FROM Bars "
+    statement += "JOIN Countries AS c2 ON Bars.BroadBeanOriginId = c2.Id "
+    statement += "WHERE " + origin_companies_condition(specification)
+    statement += "GROUP BY Company "
+    statement += "HAVING COUNT(SpecificBeanBarName) > 4 AND MIN(Bars.Id) > 0 "
+    statement += "AND {} = ? ".format(specification)
 
-    # form the statement
-    if "c1.Alpha2" in specification:
-        statement += "JOIN Countries AS c1 ON Bars.CompanyLocationId = c1.Id "
-        statement += "GROUP BY Company "
-        statement += "HAVING COUNT(SpecificBeanBarName) > 4 "
-    elif "c2.Alpha2" in specification:
-        statement += "JOIN Countries AS c2 ON Bars.BroadBeanOriginId = c2.Id "
-        statement += "GROUP BY Company "
-        statement += "HAVING COUNT(SpecificBeanBarName) > 4 "
-    elif specification == "Alpha2" or specification == "Region":
-        statement += "JOIN Countries ON Bars.CompanyLocation = Countries.EnglishName "
-        statement += "GROUP BY Company "
-        statement += "HAVING COUNT(SpecificBeanBarName) > 4 "
-    else:
-        statement += "GROUP BY Company "
-        statement += "HAVING COUNT(SpecificBeanBarName) > 4 "
-
-    # specifications
-    if specification != "":
-        if "Alpha2" in specification:
-            keyword = keyword.upper()
-        try:
-            statement += "AND {} = '{}' ".format(specification , keyword)
-        except:
-            print("Failure. Please try again.")
+    # top: DESC / bottom ASC
+    direction = ""
+    if sorting_order == "top":
+        direction = "DESC"
+    elif sorting_order == "bottom":
+        direction = "ASC"
 
-    # ratings / cocoa
+    # ratings / cocoa / bars_sold, ties ordered by Company in the same direction
     if criteria == "ratings":
-        statement += "ORDER BY {} ".format("AVG(Rating)")
+        statement += "ORDER BY {} {}, Company {} ".format("AVG(Rating)", direction, direction)
     elif criteria == "cocoa":
-        statement += "ORDER BY {} ".format("AVG(CocoaPercent)")
+        statement += "ORDER BY {} {}, Company {} ".format("AVG(CocoaPercent)", direction, direction)
     elif criteria == "bars_sold":
-        statement += "ORDER BY {} ".format("COUNT(SpecificBeanBarName)")
+        statement += "ORDER BY {} {}, Company {} ".format("COUNT(SpecificBeanBarName)", direction, direction)
+
+    # limit
+    statement += "LIMIT ?" #list the top <limit> matches or the bottom <limit> matches.
+
+    return statement
+
+# The same, for any metric: the groups are aggregated first, then joined to
+# their first bar for the location and the origin filter. (The MIN(Bars.Id)
+# trick above does not work next to other MIN/MAX aggregates.)
+def companies_origin_metrics_statement(specification, criteria, sorting_order, report):
+    # form the statement
+    statement = "SELECT Groups.Company, First.CompanyLocation, {} ".format(metric_columns(criteria, report))
+    statement += "FROM ("
+    statement += "SELECT Company, {}, MIN(Bars.Id) AS FirstBarId ".format(SUMMARY_METRIC_AGGREGATES)
+    statement += "FROM Bars "
+    statement += "JOIN Countries AS c2 ON Bars.BroadBeanOriginId = c2.Id "
+    statement += "WHERE " + origin_companies_condition(specification)
+    statement += "GROUP BY Company "
+    statement += "HAVING COUNT(SpecificBeanBarName) > 4"
+    statement += ") AS Groups "
+    statement += "JOIN Bars AS First ON First.Id = Groups.FirstBarId "
+    statement += "JOIN Countries AS c2 ON First.BroadBeanOriginId = c2.Id "
+    statement += "WHERE {} = ? ".format(specification)
 
     # top: DESC / bottom ASC
+    direction = ""
     if sorting_order == "top":
-        statement += "{} ".format("DESC")
+        direction = "DESC"
     elif sorting_order == "bottom":
-        statement += "{} ".format("ASC")
+        direction = "ASC"
 
-    # limit
-    statement += "LIMIT {}".format(limit) #list the top <limit> matches or the bottom <limit> matches.
+    # any metric, ties ordered by Company in the same direction
+    statement += "ORDER BY {} {}, Groups.Company {} ".format(SUMMARY_COLUMNS[criteria], direction, direction)
 
-    # excute the statement
-    # print(statement)
-    results = []
-    rows = cur.execute(statement).fetchall()
-    for row in rows:
-        results.append(row)
-    conn.commit()
+    # limit
+    statement += "LIMIT ?"
 
-    return results
+    return statement
 
-# --- countries ---
-def countries_query(specification="", keyword="", criteria="ratings", sorting_order="top", limit="10", sellers_or_sources="sellers"):
-    # connect db
-    conn = sqlite3.connect(DBNAME)
-    cur = conn.cursor()
+# (the search comes before the specification in the statement, and an
+# origin filter binds the keyword twice)
+def companies_params(specification="", keyword="", limit="10", search=""):
+    params = []
+    if search != "":
+        params.extend(search_params(search))
+    params += bars_params(specification, keyword, limit)
+    if "c2" in specification:
+        params.insert(0, params[0])
+    return params
 
-    statement = "SELECT EnglishName, Region, "
+def companies_query(specification="", keyword="", criteria="ratings", sorting_order="top", limit="10", report=False, search=""):
+    statement = companies_statement(specification, criteria, sorting_order, report, search_shape(search))
+    return execute_query(statement, companies_params(specification, keyword, limit, search))
 
-    # form the statement
-    if criteria == "ratings":
-        statement += "AVG(Rating) "
-    elif criteria == "cocoa":
-        statement += "AVG(CocoaPercent) "
-    elif criteria == "bars_sold":
-        statement += "COUNT(SpecificBeanBarName) "
+# --- countries ---
+def check_sellers_or_sources(sellers_or_sources):
+    if sellers_or_sources not in ("sellers", "sources"):
+        raise ValueError("Unknown sellers_or_sources: {}".format(sellers_or_sources))
 
-    statement += "FROM Countries "
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def countries_statement(specification="", criteria="ratings", sorting_order="top", sellers_or_sources="sellers", report=False):
+    if specification not in ("", "Alpha2", "Region"):
+        raise ValueError("Unknown specification for countries: {}".format(specification))
+    check_sellers_or_sources(sellers_or_sources)
 
     # form the statement
-    if sellers_or_sources == "sellers":
-        statement += "JOIN Bars ON Countries.Id = Bars.CompanyLocationId "
-    elif sellers_or_sources == "sources":
-        statement += "JOIN Bars ON Countries.Id = Bars.BroadBeanOriginId "
-
-    statement += "GROUP BY EnglishName "
-    statement += "HAVING COUNT(SpecificBeanBarName) > 4 "
+    statement = "SELECT EnglishName, Region, {} ".format(metric_columns(criteria, report))
+    statement += "FROM CountrySummary "
+    statement += "WHERE Side = '{}' ".format(sellers_or_sources)
+    statement += "AND BarCount > 4 "
 
     # specifications
     if specification != "":
-        if "Region" in specification:
-            keyword = keyword.title()
-        try:
-            statement += "AND {} = '{}' ".format(specification , keyword)
-        except:
-            print("Failure. Please try again.")
-
-    # ratings / cocoa
-    if criteria == "ratings":
-        statement += "ORDER BY {} ".format("AVG(Rating)")
-    elif criteria == "cocoa":
-        statement += "ORDER BY {} ".format("AVG(CocoaPercent)")
-    elif criteria == "bars_sold":
-        statement += "ORDER BY {} ".format("COUNT(SpecificBeanBarName)")
+        statement += "AND {} = ? ".format(specification)
 
     # top: DESC / bottom ASC
+    direction = ""
     if sorting_order == "top":
-        statement += "{} ".format("DESC")
+        direction = "DESC"
     elif sorting_order == "bottom":
-        statement += "{} ".format("ASC")
+        direction = "ASC"
+
+    # the metric, ties ordered by EnglishName in the same direction
+    statement += "ORDER BY {} {}, EnglishName {} ".format(SUMMARY_COLUMNS[criteria], direction, direction)
 
     # limit
-    statement += "LIMIT {}".format(limit) #list the top <limit> matches or the bottom <limit> matches.
+    statement += "LIMIT ?" #list the top <limit> matches or the bottom <limit> matches.
 
-    # excute the statement
-    # print(statement)
-    results = []
-    rows = cur.execute(statement).fetchall()
-    for row in rows:
-        results.append(row)
-    conn.commit()
+    return statement
 
-    return results
+def countries_params(specification="", keyword="", limit="10"):
+    params = []
+    if specification != "":
+        if "Region" in specification:
+            keyword = keyword.title()
+        params.append(keyword)
+    params.append(limit_param(limit))
+    return params
+
+def countries_query(specification="", keyword="", criteria="ratings", sorting_order="top", limit="10", sellers_or_sources="sellers", report=False):
+    statement = countries_statement(specification, criteria, sorting_order, sellers_or_sources, report)
+    return execute_query(statement, countries_params(specification, keyword, limit))
 
 # --- regions ---
-def regions_query(specification="", keyword="", criteria="ratings", sorting_order="top", limit="10", sellers_or_sources="sellers"):
-    # connect db
-    conn = sqlite3.connect(DBNAME)
-    cur = conn.cursor()
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def regions_statement(specification="", criteria="ratings", sorting_order="top", sellers_or_sources="sellers", report=False):
+    check_sellers_or_sources(sellers_or_sources)
 
     # form the statement
-    statement = "SELECT Region, "
-
-    if criteria == "ratings":
-        statement += "AVG(Rating) "
-    elif criteria == "cocoa":
-        statement += "AVG(CocoaPercent) "
-    elif criteria == "bars_sold":
-        statement += "COUNT(SpecificBeanBarName) "
+    statement = "SELECT Region, {} ".format(metric_columns(criteria, report))
+    statement += "FROM RegionSummary "
+    statement += "WHERE Side = '{}' ".format(sellers_or_sources)
+    statement += "AND BarCount > 4 "
 
-    statement += "FROM Countries "
+    # top: DESC / bottom ASC
+    direction = ""
+    if sorting_order == "top":
+        direction = "DESC"
+    elif sorting_order == "bottom":
+        direction = "ASC"
 
-    # form the statement
-    if sellers_or_sources == "sellers":
-        statement += "JOIN Bars ON Countries.Id = Bars.CompanyLocationId "
-    elif sellers_or_sources == "sources":
-        statement += "JOIN Bars ON Countries.Id = Bars.BroadBeanOriginId "
+    # the metric, ties ordered by Region in the same direction
+    statement += "ORDER BY {} {}, Region {} ".format(SUMMARY_COLUMNS[criteria], direction, direction)
 
+    # limit
+    statement += "LIMIT ?" #list the top <limit> matches or the bottom <limit> matches.
 
-    statement += "GROUP BY Region "
-    statement += "HAVING COUNT(SpecificBeanBarName) > 4 "
+    return statement
 
-    # ratings / cocoa
-    if criteria == "ratings":
-        statement += "ORDER BY {} ".format("AVG(Rating)")
-    elif criteria == "cocoa":
-        statement += "ORDER BY {} ".format("AVG(CocoaPercent)")
-    elif criteria == "bars_sold":
-        statement += "ORDER BY {} ".format("COUNT(SpecificBeanBarName)")
+def regions_params(specification="", keyword="", limit="10"):
+    return [limit_param(limit)]
 
-    # top: DESC / bottom ASC
-    if sorting_order == "top":
-        statement += "{} ".format("DESC")
-    elif sorting_order == "bottom":
-        statement += "{} ".format("ASC")
+def regions_query(specification="", keyword="", criteria="ratings", sorting_order="top", limit="10", sellers_or_sources="sellers", report=False):
+    statement = regions_statement(specification, criteria, sorting_order, sellers_or_sources, report)
+    return execute_query(statement, regions_params(specification, keyword, limit))
 
-    # limit
-    statement += "LIMIT {}".format(limit) #list the top <limit> matches or the bottom <limit> matches.
+# --- columnar backend ---
+# QUERY_BACKEND picks what answers parsed commands: "sqlite" runs the query
+# functions above, "columnar" answers from a ColumnStore, an in-memory copy
+# of Bars and Countries loaded once and dropped whenever the result cache is
+# invalidated. Both return the same rows in the same order.
+QUERY_BACKEND = "sqlite"
 
-    # excute the statement
-    # print(statement)
-    results = []
-    rows = cur.execute(statement).fetchall()
-    for row in rows:
-        results.append(row)
-    conn.commit()
+COLUMN_STORE = None
+COLUMN_STORE_LOCK = threading.Lock()
 
+# NumPy is optional: without it the column store works on array.array
+# columns with plain loops and heapq.
+def load_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+# Dictionary-encode a sequence of strings. Codes follow the sorted order of
+# the values, so comparing codes compares the strings.
+def dictionary_encode(values):
+    dictionary = sorted(set(values), key=lambda value: (value is not None, value))
+    positions = {value: code for (code, value) in enumerate(dictionary)}
+    return (dictionary, array.array('i', [positions[value] for value in values]))
+
+# The columns of the column store and their array typecodes ("s": a list of
+# strings, the dictionary of a code column), in the order they are encoded
+# and written to a column snapshot. Countries are indexed by position, bars
+# are in Id order, and <side>_positions lists the bars of each country (the
+# ones of country c from <side>_offsets[c] to <side>_offsets[c + 1]).
+STORE_COLUMNS = collections.OrderedDict([
+    ("country_names", "s"),
+    ("alpha2_dictionary", "s"),
+    ("country_alpha2", "i"),
+    ("region_dictionary", "s"),
+    ("country_region", "i"),
+    ("bar_id", "q"),
+    ("company_dictionary", "s"),
+    ("company", "i"),
+    ("bar_name_dictionary", "s"),
+    ("bar_name", "i"),
+    ("location_dictionary", "s"),
+    ("location", "i"),
+    ("origin_dictionary", "s"),
+    ("origin", "i"),
+    ("location_country", "i"),
+    ("origin_country", "i"),
+    ("rating", "d"),
+    ("cocoa", "d"),
+    ("review_date_dictionary", "s"),
+    ("review_date", "i"),
+    ("sellers_offsets", "q"),
+    ("sellers_positions", "i"),
+    ("sources_offsets", "q"),
+    ("sources_positions", "i"),
+])
+
+# (offsets, positions) of the bars of each country, from the country
+# position of every bar (-1: none)
+def country_bar_index(country_of, countries):
+    offsets = array.array('q', [0]) * (countries + 1)
+    for country in country_of:
+        if country >= 0:
+            offsets[country + 1] += 1
+    for country in range(countries):
+        offsets[country + 1] += offsets[country]
+    positions = array.array('i', [0]) * offsets[countries]
+    following = offsets[:countries]
+    for (position, country) in enumerate(country_of):
+        if country >= 0:
+            positions[following[country]] = position
+            following[country] += 1
+    return (offsets, positions)
+
+# STORE_COLUMNS of the Bars rows (Id, Company, SpecificBeanBarName,
+# CompanyLocation, BroadBeanOrigin, CompanyLocationId, BroadBeanOriginId,
+# Rating, CocoaPercent, ReviewDate) and Countries rows (Id, EnglishName,
+# Alpha2, Region)
+def encode_columns(bars, countries):
+    columns = {}
+    # Countries.Id -> position
+    positions = {row[0]: position for (position, row) in enumerate(countries)}
+    columns["country_names"] = [row[1] for row in countries]
+    (columns["alpha2_dictionary"], columns["country_alpha2"]) = dictionary_encode([row[2] for row in countries])
+    (columns["region_dictionary"], columns["country_region"]) = dictionary_encode([row[3] for row in countries])
+
+    columns["bar_id"] = array.array('q', [row[0] for row in bars])
+    (columns["company_dictionary"], columns["company"]) = dictionary_encode([row[1] for row in bars])
+    (columns["bar_name_dictionary"], columns["bar_name"]) = dictionary_encode([row[2] for row in bars])
+    (columns["location_dictionary"], columns["location"]) = dictionary_encode([row[3] for row in bars])
+    (columns["origin_dictionary"], columns["origin"]) = dictionary_encode([row[4] for row in bars])
+    columns["location_country"] = array.array('i', [positions.get(row[5], -1) for row in bars])
+    columns["origin_country"] = array.array('i', [positions.get(row[6], -1) for row in bars])
+    columns["rating"] = array.array('d', [row[7] for row in bars])
+    columns["cocoa"] = array.array('d', [row[8] for row in bars])
+    (columns["review_date_dictionary"], columns["review_date"]) = dictionary_encode([row[9] for row in bars])
+
+    for (side, column) in [("sellers", "location_country"), ("sources", "origin_country")]:
+        (columns[side + "_offsets"], columns[side + "_positions"]) = country_bar_index(columns[column], len(countries))
+    return columns
+
+# The store works on any sequences of its STORE_COLUMNS: the arrays of
+# encode_columns(), or memoryviews of a column snapshot.
+class ColumnStore:
+
+    def __init__(self, columns, numpy=None):
+        self.numpy = numpy
+        for name in STORE_COLUMNS:
+            setattr(self, name, columns[name])
+
+        # side -> (offsets, positions) of the bars of each country
+        self.bars_by_country = {
+            "sellers": (self.sellers_offsets, self.sellers_positions),
+            "sources": (self.sources_offsets, self.sources_positions),
+        }
+
+        if numpy is not None:
+            self.np_rating = numpy.frombuffer(self.rating, dtype=numpy.float64)
+            self.np_cocoa = numpy.frombuffer(self.cocoa, dtype=numpy.float64)
+            self.np_bar_id = numpy.frombuffer(self.bar_id, dtype=numpy.int64)
+
+        self.group_cache = {}
+
+    # -- helpers --
+    def metric(self, criteria):
+        if criteria == "ratings":
+            return self.rating
+        elif criteria == "cocoa":
+            return self.cocoa
+        raise ValueError("Unknown criteria: {}".format(criteria))
+
+    def countries_where(self, column, keyword):
+        if column == "Alpha2":
+            (dictionary, codes) = (self.alpha2_dictionary, self.country_alpha2)
+        elif column == "Region":
+            (dictionary, codes) = (self.region_dictionary, self.country_region)
+        else:
+            raise ValueError("Unknown specification: {}".format(column))
+        return [position for (position, code) in enumerate(codes) if dictionary[code] == keyword]
+
+    # the side of a bars specification
+    def bars_side(self, specification):
+        if specification.startswith("c1."):
+            return "sellers"
+        elif specification.startswith("c2."):
+            return "sources"
+        raise ValueError("Unknown specification for bars: {}".format(specification))
+
+    # the bars of the countries of a bars specification and keyword
+    def country_bars(self, specification, keyword):
+        (offsets, positions) = self.bars_by_country[self.bars_side(specification)]
+        bars = []
+        for country in self.countries_where(specification.split(".")[-1], keyword):
+            bars.extend(positions[offsets[country]:offsets[country + 1]])
+        return bars
+
+    # Positions of the bars that pass every filter ((specification, keyword)
+    # pairs) and range ((column, low, high) of RANGE_COLUMNS, None for an
+    # open end), as the conditions of bars_filter_statement().
+    def filtered_positions(self, filters, ranges):
+        positions = None
+        for (specification, keyword) in filters:
+            bars = set(self.country_bars(specification, keyword))
+            positions = bars if positions is None else positions & bars
+        if positions is None:
+            positions = range(len(self.bar_id))
+
+        for (column, low, high) in ranges:
+            if column == "ReviewDate":
+                # (a text column: compared as text, as in the SQL)
+                codes = {code for (code, value) in enumerate(self.review_date_dictionary) if in_range(value, low, high)}
+                positions = [position for position in positions if self.review_date[position] in codes]
+            elif column in ("Rating", "CocoaPercent"):
+                values = self.rating if column == "Rating" else self.cocoa
+                positions = [position for position in positions if in_range(values[position], low, high)]
+            else:
+                raise ValueError("Unknown range column: {}".format(column))
+        return sorted(positions)
+
+    def bar_row(self, position):
+        return (
+            self.bar_name_dictionary[self.bar_name[position]],
+            self.company_dictionary[self.company[position]],
+            self.location_dictionary[self.location[position]],
+            self.rating[position],
+            self.cocoa[position],
+            self.origin_dictionary[self.origin[position]],
+        )
+
+    # positions of the first `limit` candidates ordered by (metric, Id)
+    def top_positions(self, candidates, criteria, sorting_order, limit):
+        values = self.metric(criteria)
+        count = len(candidates) if candidates is not None else len(values)
+        if limit < 0 or limit > count:
+            limit = count
+        if limit == 0:
+            return []
+        descending = sorting_order == "top"
+
+        numpy = self.numpy
+        if numpy is not None:
+            np_values = self.np_rating if criteria == "ratings" else self.np_cocoa
+            if candidates is None:
+                positions = numpy.arange(count)
+            else:
+                positions = numpy.asarray(candidates, dtype=numpy.int64)
+            keys = np_values[positions]
+            if descending:
+                keys = -keys
+            if limit < count:
+                # everything up to the limit-th key, including its ties
+                threshold = numpy.partition(keys, limit - 1)[limit - 1]
+                selected = keys <= threshold
+                positions = positions[selected]
+                keys = keys[selected]
+            order = numpy.lexsort((self.np_bar_id[positions], keys))[:limit]
+            return positions[order].tolist()
+
+        if candidates is None:
+            candidates = range(count)
+        if descending:
+            key = lambda position: (-values[position], self.bar_id[position])
+        else:
+            key = lambda position: (values[position], self.bar_id[position])
+        return heapq.nsmallest(limit, candidates, key=key)
+
+    # Group the bars by codes (one per bar, -1 for none): per group, in
+    # code order, [code, count, first bar position, rating sum, cocoa sum,
+    # min rating, max rating, rating squares sum, min cocoa, max cocoa,
+    # cocoa squares sum]. The sums add the bars in position order.
+    def group_totals(self, codes):
+        numpy = self.numpy
+        if numpy is not None:
+            selected = numpy.flatnonzero(codes >= 0)
+            (keys, first, inverse, counts) = numpy.unique(codes[selected], return_index=True, return_inverse=True, return_counts=True)
+            columns = [keys, counts, selected[first]]
+            for values in (self.np_rating[selected], self.np_cocoa[selected]):
+                columns.append(numpy.bincount(inverse, weights=values, minlength=len(keys)))
+            for values in (self.np_rating[selected], self.np_cocoa[selected]):
+                low = numpy.full(len(keys), numpy.inf)
+                numpy.minimum.at(low, inverse, values)
+                high = numpy.full(len(keys), -numpy.inf)
+                numpy.maximum.at(high, inverse, values)
+                columns += [low, high, numpy.bincount(inverse, weights=values * values, minlength=len(keys))]
+            return [list(entry) for entry in zip(*[column.tolist() for column in columns])]
+
+        totals = {}
+        for (position, code) in enumerate(codes):
+            if code < 0:
+                continue
+            rating = self.rating[position]
+            cocoa = self.cocoa[position]
+            entry = totals.get(code)
+            if entry is None:
+                totals[code] = [code, 1, position, rating, cocoa, rating, rating, rating * rating, cocoa, cocoa, cocoa * cocoa]
+            else:
+                entry[1] += 1
+                entry[3] += rating
+                entry[4] += cocoa
+                entry[5] = min(entry[5], rating)
+                entry[6] = max(entry[6], rating)
+                entry[7] += rating * rating
+                entry[8] = min(entry[8], cocoa)
+                entry[9] = max(entry[9], cocoa)
+                entry[10] += cocoa * cocoa
+        return [totals[code] for code in sorted(totals)]
+
+    # the metrics of a group's totals, in SUMMARY_METRICS order
+    def group_metrics(self, entry):
+        count = entry[1]
+        return (
+            entry[3] / count, entry[4] / count, count,
+            entry[5], entry[6], stddev_pop(count, entry[3], entry[7]),
+            entry[8], entry[9], stddev_pop(count, entry[4], entry[10]),
+        )
+
+    # The bar codes of a grouping, with NumPy as one array:
+    #   companies[:sellers|:sources]: the company (only of the bars located
+    #       in / from a country for :sellers / :sources)
+    #   countries:<side>: the country of the side
+    #   regions:<side>: the region of the side's country
+    def group_codes(self, name):
+        numpy = self.numpy
+        (family, _, side) = name.partition(":")
+        country = None
+        if side == "sellers":
+            country = self.location_country
+        elif side == "sources":
+            country = self.origin_country
+
+        if numpy is not None:
+            if country is not None:
+                country = numpy.frombuffer(country, dtype=numpy.int32)
+            if family == "companies":
+                codes = numpy.frombuffer(self.company, dtype=numpy.int32)
+                return codes if country is None else numpy.where(country >= 0, codes, -1)
+            elif family == "countries":
+                return country
+            regions = numpy.frombuffer(self.country_region, dtype=numpy.int32)
+            return numpy.where(country >= 0, regions[country], -1)
+
+        if family == "companies":
+            if country is None:
+                return self.company
+            return [code if located >= 0 else -1 for (code, located) in zip(self.company, country)]
+        elif family == "countries":
+            return country
+        return [self.country_region[located] if located >= 0 else -1 for located in country]
+
+    # A grouping of the bars, computed once per store: the groups of more
+    # than 4 bars, each as (sort key, label, country it is filtered on,
+    # metrics in SUMMARY_METRICS order), and the group orders (see
+    # group_order).
+    def grouping(self, name):
+        with COLUMN_STORE_LOCK:
+            grouping = self.group_cache.get(name)
+        if grouping is not None:
+            return grouping
+
+        (family, _, side) = name.partition(":")
+        groups = []
+        for entry in self.group_totals(self.group_codes(name)):
+            (code, count, first) = entry[:3]
+            if count <= 4:
+                continue
+            if family == "companies":
+                # located by, and filtered on the country of, the first bar
+                label = (self.company_dictionary[code], self.location_dictionary[self.location[first]])
+                country = None
+                if side == "sellers":
+                    country = self.location_country[first]
+                elif side == "sources":
+                    country = self.origin_country[first]
+                groups.append((code, label, country, self.group_metrics(entry)))
+            elif family == "countries":
+                country_name = self.country_names[code]
+                label = (country_name, self.region_dictionary[self.country_region[code]])
+                groups.append((country_name, label, code, self.group_metrics(entry)))
+            else:
+                groups.append((code, (self.region_dictionary[code],), None, self.group_metrics(entry)))
+
+        grouping = {"groups": groups, "orders": {}}
+        with COLUMN_STORE_LOCK:
+            return self.group_cache.setdefault(name, grouping)
+
+    # the groups in ascending (aggregate, sort key) order, sorted once per
+    # criteria (descending is the reverse, as the SQL orders the key in the
+    # same direction)
+    def group_order(self, grouping, criteria):
+        order = grouping["orders"].get(criteria)
+        if order is None:
+            index = list(SUMMARY_METRICS).index(criteria)
+            groups = grouping["groups"]
+            order = sorted(range(len(groups)), key=lambda group: (groups[group][3][index], groups[group][0]))
+            with COLUMN_STORE_LOCK:
+                order = grouping["orders"].setdefault(criteria, order)
+        return order
+
+    # the first `limit` groups (whose country is in countries, when given)
+    # in the sorting order
+    def top_groups(self, name, criteria, sorting_order, limit, report=False, countries=None):
+        if criteria not in SUMMARY_METRICS:
+            raise ValueError("Unknown criteria: {}".format(criteria))
+        index = list(SUMMARY_METRICS).index(criteria)
+        grouping = self.grouping(name)
+        order = self.group_order(grouping, criteria)
+        if sorting_order == "top":
+            order = reversed(order)
+
+        rows = []
+        groups = grouping["groups"]
+        for group in order:
+            if len(rows) == limit:
+                break
+            (_, label, country, metrics) = groups[group]
+            if countries is not None and country not in countries:
+                continue
+            if report:
+                rows.append(label + metrics)
+            else:
+                rows.append(label + (metrics[index],))
+        return rows
+
+    # -- the four command families --
+    # filters: further (specification, keyword) pairs; ranges: (column, low,
+    # high), as for bars_query()
+    def bars(self, specification, keyword, criteria, sorting_order, limit, filters=(), ranges=()):
+        candidates = None
+        if filters or ranges:
+            if specification != "":
+                filters = ((specification, keyword),) + tuple(filters)
+            candidates = self.filtered_positions(filters, ranges)
+        elif specification != "":
+            candidates = self.country_bars(specification, keyword)
+        positions = self.top_positions(candidates, criteria, sorting_order, limit)
+        return [self.bar_row(position) for position in positions]
+
+    def companies(self, specification, keyword, criteria, sorting_order, limit, report=False):
+        if specification == "":
+            return self.top_groups("companies", criteria, sorting_order, limit, report)
+        name = "companies:sources" if specification.startswith("c2.") else "companies:sellers"
+        countries = set(self.countries_where(specification.split(".")[-1], keyword))
+        return self.top_groups(name, criteria, sorting_order, limit, report, countries)
+
+    def countries(self, specification, keyword, criteria, sorting_order, limit, sellers_or_sources, report=False):
+        countries = None
+        if specification != "":
+            countries = set(self.countries_where(specification, keyword))
+        return self.top_groups("countries:" + sellers_or_sources, criteria, sorting_order, limit, report, countries)
+
+    def regions(self, specification, keyword, criteria, sorting_order, limit, sellers_or_sources, report=False):
+        return self.top_groups("regions:" + sellers_or_sources, criteria, sorting_order, limit, report)
+
+    def query(self, command_dic):
+        query_type = command_dic["query_type"]
+        specification = command_dic["specification"]
+        criteria = command_dic["criteria"]
+        sorting_order = command_dic["sorting_order"]
+        limit = limit_param(command_dic["limit"])
+
+        # the keyword exactly as the SQL path binds it
+        keyword = ""
+        if query_type == "bars":
+            check_specification(specification)
+            if specification != "":
+                keyword = bars_params(specification, command_dic["keyword"], limit)[0]
+            filters = []
+            for (filter_specification, filter_keyword) in command_dic["filters"]:
+                check_specification(filter_specification)
+                filters.append((filter_specification, bars_params(filter_specification, filter_keyword, limit)[0]))
+            return self.bars(specification, keyword, criteria, sorting_order, limit, filters, command_dic["ranges"])
+        elif query_type == "companies":
+            check_specification(specification)
+            if specification != "":
+                keyword = companies_params(specification, command_dic["keyword"], limit)[0]
+            return self.companies(specification, keyword, criteria, sorting_order, limit, command_dic["report"])
+        elif query_type == "countries":
+            if specification not in ("", "Alpha2", "Region"):
+                raise ValueError("Unknown specification for countries: {}".format(specification))
+            check_sellers_or_sources(command_dic["sellers_or_sources"])
+            if specification != "":
+                keyword = countries_params(specification, command_dic["keyword"], limit)[0]
+            return self.countries(specification, keyword, criteria, sorting_order, limit, command_dic["sellers_or_sources"], command_dic["report"])
+        elif query_type == "regions":
+            check_sellers_or_sources(command_dic["sellers_or_sources"])
+            return self.regions(specification, keyword, criteria, sorting_order, limit, command_dic["sellers_or_sources"], command_dic["report"])
+
+def load_column_store():
+    cur = get_connection().cursor()
+    bars = cur.execute('''
+        SELECT Id, Company, SpecificBeanBarName, CompanyLocation, BroadBeanOrigin,
+               CompanyLocationId, BroadBeanOriginId, Rating, CocoaPercent, ReviewDate
+        FROM Bars
+        ORDER BY Id
+    ''').fetchall()
+    countries = cur.execute('''
+        SELECT Id, EnglishName, Alpha2, Region FROM Countries ORDER BY Id
+    ''').fetchall()
+    cur.close()
+    return ColumnStore(encode_columns(bars, countries), load_numpy())
+
+def column_store():
+    global COLUMN_STORE
+    store = COLUMN_STORE
+    if store is None:
+        if COLUMN_SNAPSHOT is not None:
+            store = open_column_snapshot(COLUMN_SNAPSHOT)
+        else:
+            store = load_column_store()
+        with COLUMN_STORE_LOCK:
+            COLUMN_STORE = store
+    return store
+
+def invalidate_column_store():
+    global COLUMN_STORE
+    with COLUMN_STORE_LOCK:
+        COLUMN_STORE = None
+
+# --- column snapshots ---
+# A column snapshot is the column store written to one file, for read-only
+# deployments that answer every command from the column store: strings are
+# dictionary-encoded (one list of the distinct values per column, and a
+# column of int32 codes), numbers are fixed-width little-endian columns.
+#
+#   header: magic, format version, SCHEMA_VERSION, column count,
+#           payload size, CRC-32 of the payload
+#   payload: one entry (name, typecode, items, offset, size) per column,
+#            then the columns, each 8-byte aligned
+#
+# A string list ("s") is items + 1 int64 end offsets into the UTF-8 bytes
+# that follow them, a negative offset -(end + 1) marking a None.
+# open_column_snapshot() memory-maps the file, and the numeric columns of
+# the store are memoryviews of the map, so nothing is copied or parsed but
+# the (small) string lists.
+SNAPSHOT_MAGIC = b"CHOCCOLS"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct("<8sIIIQI")
+SNAPSHOT_ENTRY = struct.Struct("<24s1s7xQQQ")
+
+# the column snapshot the column store is read from instead of choc.db
+COLUMN_SNAPSHOT = None
+
+def encode_strings(values):
+    ends = array.array('q', [0])
+    data = bytearray()
+    for value in values:
+        if value is None:
+            ends.append(-len(data) - 1)
+        else:
+            data += value.encode("utf-8")
+            ends.append(len(data))
+    return column_bytes(ends, 'q') + bytes(data)
+
+def decode_strings(data, items):
+    size = 8 * (items + 1)
+    ends = column_view(data[:size], 'q')
+    data = data[size:]
+    values = []
+    start = 0
+    for end in ends[1:]:
+        if end < 0:
+            values.append(None)
+            end = -end - 1
+        else:
+            values.append(str(data[start:end], "utf-8"))
+        start = end
+    return values
+
+def column_bytes(column, typecode):
+    if sys.byteorder != "little":
+        column = array.array(typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+# a column of the map, without a copy (but on a big-endian machine)
+def column_view(data, typecode):
+    if sys.byteorder == "little":
+        return data.cast(typecode)
+    column = array.array(typecode)
+    column.frombytes(data)
+    column.byteswap()
+    return column
+
+# Write the column store (default: the one of choc.db) to filename.
+# Returns the size of the snapshot in bytes.
+def write_column_snapshot(filename, store=None):
+    import zlib
+    if store is None:
+        store = load_column_store()
+
+    entries = []
+    columns = []
+    offset = SNAPSHOT_ENTRY.size * len(STORE_COLUMNS)
+    for (name, typecode) in STORE_COLUMNS.items():
+        column = getattr(store, name)
+        if typecode == "s":
+            data = encode_strings(column)
+        else:
+            data = column_bytes(column, typecode)
+        entries.append(SNAPSHOT_ENTRY.pack(name.encode("ascii"), typecode.encode("ascii"), len(column), offset, len(data)))
+        data += b"\0" * (-len(data) % 8)
+        columns.append(data)
+        offset += len(data)
+
+    # written next to filename, then moved over it
+    temporary = filename + ".tmp"
+    checksum = 0
+    with open(temporary, "wb") as snapshot_f:
+        snapshot_f.write(b"\0" * SNAPSHOT_HEADER.size)
+        for data in entries + columns:
+            snapshot_f.write(data)
+            checksum = zlib.crc32(data, checksum)
+        snapshot_f.seek(0)
+        snapshot_f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, SCHEMA_VERSION, len(STORE_COLUMNS), offset, checksum))
+    os.replace(temporary, filename)
+    return SNAPSHOT_HEADER.size + offset
+
+# The column store of a column snapshot. verify=False skips the checksum
+# (the only step that reads the whole file). Raises ValueError on a file
+# that is not a snapshot of the current schema, or does not match its
+# checksum.
+def open_column_snapshot(filename, verify=True):
+    import mmap
+    import zlib
+    with open(filename, "rb") as snapshot_f:
+        mapped = mmap.mmap(snapshot_f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+
+    if len(view) < SNAPSHOT_HEADER.size:
+        raise ValueError("Not a column snapshot: {}".format(filename))
+    (magic, version, schema_version, count, size, checksum) = SNAPSHOT_HEADER.unpack_from(view)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise ValueError("Not a column snapshot: {}".format(filename))
+    if schema_version != SCHEMA_VERSION:
+        raise ValueError("Column snapshot of schema version {} (expected {}): {}".format(schema_version, SCHEMA_VERSION, filename))
+    payload = view[SNAPSHOT_HEADER.size:]
+    if len(payload) != size or (verify and zlib.crc32(payload) != checksum):
+        raise ValueError("Corrupt column snapshot: {}".format(filename))
+
+    columns = {}
+    for index in range(count):
+        (name, typecode, items, offset, length) = SNAPSHOT_ENTRY.unpack_from(payload, index * SNAPSHOT_ENTRY.size)
+        (name, typecode) = (name.rstrip(b"\0").decode("ascii"), typecode.decode("ascii"))
+        data = payload[offset:offset + length]
+        if typecode == "s":
+            columns[name] = decode_strings(data, items)
+        else:
+            columns[name] = column_view(data, typecode)
+    missing = [name for name in STORE_COLUMNS if name not in columns]
+    if missing:
+        raise ValueError("Column snapshot without {}: {}".format(", ".join(missing), filename))
+    return ColumnStore(columns, load_numpy())
+
+# Answer commands from a column snapshot (loaded now) with the columnar
+# backend; choc.db is not needed but for search= commands, which go
+# through the search index.
+def use_column_snapshot(filename, verify=True):
+    global COLUMN_SNAPSHOT, COLUMN_STORE, QUERY_BACKEND
+    store = open_column_snapshot(filename, verify)
+    with COLUMN_STORE_LOCK:
+        COLUMN_SNAPSHOT = filename
+        COLUMN_STORE = store
+    QUERY_BACKEND = "columnar"
+    return store
+
+# run the query function of a parsed command, or ask the column store
+def run_query(command_dic):
+    # (the column store has no search index)
+    if QUERY_BACKEND == "columnar" and command_dic["search"] == "":
+        with trace_stage("execute"):
+            return column_store().query(command_dic)
+
+    if command_dic["query_type"] == "bars":
+        return bars_query(command_dic["specification"], command_dic["keyword"], command_dic["criteria"], command_dic["sorting_order"], command_dic["limit"], command_dic["search"], command_dic["filters"], command_dic["ranges"])
+    elif command_dic["query_type"] == "companies":
+        return companies_query(command_dic["specification"], command_dic["keyword"], command_dic["criteria"], command_dic["sorting_order"], command_dic["limit"], command_dic["report"], command_dic["search"])
+    elif command_dic["query_type"] == "countries":
+        return countries_query(command_dic["specification"], command_dic["keyword"], command_dic["criteria"], command_dic["sorting_order"], command_dic["limit"], command_dic["sellers_or_sources"], command_dic["report"])
+    elif command_dic["query_type"] == "regions":
+        return regions_query(command_dic["specification"], command_dic["keyword"], command_dic["criteria"], command_dic["sorting_order"], command_dic["limit"], command_dic["sellers_or_sources"], command_dic["report"])
+
+# --- result cache ---
+# Results of parsed commands, most recently used last. Entries expire after
+# RESULT_CACHE_TTL seconds (None: never) and the least recently used ones
+# are evicted beyond RESULT_CACHE_SIZE. Every load step clears the cache,
+# and so does a commit by any other connection or process (noticed through
+# PRAGMA data_version on the pooled connection). A pooled connection cannot
+# tell whether the database changed before it was opened, so it only uses
+# the entries stored after its first check (entries are numbered from
+# RESULT_CACHE_SEQUENCE).
+RESULT_CACHE_SIZE = 1024
+RESULT_CACHE_TTL = 300.0
+
+RESULT_CACHE = collections.OrderedDict()
+RESULT_CACHE_LOCK = threading.Lock()
+RESULT_CACHE_SEQUENCE = itertools.count(1)
+RESULT_CACHE_STATS = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+# Key of a parsed command: differently written commands that parse to the
+# same QuerySpec share an entry.
+def command_key(command_dic):
+    return (os.path.abspath(DBNAME), command_dic)
+
+def invalidate_result_cache():
+    with RESULT_CACHE_LOCK:
+        RESULT_CACHE.clear()
+        RESULT_CACHE_STATS["invalidations"] += 1
+    SEARCH_INDEX.clear()
+    COLUMN_HISTOGRAMS.clear()
+    invalidate_column_store()
+
+def result_cache_stats():
+    with RESULT_CACHE_LOCK:
+        stats = dict(RESULT_CACHE_STATS)
+        stats["size"] = len(RESULT_CACHE)
+    return stats
+
+# Clear the cache when the database was changed through another connection.
+# Returns the sequence number the entries the connection of this thread may
+# use are above.
+def check_data_version():
+    # (a column snapshot does not change)
+    if COLUMN_SNAPSHOT is not None:
+        return 0
+    versions = getattr(THREAD_CONNECTIONS, "data_versions", None)
+    if versions is None:
+        versions = THREAD_CONNECTIONS.data_versions = {}
+    conn = get_connection()
+    version = conn.execute("PRAGMA data_version").fetchone()[0]
+    seen = versions.get(DBNAME)
+    if seen is None or seen[0] is not conn:
+        # a connection new to the cache
+        seen = (conn, version, next(RESULT_CACHE_SEQUENCE))
+    elif seen[1] != version:
+        invalidate_result_cache()
+        seen = (conn, version, seen[2])
+    versions[DBNAME] = seen
+    return seen[2]
+
+# cached results of a key stored after the since sequence number, or None
+def cache_lookup(key, since=0):
+    now = time.monotonic()
+    with RESULT_CACHE_LOCK:
+        entry = RESULT_CACHE.get(key)
+        if entry is not None:
+            (expires, sequence, results) = entry
+            if (expires is None or expires > now) and sequence > since:
+                RESULT_CACHE.move_to_end(key)
+                RESULT_CACHE_STATS["hits"] += 1
+                return list(results)
+            del RESULT_CACHE[key]
+        RESULT_CACHE_STATS["misses"] += 1
+    return None
+
+def cache_store(key, results):
+    expires = None if RESULT_CACHE_TTL is None else time.monotonic() + RESULT_CACHE_TTL
+    with RESULT_CACHE_LOCK:
+        RESULT_CACHE[key] = (expires, next(RESULT_CACHE_SEQUENCE), tuple(results))
+        while len(RESULT_CACHE) > RESULT_CACHE_SIZE:
+            RESULT_CACHE.popitem(last=False)
+            RESULT_CACHE_STATS["evictions"] += 1
+
+def cached_query(command_dic):
+    key = command_key(command_dic)
+    since = check_data_version()
+
+    results = cache_lookup(key, since)
+    if results is None:
+        results = run_query(command_dic)
+        cache_store(key, results)
+    else:
+        trace = current_trace()
+        if trace is not None:
+            trace.cached = True
     return results
 
+# --- instrumentation ---
+# Commands run through execute_command() / process_command() are traced:
+# the time spent in each stage (parse, connect, execute, fetch, format,
+# write), the rows returned, and the SQL and parameters of every statement
+# that ran. When INSTRUMENT is off, commands are not traced at all.
+# A command slower than SLOW_QUERY_THRESHOLD seconds (None: never) is logged
+# to SLOW_QUERY_LOG as one JSON line, with the EXPLAIN QUERY PLAN of each
+# statement.
+# query_stats() returns counts, rows and a latency histogram per query type;
+# the RECENT_TRACES_SIZE last traces are kept in RECENT_TRACES.
+INSTRUMENT = True
+SLOW_QUERY_THRESHOLD = 0.5
+SLOW_QUERY_LOG = "proj3_choc.slow_queries"
+RECENT_TRACES_SIZE = 100
+
+# upper bounds of the histogram buckets, in milliseconds
+LATENCY_BUCKETS = [1, 5, 10, 50, 100, 500, 1000, float("inf")]
+
+QUERY_STATS = {}
+QUERY_STATS_LOCK = threading.Lock()
+RECENT_TRACES = collections.deque(maxlen=RECENT_TRACES_SIZE)
+THREAD_TRACE = threading.local()
+
+class CommandTrace:
+
+    def __init__(self, command):
+        self.command = command
+        self.query_type = None
+        self.stages = collections.OrderedDict()
+        self.rows = None
+        self.cached = False
+        # (statement, params) of every statement the command ran, in order
+        self.statements = []
+        self.start = time.perf_counter()
+        self.seconds = None
+
+    # time spent in the block, added to the stage
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    # the plan steps of each statement
+    def plans(self):
+        return [[detail for (_, _, detail) in query_plan(statement, params)] for (statement, params) in self.statements]
+
+    def as_dict(self):
+        return {
+            "command": self.command,
+            "query_type": self.query_type,
+            "seconds": self.seconds,
+            "stages": dict(self.stages),
+            "rows": self.rows,
+            "cached": self.cached,
+            "statements": [{"sql": statement, "params": params} for (statement, params) in self.statements],
+        }
+
+# a no-op stage, for code running outside of a traced command
+@contextlib.contextmanager
+def untraced():
+    yield
+
+def current_trace():
+    return getattr(THREAD_TRACE, "trace", None)
+
+def trace_stage(name):
+    trace = current_trace()
+    if trace is None:
+        return untraced()
+    return trace.stage(name)
+
+def start_trace(command):
+    if not INSTRUMENT:
+        return None
+    trace = CommandTrace(command)
+    THREAD_TRACE.trace = trace
+    return trace
+
+def finish_trace(trace):
+    if trace is None:
+        return
+    THREAD_TRACE.trace = None
+    trace.seconds = time.perf_counter() - trace.start
+    RECENT_TRACES.append(trace)
+    if trace.query_type is None:
+        return
+
+    milliseconds = trace.seconds * 1000
+    bucket = 0
+    while milliseconds > LATENCY_BUCKETS[bucket]:
+        bucket += 1
+    with QUERY_STATS_LOCK:
+        stats = QUERY_STATS.get(trace.query_type)
+        if stats is None:
+            stats = QUERY_STATS[trace.query_type] = {
+                "count": 0, "cached": 0, "rows": 0, "seconds": 0.0, "max_seconds": 0.0,
+                "histogram": [0] * len(LATENCY_BUCKETS),
+            }
+        stats["count"] += 1
+        stats["cached"] += trace.cached
+        stats["rows"] += trace.rows or 0
+        stats["seconds"] += trace.seconds
+        stats["max_seconds"] = max(stats["max_seconds"], trace.seconds)
+        stats["histogram"][bucket] += 1
+
+    if SLOW_QUERY_THRESHOLD is not None and trace.seconds > SLOW_QUERY_THRESHOLD:
+        record = trace.as_dict()
+        record["event"] = "slow_query"
+        record["plans"] = trace.plans()
+        import json
+        import logging
+        logging.getLogger(SLOW_QUERY_LOG).warning(json.dumps(record))
+
+def query_stats():
+    with QUERY_STATS_LOCK:
+        stats = {}
+        for (query_type, entry) in QUERY_STATS.items():
+            stats[query_type] = dict(entry, histogram=list(zip(LATENCY_BUCKETS, entry["histogram"])))
+            stats[query_type]["mean_seconds"] = entry["seconds"] / entry["count"]
+        return stats
+
+def reset_query_stats():
+    with QUERY_STATS_LOCK:
+        QUERY_STATS.clear()
+    RECENT_TRACES.clear()
+
 # functions for formatting the output
 def str_output(string_output):
     if len(string_output) > 12:
@@ -410,166 +2505,701 @@ def digits_output(rating_float):
     formatted_output = "{0:.1f}".format(rating_float, 1)
     return formatted_output
 
-# Implement logic to process user commands
-def process_command(command):
-
-    command_lst = command.lower().split()
-
-    # def bars_query(specification="", keyword="", criteria="ratings", sorting_order="top", limit="10"):
-    command_dic = {
-        "specification":"",
-        "keyword":"",
-        "criteria":"ratings",
-        "sorting_order":"top",
-        "limit":"10",
-        "sellers_or_sources":"sellers"
-    }
-
-    # lists for checing the commend
-    query_type_lst = ["bars", "companies", "countries", "regions"]
-    sorting_criteria_lst = ["cocoa", "ratings", "bars_sold"]
-    sorting_order_lst = ["top", "bottom"]
-    specification_lst = ["sellcountry", "sourcecountry", "sellregion", "sourceregion", "country", "region", "sellers", "sources"]
-    sellers_or_sources_lst = ["sellers", "sources"]
-
-    if_valid = True
-
-    # check user's command line
-    for command in command_lst:
-        # query type
-        if command in query_type_lst:
-            command_dic["query_type"] = command
-        # sorting criteria
-        elif command in sorting_criteria_lst:
-            command_dic["criteria"] = command
-        # for countries and regions: sellers / sources
-        elif command in sellers_or_sources_lst:
-            command_dic["sellers_or_sources"] = command
-        # number of matches & specifications
-        elif "=" in command:
-            lst = command.split("=")
-            for ele in lst:
-                # top/bottom & limit
-                if ele in sorting_order_lst:
-                    command_dic["sorting_order"] = lst[0]
-                    command_dic["limit"] = lst[1]
-                # specifications
-                elif ele in specification_lst:
-                    if lst[0] == "sellcountry":
-                        command_dic["specification"] = "c1.Alpha2"
-                    elif lst[0] == "sourcecountry":
-                        command_dic["specification"] = "c2.Alpha2"
-                    elif lst[0] == "sellregion":
-                        command_dic["specification"] = "c1.Region"
-                    elif lst[0] == "sourceregion":
-                        command_dic["specification"] = "c2.Region"
-                    elif lst[0] == "country":
-                        command_dic["specification"] = "Alpha2"
-                    else:
-                        command_dic["specification"] = lst[0].title()
-                    command_dic["keyword"] = lst[1].title()
-        else:
-            if_valid = False
-
-    if if_valid == False:
-        print("Command not recognized: ", command)
-
-
-    results = []
-
-    if command_dic["query_type"] == "bars" and if_valid == True:
-        # execute bars_query
-        results = bars_query(command_dic["specification"], command_dic["keyword"], command_dic["criteria"], command_dic["sorting_order"], command_dic["limit"])
-
-        # output
+# --- results ---
+# A QueryResult is the list of rows of a command, plus what is needed to
+# format it. Nothing is formatted until render() is called with one of the
+# RENDERERS: "text" (the fixed-width listing of the prompt), "csv", "json",
+# "dicts", "records" (NumPy record array) or "arrow" (pyarrow Table).
+# The rows of a report hold every metric (SUMMARY_METRICS) of a group.
+RESULT_COLUMNS = {
+    "bars": ["SpecificBeanBarName", "Company", "CompanyLocation", "Rating", "CocoaPercent", "BroadBeanOrigin"],
+    "companies": ["Company", "CompanyLocation"],
+    "countries": ["Country", "Region"],
+    "regions": ["Region"],
+}
+
+class QueryResult(list):
+
+    def __init__(self, rows, query_type, criteria, report=False):
+        list.__init__(self, rows)
+        self.query_type = query_type
+        self.criteria = criteria
+        self.report = report
+
+    @property
+    def columns(self):
+        columns = list(RESULT_COLUMNS[self.query_type])
+        if self.report:
+            columns.extend(SUMMARY_COLUMNS.values())
+        elif self.query_type != "bars":
+            columns.append(SUMMARY_COLUMNS[self.criteria])
+        return columns
+
+    def render(self, output_format="text"):
+        renderer = RENDERERS.get(output_format)
+        if renderer is None:
+            raise ValueError("Unknown output format: {}".format(output_format))
+        return renderer(self)
+
+def aggregate_output(criteria, agg):
+    if criteria in ("ratings", "min_rating", "max_rating"):
+        return digits_output(agg)
+    elif criteria in ("cocoa", "min_cocoa", "max_cocoa"):
+        return percent_output(agg)
+    elif criteria in ("stddev_rating", "stddev_cocoa"):
+        return "{0:.2f}".format(agg)
+    return agg
+
+# the columns of a report line, per metric
+REPORT_FORMATS = {
+    "ratings": "{0:>6.2f}",
+    "cocoa": "{0:>6.1f}%",
+    "bars_sold": "{0:>5}",
+    "min_rating": "{0:>6.2f}",
+    "max_rating": "{0:>6.2f}",
+    "stddev_rating": "{0:>6.2f}",
+    "min_cocoa": "{0:>6.1f}%",
+    "max_cocoa": "{0:>6.1f}%",
+    "stddev_cocoa": "{0:>6.2f}",
+}
+
+def report_output(metrics):
+    return " ".join(REPORT_FORMATS[criteria].format(value) for (criteria, value) in zip(SUMMARY_METRICS, metrics))
+
+# the fixed-width lines of the prompt listing, for any iterable of rows
+def text_lines(query_type, criteria, rows, report=False):
+    if report:
+        # the group's label (as in the listing), then every metric
+        width = 15 if query_type == "regions" else 20
+        labels = len(RESULT_COLUMNS[query_type])
+        for row in rows:
+            label = " ".join("{0:{1}}".format(str_output(value), width) for value in row[:labels])
+            yield "{} {}\n".format(label, report_output(row[labels:]))
+    elif query_type == "bars":
         # 'SpecificBeanBarName','Company', 'CompanyLocation', 'Rating', 'CocoaPercent', 'BroadBeanOrigin'
-        template = "{0:20} {1:20} {2:20} {3:20} {4:20} {5:20}"
-        for row in results:
-            (sbbn, c, cl, r, cp, bbo) = row
-            print(template.format(str_output(sbbn), str_output(c), str_output(cl), digits_output(r), percent_output(cp), str_output(bbo)))
-
-        return results
-
-    elif command_dic["query_type"] == "companies" and if_valid == True:
-        # execute companies_query
-        results = companies_query(command_dic["specification"], command_dic["keyword"], command_dic["criteria"], command_dic["sorting_order"], command_dic["limit"])
-
-        # output
-        # 'Company', 'CompanyLocation', <agg> (i.e., average rating or cocoa percent, or number of bars sold)
-        template = "{0:20} {1:20} {2:20}"
-        for row in results:
-            (c, cl, agg) = row
-
-            if command_dic["criteria"] == "ratings":
-                agg = digits_output(agg)
-            elif command_dic["criteria"] == "cocoa":
-                agg = percent_output(agg)
-
-            print(template.format(str_output(c), str_output(cl), agg))
-
-        return results
-
-    elif command_dic["query_type"] == "countries" and if_valid == True:
-        # execute countries_query
-        results = countries_query(command_dic["specification"], command_dic["keyword"], command_dic["criteria"], command_dic["sorting_order"], command_dic["limit"], command_dic["sellers_or_sources"])
-
-        # output
-        # 'Country', 'Region', <agg> (i.e., average rating or cocoa percent, or number of bars sold)
-        template = "{0:20} {1:20} {2:20}"
-        for row in results:
-            (c, r, agg) = row
-
-            if command_dic["criteria"] == "ratings":
-                agg = digits_output(agg)
-            elif command_dic["criteria"] == "cocoa":
-                agg = percent_output(agg)
-
-            print(template.format(str_output(c), str_output(r), agg))
+        template = "{0:20} {1:20} {2:20} {3:20} {4:20} {5:20}\n"
+        for (sbbn, c, cl, r, cp, bbo) in rows:
+            yield template.format(str_output(sbbn), str_output(c), str_output(cl), digits_output(r), percent_output(cp), str_output(bbo))
+    elif query_type in ("companies", "countries"):
+        # 'Company', 'CompanyLocation' / 'Country', 'Region', <agg> (i.e., average rating or cocoa percent, or number of bars sold)
+        template = "{0:20} {1:20} {2:20}\n"
+        for (name, place, agg) in rows:
+            yield template.format(str_output(name), str_output(place), aggregate_output(criteria, agg))
+    elif query_type == "regions":
+        # 'Region', <agg> (i.e., average rating or cocoa percent, or number of bars sold)
+        template = "{0:15} {1:15}\n"
+        for (r, agg) in rows:
+            yield template.format(str_output(r), aggregate_output(criteria, agg))
+
+def render_text(result):
+    return "".join(text_lines(result.query_type, result.criteria, result, result.report))
+
+def render_csv(result):
+    import csv
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(result.columns)
+    writer.writerows(result)
+    return out.getvalue()
+
+def render_dicts(result):
+    columns = result.columns
+    return [dict(zip(columns, row)) for row in result]
+
+def render_json(result):
+    import json
+    return json.dumps(render_dicts(result))
+
+def render_records(result):
+    numpy = load_numpy()
+    if numpy is None:
+        raise ImportError("the records output format needs NumPy")
+    if len(result) == 0:
+        return numpy.recarray((0,), dtype=[(name, object) for name in result.columns])
+    return numpy.rec.fromrecords(list(result), names=result.columns)
+
+def render_arrow(result):
+    import pyarrow
+    return pyarrow.Table.from_pylist(render_dicts(result))
+
+RENDERERS = {
+    "text": render_text,
+    "csv": render_csv,
+    "json": render_json,
+    "dicts": render_dicts,
+    "records": render_records,
+    "arrow": render_arrow,
+}
+
+# A parsed command. QuerySpecs are hashable, so they key the result cache
+# as they are; fields can also be read by name (spec["criteria"]).
+QUERY_SPEC_FIELDS = ["query_type", "specification", "keyword", "criteria", "sorting_order", "limit", "sellers_or_sources", "report", "search", "filters", "ranges"]
+
+class QuerySpec(collections.namedtuple("QuerySpec", QUERY_SPEC_FIELDS)):
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
+
+# filters: the country/region filters after the first (specification,
+# keyword) one; ranges: (column, low, high) of each range
+DEFAULT_SPEC = QuerySpec(None, "", "", "ratings", "top", 10, "sellers", False, "", (), ())
+
+# The command grammar, compiled once into dispatch tables:
+#   COMMAND_WORDS: word -> (field, value)
+#   COMMAND_OPTIONS: <option>=<value> -> (field of the value, value
+#       transform, field of the option or None, what the option sets it
+#       to); a value of a tuple field is added to the tuple
+QUERY_TYPES = ["bars", "companies", "countries", "regions"]
+SORTING_CRITERIA = ["cocoa", "ratings", "bars_sold", "min_rating", "max_rating", "stddev_rating", "min_cocoa", "max_cocoa", "stddev_cocoa"]
+# criteria bars can be sorted on; the others are metrics of groups
+BARS_CRITERIA = ["cocoa", "ratings", "bars_sold"]
+SORTING_ORDERS = ["top", "bottom"]
+SELLERS_OR_SOURCES = ["sellers", "sources"]
+SPECIFICATION_OPTIONS = {
+    "sellcountry": "c1.Alpha2",
+    "sourcecountry": "c2.Alpha2",
+    "sellregion": "c1.Region",
+    "sourceregion": "c2.Region",
+    "country": "Alpha2",
+    "region": "Region",
+}
+
+# <low>..<high>, <low>.., ..<high> or <value> of a range option, as
+# (column, low, high)
+def range_bounds(column, number, value):
+    (low, dots, high) = value.partition("..")
+    if not dots:
+        high = low
+    if low == "" and high == "":
+        raise ValueError("Not a range: {}".format(value))
+    return (column, number(low) if low != "" else None, number(high) if high != "" else None)
+
+# the number types of the range columns (ReviewDate is a text column)
+RANGE_NUMBERS = {
+    "CocoaPercent": lambda value: float(value.rstrip("%")),
+    "Rating": float,
+    "ReviewDate": lambda value: str(int(value)),
+}
+
+def compile_grammar():
+    words = {}
+    for (field, values) in [("query_type", QUERY_TYPES), ("criteria", SORTING_CRITERIA), ("sellers_or_sources", SELLERS_OR_SOURCES)]:
+        for value in values:
+            words[value] = (field, value)
+    words["report"] = ("report", True)
+
+    options = {}
+    for sorting_order in SORTING_ORDERS:
+        options[sorting_order] = ("limit", int, "sorting_order", sorting_order)
+    for (option, specification) in SPECIFICATION_OPTIONS.items():
+        options[option] = ("keyword", str.title, "specification", specification)
+    options["search"] = ("search", search_term, None, None)
+    for (option, column) in RANGE_COLUMNS.items():
+        options[option] = ("ranges", functools.partial(range_bounds, column, RANGE_NUMBERS[column]), None, None)
+    return (words, options)
+
+(COMMAND_WORDS, COMMAND_OPTIONS) = compile_grammar()
+
+# Parse a command into a QuerySpec; None (after reporting it, unless
+# report_errors is False) when it is not a valid command.
+# <option>=<value> words with an unknown option are ignored.
+def parse_command(command, report_errors=True):
+    spec = DEFAULT_SPEC._asdict()
+    if_valid = True
 
-        return results
+    for word in command.lower().split():
+        entry = COMMAND_WORDS.get(word)
+        if entry is not None:
+            (field, value) = entry
+            spec[field] = value
+            continue
 
-    elif command_dic["query_type"] == "regions" and if_valid == True:
-        # execute regions_query
-        results = regions_query(command_dic["specification"], command_dic["keyword"], command_dic["criteria"], command_dic["sorting_order"], command_dic["limit"], command_dic["sellers_or_sources"])
+        parts = word.split("=")
+        if len(parts) < 2:
+            if_valid = False
+            break
+        option = COMMAND_OPTIONS.get(parts[0])
+        if option is not None:
+            (field, transform, option_field, option_value) = option
+            try:
+                value = transform(parts[1])
+            except ValueError:
+                if_valid = False
+                break
+            if option_field == "specification" and spec["specification"] != "":
+                # a further country or region filter
+                spec["filters"] += ((option_value, value),)
+            elif isinstance(spec[field], tuple):
+                spec[field] += (value,)
+            else:
+                spec[field] = value
+                if option_field is not None:
+                    spec[option_field] = option_value
+
+    query_type = spec["query_type"]
+    # a blank command is not reported
+    if query_type is None and if_valid and command.strip() == "":
+        return None
+    # a report, and the metrics of groups, are not for bars; search= is only
+    # for bars and companies (not filtered on their bean origin)
+    if query_type == "bars" and (spec["report"] or spec["criteria"] not in BARS_CRITERIA):
+        if_valid = False
+    if spec["search"] != "" and (query_type not in ("bars", "companies") or (query_type == "companies" and spec["specification"].startswith("c2."))):
+        if_valid = False
+    # several filters, and ranges, are only for bars (without search=), and
+    # are listed in one order whatever the order of the command
+    if (spec["filters"] or spec["ranges"]) and (query_type != "bars" or spec["search"] != ""):
+        if_valid = False
+    if spec["filters"]:
+        filters = sorted(((spec["specification"], spec["keyword"]),) + spec["filters"])
+        ((spec["specification"], spec["keyword"]), spec["filters"]) = (filters[0], tuple(filters[1:]))
+    spec["ranges"] = tuple(sorted(spec["ranges"], key=lambda bounds: bounds[0]))
+    if not if_valid or query_type is None:
+        if report_errors:
+            print("Command not recognized: ", command)
+        return None
+
+    return QuerySpec(**spec)
+
+# SQL template and its parameters answering a parsed command
+def command_statement(command_dic):
+    if command_dic["query_type"] == "bars" and (command_dic["filters"] or command_dic["ranges"]):
+        filters = command_dic["filters"]
+        if command_dic["specification"] != "":
+            filters = ((command_dic["specification"], command_dic["keyword"]),) + filters
+        (statement, params) = bars_filter(filters, command_dic["ranges"], command_dic["criteria"], command_dic["sorting_order"], command_dic["limit"])
+    elif command_dic["query_type"] == "bars":
+        statement = bars_statement(command_dic["specification"], command_dic["criteria"], command_dic["sorting_order"], search=search_shape(command_dic["search"]))
+        params = bars_params(command_dic["specification"], command_dic["keyword"], command_dic["limit"], command_dic["search"])
+    elif command_dic["query_type"] == "companies":
+        statement = companies_statement(command_dic["specification"], command_dic["criteria"], command_dic["sorting_order"], command_dic["report"], search_shape(command_dic["search"]))
+        params = companies_params(command_dic["specification"], command_dic["keyword"], command_dic["limit"], command_dic["search"])
+    elif command_dic["query_type"] == "countries":
+        statement = countries_statement(command_dic["specification"], command_dic["criteria"], command_dic["sorting_order"], command_dic["sellers_or_sources"], command_dic["report"])
+        params = countries_params(command_dic["specification"], command_dic["keyword"], command_dic["limit"])
+    elif command_dic["query_type"] == "regions":
+        statement = regions_statement(command_dic["specification"], command_dic["criteria"], command_dic["sorting_order"], command_dic["sellers_or_sources"], command_dic["report"])
+        params = regions_params(command_dic["specification"], command_dic["keyword"], command_dic["limit"])
+    return (statement, params)
+
+# Run a command and return its QueryResult, without formatting anything.
+# Returns None when the command is not valid. A command is traced from
+# parsing to the end of process_command() when it is given a trace, and
+# on its own otherwise.
+def execute_command(command, trace=None):
+    own_trace = trace is None
+    if own_trace:
+        trace = start_trace(command)
+    try:
+        with trace_stage("parse"):
+            command_dic = parse_command(command)
+        if command_dic is None:
+            return None
+
+        # execute the query (through the result cache)
+        results = cached_query(command_dic)
+        if trace is not None:
+            trace.query_type = command_dic["query_type"]
+            trace.rows = len(results)
+        return QueryResult(results, command_dic["query_type"], command_dic["criteria"], command_dic["report"])
+    finally:
+        if own_trace:
+            finish_trace(trace)
 
-        # output
-        # 'Region', <agg> (i.e., average rating or cocoa percent, or number of bars sold)
-        template = "{0:15} {1:15}"
-        for row in results:
-            (r, agg) = row
+def process_command(command):
+    trace = start_trace(command)
+    try:
+        result = execute_command(command, trace)
+        if result is None:
+            return None
+
+        # output, in one write for the whole result set
+        with trace_stage("format"):
+            text = result.render("text")
+        with trace_stage("write"):
+            sys.stdout.write(text)
+        return result
+    finally:
+        finish_trace(trace)
+
+# Print the listing of a command while its rows are fetched, one write per
+# fetch_size rows, without caching or keeping the result set; for commands
+# whose limit is too large to hold. Always reads SQLite. Returns the number
+# of rows, or None when the command is not valid.
+STREAM_LIMIT = 10000
+
+def stream_command(command, out=None, fetch_size=FETCH_SIZE):
+    command_dic = parse_command(command)
+    if command_dic is None:
+        return None
+    if out is None:
+        out = sys.stdout
+
+    (statement, params) = command_statement(command_dic)
+    rows = iter_query(statement, params, fetch_size)
+    count = 0
+    chunk = []
+    for line in text_lines(command_dic["query_type"], command_dic["criteria"], rows, command_dic["report"]):
+        chunk.append(line)
+        if len(chunk) == fetch_size:
+            out.write("".join(chunk))
+            count += len(chunk)
+            chunk = []
+    out.write("".join(chunk))
+    return count + len(chunk)
+
+# --- batch mode ---
+# Commands are read and answered BATCH_CHUNK_SIZE at a time. Within a chunk,
+# commands that differ only in their limit share one query, run with the
+# largest limit and cut down for the others (results are fully ordered, so
+# a smaller limit is a prefix of a larger one).
+BATCH_CHUNK_SIZE = 10000
+BATCH_FORMATS = ["jsonl", "csv"]
+
+# default size of the process pool (see command_pool) and the number of
+# queries handed to a worker at a time
+POOL_WORKERS = os.cpu_count() or 1
+POOL_CHUNKSIZE = 16
+
+# The query a command is grouped under, and its limit. Raises ValueError
+# for a command that is not recognized.
+def batch_group(command):
+    command_dic = parse_command(command, report_errors=False)
+    if command_dic is None:
+        raise ValueError("Command not recognized: {}".format(command))
+    return (command_key(command_dic._replace(limit=None)), command_dic, command_dic.limit)
+
+# Yields (command, results, error) for every command, in input order.
+# Blank lines and lines starting with # are skipped. With an executor (see
+# command_pool) the queries of each chunk run in its worker processes.
+def iter_command_results(commands, chunk_size=BATCH_CHUNK_SIZE, executor=None, pool_chunksize=POOL_CHUNKSIZE):
+    chunk = []
+    for command in commands:
+        command = command.strip()
+        if command == "" or command.startswith("#"):
+            continue
+        chunk.append(command)
+        if len(chunk) >= chunk_size:
+            yield from run_command_chunk(chunk, executor, pool_chunksize)
+            chunk = []
+    if chunk:
+        yield from run_command_chunk(chunk, executor, pool_chunksize)
+
+def run_command_chunk(chunk, executor=None, pool_chunksize=POOL_CHUNKSIZE):
+    parsed = []
+    groups = {}
+    for command in chunk:
+        try:
+            (group, command_dic, limit) = batch_group(command)
+        except ValueError as error:
+            parsed.append((command, None, None, str(error)))
+            continue
+        parsed.append((command, group, limit, None))
 
-            if command_dic["criteria"] == "ratings":
-                agg = digits_output(agg)
-            elif command_dic["criteria"] == "cocoa":
-                agg = percent_output(agg)
+        # the largest limit of the group; a negative limit means no limit
+        widest = groups.get(group)
+        if widest is None or (widest[1] >= 0 and (limit < 0 or limit > widest[1])):
+            groups[group] = (command_dic, limit)
 
-            print(template.format(str_output(r), agg))
+    group_results = {}
+    if executor is None:
+        for (group, (command_dic, limit)) in groups.items():
+            group_results[group] = guarded_query(command_dic, cached_query)
+    else:
+        # answer what the cache holds, fan the rest out to the workers
+        since = check_data_version()
+        pending = []
+        for (group, (command_dic, limit)) in groups.items():
+            results = cache_lookup(command_key(command_dic), since)
+            if results is None:
+                pending.append((group, command_dic))
+            else:
+                group_results[group] = (results, None)
+        answers = executor.map(worker_query, [command_dic for (group, command_dic) in pending], chunksize=pool_chunksize)
+        for ((group, command_dic), (results, error)) in zip(pending, answers):
+            if error is None:
+                cache_store(command_key(command_dic), results)
+            group_results[group] = (results, error)
+
+    for (command, group, limit, error) in parsed:
+        if error is not None:
+            yield (command, None, error)
+            continue
+        (results, error) = group_results[group]
+        if error is not None:
+            yield (command, None, error)
+        elif limit < 0:
+            yield (command, results, None)
+        else:
+            yield (command, results[:limit], None)
 
-        return results
+# (results, error) of a query; errors are returned instead of raised
+def guarded_query(command_dic, query=run_query):
+    try:
+        return (query(command_dic), None)
+    except (sqlite3.Error, ValueError, KeyError) as error:
+        return (None, str(error))
+
+# --- process pool ---
+# Worker processes answer the queries of a batch in parallel. Each worker
+# opens its own read-only connection (or builds its own column store) on
+# first use; results come back in submission order.
+def init_worker(dbname, backend, column_snapshot=None):
+    global DBNAME, QUERY_BACKEND, COLUMN_SNAPSHOT, THREAD_CONNECTIONS, POOLED_CONNECTIONS, POOL_LOCK
+    global RESULT_CACHE_LOCK, COLUMN_STORE_LOCK, QUERY_STATS_LOCK, THREAD_TRACE
+    DBNAME = dbname
+    QUERY_BACKEND = backend
+    COLUMN_SNAPSHOT = column_snapshot
+
+    # a forked worker must not reuse the connections or locks of its parent
+    THREAD_CONNECTIONS = threading.local()
+    POOLED_CONNECTIONS = []
+    POOL_LOCK = threading.Lock()
+    RESULT_CACHE_LOCK = threading.Lock()
+    COLUMN_STORE_LOCK = threading.Lock()
+    QUERY_STATS_LOCK = threading.Lock()
+    THREAD_TRACE = threading.local()
+
+def worker_query(command_dic):
+    return guarded_query(command_dic)
+
+def command_pool(workers=None):
+    import concurrent.futures
+    if workers is None:
+        workers = POOL_WORKERS
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers, initializer=init_worker, initargs=(DBNAME, QUERY_BACKEND, COLUMN_SNAPSHOT))
+
+# Run a batch of commands and write their results to out:
+#   jsonl: one {"command", "rows"} (or {"command", "error"}) object per command
+#   csv:   one line per result row: the command, then the row's columns;
+#          errors are reported on stderr
+# workers > 1 runs the queries on a process pool of that size, handing each
+# worker pool_chunksize queries at a time.
+# Returns the number of commands answered.
+def process_commands(commands, out=None, output_format="jsonl", chunk_size=BATCH_CHUNK_SIZE, workers=1, pool_chunksize=POOL_CHUNKSIZE):
+    if output_format not in BATCH_FORMATS:
+        raise ValueError("Unknown output format: {}".format(output_format))
+    if out is None:
+        out = sys.stdout
+
+    if workers is not None and workers <= 1:
+        return write_command_results(iter_command_results(commands, chunk_size), out, output_format)
+    with command_pool(workers) as executor:
+        return write_command_results(iter_command_results(commands, chunk_size, executor, pool_chunksize), out, output_format)
+
+def write_command_results(command_results, out, output_format):
+    import csv
+    import json
+    count = 0
+    if output_format == "csv":
+        writer = csv.writer(out)
+    for (command, results, error) in command_results:
+        count += 1
+        if output_format == "jsonl":
+            if error is None:
+                record = {"command": command, "rows": [list(row) for row in results]}
+            else:
+                record = {"command": command, "error": error}
+            out.write(json.dumps(record) + "\n")
+        elif error is None:
+            writer.writerows([command] + list(row) for row in results)
+        else:
+            print(error, file=sys.stderr)
+    out.flush()
+    return count
+
+# --- asyncio service ---
+# QueryService answers commands from asyncio code. Queries run on a bounded
+# thread pool (each thread with its own pooled connection, closed with the
+# service), at most max_in_flight at a time; further callers wait for a
+# slot. Concurrent requests for the same parsed command share one execution.
+ASYNC_WORKERS = 4
+ASYNC_MAX_IN_FLIGHT = 32
+
+class QueryService:
+
+    def __init__(self, workers=ASYNC_WORKERS, max_in_flight=ASYNC_MAX_IN_FLIGHT):
+        import concurrent.futures
+        self.threads = set()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="choc-query", initializer=self.add_thread)
+        self.max_in_flight = max_in_flight
+        self.loop = None
+        self.slots = None
+        self.pending = {}
+        self.stats = {"executed": 0, "coalesced": 0}
+
+    # semaphores and futures belong to one event loop
+    def bind_loop(self):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            self.loop = loop
+            self.slots = asyncio.Semaphore(self.max_in_flight)
+            self.pending = {}
+
+    async def run_command(self, command):
+        command_dic = parse_command(command, report_errors=False)
+        if command_dic is None:
+            raise ValueError("Command not recognized: {}".format(command))
+        return await self.run_query(command_dic)
+
+    # The shared execution runs in its own task, which every caller (the
+    # first one included) awaits through a shield: a cancelled caller stops
+    # waiting, but the execution goes on for the others.
+    async def run_query(self, command_dic):
+        import asyncio
+        self.bind_loop()
+        key = command_key(command_dic)
+
+        task = self.pending.get(key)
+        if task is None:
+            task = self.pending[key] = asyncio.ensure_future(self.execute(key, command_dic))
+            # the callers (if any) get the error; nobody has to retrieve it
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        else:
+            self.stats["coalesced"] += 1
+        return list(await asyncio.shield(task))
 
+    async def execute(self, key, command_dic):
+        try:
+            async with self.slots:
+                self.stats["executed"] += 1
+                return await self.loop.run_in_executor(self.executor, cached_query, command_dic)
+        finally:
+            del self.pending[key]
+
+    def add_thread(self):
+        self.threads.add(threading.current_thread())
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        close_connections(self.threads)
+
+QUERY_SERVICE = None
+
+def query_service():
+    global QUERY_SERVICE
+    if QUERY_SERVICE is None:
+        QUERY_SERVICE = QueryService()
+    return QUERY_SERVICE
+
+async def run_command(command):
+    return await query_service().run_command(command)
+
+# --- startup ---
+# With fast_start, a choc.db of the current SCHEMA_VERSION is used as a
+# prebuilt snapshot: it is opened read-only (the connection queries then
+# reuse) without looking at the source files, so neither the CSV and JSON
+# loaders nor the manifest hashing are imported or run. It is only built
+# when missing or of another version. Otherwise build_db() brings it up to
+# date with the sources first.
+# STARTUP_STATS records how the database was readied and how long the start
+# took since this module was imported; a fast start slower than
+# STARTUP_BUDGET seconds is logged to STARTUP_LOG.
+STARTUP_BUDGET = 0.25
+STARTUP_LOG = "proj3_choc.startup"
+STARTUP_STATS = {}
+
+def open_snapshot():
+    if not os.path.exists(DBNAME):
+        return False
+    try:
+        version = get_connection().execute("PRAGMA user_version").fetchone()[0]
+    except sqlite3.Error:
+        return False
+    return version == SCHEMA_VERSION
+
+# Returns "column_snapshot", "snapshot" or what build_db() returned.
+def start(fast_start=False, column_snapshot=None):
+    build_start = time.perf_counter()
+    if column_snapshot is not None:
+        use_column_snapshot(column_snapshot)
+        mode = "column_snapshot"
+    elif fast_start and open_snapshot():
+        mode = "snapshot"
+    else:
+        mode = build_db()
+    ready = time.perf_counter()
+
+    STARTUP_STATS.update({
+        "mode": mode,
+        "import_seconds": build_start - IMPORT_TIME,
+        "build_seconds": ready - build_start,
+        "seconds": ready - IMPORT_TIME,
+    })
+    if mode in ("snapshot", "column_snapshot") and STARTUP_STATS["seconds"] > STARTUP_BUDGET:
+        import logging
+        logging.getLogger(STARTUP_LOG).warning("fast start took %.3fs (budget %.3fs)", STARTUP_STATS["seconds"], STARTUP_BUDGET)
+    return mode
+
+# read on the first 'help'
+@functools.lru_cache(maxsize=None)
 def load_help_text():
     with open('help.txt') as f:
         return f.read()
 
 def interactive_prompt():
-    help_text = load_help_text()
     response = ''
     while response != 'exit':
         response = input('Enter a command: ')
 
+        if response == 'help':
+            print(load_help_text())
+            continue
+        elif response == 'exit':
+            continue
+
         try:
-            results = process_command(response)
+            # listings larger than STREAM_LIMIT rows are printed as they are fetched
+            command_dic = parse_command(response, report_errors=False)
+            if command_dic is not None and limit_param(command_dic["limit"]) > STREAM_LIMIT:
+                stream_command(response)
+            else:
+                results = process_command(response)
         except:
             continue
 
-        if response == 'help':
-            print(help_text)
-            continue
+def parse_arguments(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Query the chocolate bar ratings database.")
+    parser.add_argument("--batch", metavar="FILE",
+                        help="run the commands in FILE ('-' for stdin) instead of prompting")
+    parser.add_argument("--format", choices=BATCH_FORMATS, default="jsonl",
+                        help="output format of --batch (default: jsonl)")
+    parser.add_argument("--backend", choices=["sqlite", "columnar"], default=QUERY_BACKEND,
+                        help="query backend (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes for --batch (default: 1, no pool)")
+    parser.add_argument("--chunk-size", type=int, default=POOL_CHUNKSIZE,
+                        help="queries handed to a worker at a time (default: %(default)s)")
+    parser.add_argument("--slow-query-threshold", type=float, default=SLOW_QUERY_THRESHOLD,
+                        help="log commands slower than this many seconds (default: %(default)s)")
+    parser.add_argument("--fast-start", action="store_true",
+                        help="use a choc.db of the current schema version as it is, without checking the source files")
+    parser.add_argument("--column-snapshot", metavar="FILE",
+                        help="answer commands from the column snapshot FILE (memory-mapped) instead of choc.db")
+    parser.add_argument("--export-column-snapshot", metavar="FILE",
+                        help="write a column snapshot of choc.db to FILE and exit")
+    return parser.parse_args(argv)
 
 # Make sure nothing runs or prints out when this file is run as a module
 if __name__=="__main__":
-    init_db_tables()
-    read_csv_file_and_insert_data(BARSCSV)
-    read_json_file_and_insert_data(COUNTRIESJSON)
-    update_tables()
-    interactive_prompt()
+    args = parse_arguments()
+    QUERY_BACKEND = args.backend
+    SLOW_QUERY_THRESHOLD = args.slow_query_threshold
+    start(args.fast_start, args.column_snapshot)
+
+    if args.export_column_snapshot is not None:
+        write_column_snapshot(args.export_column_snapshot, column_store())
+    elif args.batch == "-":
+        process_commands(sys.stdin, output_format=args.format, workers=args.workers, pool_chunksize=args.chunk_size)
+    elif args.batch is not None:
+        with open(args.batch) as batch_f:
+            process_commands(batch_f, output_format=args.format, workers=args.workers, pool_chunksize=args.chunk_size)
+    else:
+        interactive_prompt()
@@ -0,0 +1,239 @@
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import proj3_choc as choc
+
+# proj3_choc_bench.py
+# Benchmark of the ingest and of the query commands, on synthetic datasets
+# shaped like flavors_of_cacao_cleaned.csv and countries.json at 10x, 100x
+# and 1000x the sample size.
+#
+# Copy k of the sample (k = 1..scale-1) renames its companies and countries
+# with a " k" suffix, so every command family grows with the scale: more
+# bars, companies, and countries (the regions stay the same).
+#
+# Each run appends one JSON line per scale to the history file, and is
+# compared with the last run of the same scale and backend there: a step
+# or command family whose time grew by more than the tolerance is reported
+# as a regression (and the exit status is 1).
+#
+#   python proj3_choc_bench.py --scales 10,100 --repeat 5
+SCALES = [10, 100, 1000]
+HISTORY = "bench_history.jsonl"
+TOLERANCE = 0.25
+
+# representative commands of every family
+COMMANDS = [
+    "bars ratings top=10",
+    "bars cocoa bottom=10",
+    "bars sellcountry=US ratings top=10",
+    "bars sourcecountry=VE cocoa top=10",
+    "bars sellregion=Europe ratings bottom=10",
+    "bars sourceregion=Africa cocoa top=10",
+    "bars ratings top=1000",
+    "companies ratings top=10",
+    "companies cocoa bottom=10",
+    "companies bars_sold top=10",
+    "companies country=US ratings top=10",
+    "companies region=Europe bars_sold top=10",
+    "companies region=Americas cocoa bottom=10",
+    "countries sellers ratings top=10",
+    "countries sources bars_sold top=10",
+    "countries region=Europe sellers cocoa top=10",
+    "countries region=Americas sources ratings bottom=10",
+    "regions sellers ratings top=10",
+    "regions sources bars_sold top=10",
+    "regions sellers cocoa bottom=10",
+]
+
+# --- synthetic data ---
+def copy_name(name, k):
+    if k == 0 or name == "Unknown":
+        return name
+    return "{} {}".format(name, k)
+
+def write_countries(filename, countries, scale):
+    with open(filename, "w") as json_f:
+        json_f.write("[")
+        for k in range(scale):
+            for (i, country) in enumerate(countries):
+                if k or i:
+                    json_f.write(",")
+                country = dict(country, name=copy_name(country["name"], k))
+                json_f.write(json.dumps(country))
+        json_f.write("]")
+
+def write_bars(filename, header, bars, scale, seed):
+    rand = random.Random(seed)
+    with open(filename, "w", newline="") as csv_f:
+        writer = csv.writer(csv_f)
+        writer.writerow(header)
+        for k in range(scale):
+            for row in bars:
+                (company, name, ref, date, cocoa, location, rating, bean_type, origin) = row
+                if k:
+                    # vary the metrics, so the copies do not all tie
+                    cocoa = "{:g}%".format(min(100, max(40, float(cocoa.strip("%")) + rand.choice([-2, 0, 2]))))
+                    rating = str(min(5.0, max(1.0, float(rating) + rand.choice([-0.25, 0, 0.25]))))
+                writer.writerow([copy_name(company, k), name, int(ref) + 10000 * k, date, cocoa,
+                                 copy_name(location, k), rating, bean_type, copy_name(origin, k)])
+
+def generate_dataset(directory, scale, seed=0):
+    with open(choc.BARSCSV) as csv_f:
+        reader = csv.reader(csv_f)
+        header = next(reader)
+        bars = list(reader)
+    with open(choc.COUNTRIESJSON) as json_f:
+        countries = json.load(json_f)
+
+    bars_csv = os.path.join(directory, "bars_{}x.csv".format(scale))
+    countries_json = os.path.join(directory, "countries_{}x.json".format(scale))
+    write_bars(bars_csv, header, bars, scale, seed)
+    write_countries(countries_json, countries, scale)
+    return (bars_csv, countries_json)
+
+# --- timing ---
+def percentile(samples, p):
+    ordered = sorted(samples)
+    index = max(0, int(round(p / 100.0 * len(ordered))) - 1)
+    return ordered[index]
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return (time.perf_counter() - start, result)
+
+def bench_ingest(bars_csv, countries_json):
+    choc.init_db_tables(indexes=False)
+    steps = {}
+    (seconds, bars) = timed(choc.read_csv_file_and_insert_data, bars_csv)
+    steps["read_csv_file_and_insert_data"] = {"seconds": seconds, "rows": bars["rows"]}
+    (seconds, countries) = timed(choc.read_json_file_and_insert_data, countries_json)
+    steps["read_json_file_and_insert_data"] = {"seconds": seconds, "rows": countries["rows"]}
+    (seconds, _) = timed(choc.update_tables)
+    steps["update_tables"] = {"seconds": seconds, "rows": bars["rows"]}
+    (seconds, _) = timed(choc.create_indexes)
+    steps["create_indexes"] = {"seconds": seconds, "rows": bars["rows"]}
+    for step in steps.values():
+        step["rows_per_sec"] = step["rows"] / step["seconds"] if step["seconds"] > 0 else None
+    return steps
+
+# Each command is parsed and run repeat times, bypassing the result cache,
+# after one untimed run to warm the connection and the page cache.
+def bench_queries(repeat):
+    choc.close_connections()
+    choc.invalidate_result_cache()
+    families = {}
+    for command in COMMANDS:
+        choc.run_query(choc.parse_command(command))
+        family = families.setdefault(command.split()[0], {"samples": [], "rows": 0})
+        for _ in range(repeat):
+            start = time.perf_counter()
+            results = choc.run_query(choc.parse_command(command))
+            family["samples"].append(time.perf_counter() - start)
+            family["rows"] += len(results)
+
+    report = {}
+    for (name, family) in families.items():
+        seconds = sum(family["samples"])
+        report[name] = {
+            "queries": len(family["samples"]),
+            "p50_ms": percentile(family["samples"], 50) * 1000,
+            "p99_ms": percentile(family["samples"], 99) * 1000,
+            "rows_per_sec": family["rows"] / seconds if seconds > 0 else None,
+        }
+    return report
+
+def run_scale(directory, scale, repeat, seed=0):
+    (bars_csv, countries_json) = generate_dataset(directory, scale, seed)
+    dbname = choc.DBNAME
+    choc.DBNAME = os.path.join(directory, "choc_{}x.db".format(scale))
+    try:
+        ingest = bench_ingest(bars_csv, countries_json)
+        queries = bench_queries(repeat)
+    finally:
+        choc.close_connections()
+        choc.invalidate_result_cache()
+        choc.DBNAME = dbname
+    return {"ingest": ingest, "queries": queries}
+
+# --- history ---
+def read_history(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as history_f:
+        return [json.loads(line) for line in history_f if line.strip()]
+
+def previous_run(history, scale, backend):
+    for record in reversed(history):
+        if record["scale"] == scale and record["backend"] == backend:
+            return record
+    return None
+
+# (name, previous, current) of every timing that grew by more than tolerance
+def regressions(previous, current, tolerance=TOLERANCE):
+    found = []
+    for (step, stats) in current["ingest"].items():
+        before = previous["ingest"].get(step)
+        if before and stats["seconds"] > before["seconds"] * (1 + tolerance):
+            found.append(("ingest " + step, before["seconds"], stats["seconds"]))
+    for (family, stats) in current["queries"].items():
+        before = previous["queries"].get(family)
+        if before and stats["p50_ms"] > before["p50_ms"] * (1 + tolerance):
+            found.append((family + " p50_ms", before["p50_ms"], stats["p50_ms"]))
+    return found
+
+def print_report(record):
+    print("scale {}x ({} backend)".format(record["scale"], record["backend"]))
+    for (step, stats) in record["ingest"].items():
+        print("  {0:32} {1:10.3f}s {2:12.0f} rows/sec".format(step, stats["seconds"], stats["rows_per_sec"] or 0))
+    for (family, stats) in record["queries"].items():
+        print("  {0:32} p50 {1:9.3f}ms  p99 {2:9.3f}ms {3:12.0f} rows/sec".format(
+            family, stats["p50_ms"], stats["p99_ms"], stats["rows_per_sec"] or 0))
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the chocolate bar ratings database.")
+    parser.add_argument("--scales", default=",".join(str(scale) for scale in SCALES),
+                        help="comma separated dataset scales (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="timed runs of each command (default: %(default)s)")
+    parser.add_argument("--backend", choices=["sqlite", "columnar"], default=choc.QUERY_BACKEND,
+                        help="query backend (default: %(default)s)")
+    parser.add_argument("--history", default=HISTORY,
+                        help="JSON lines file the results are appended to (default: %(default)s)")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="slowdown reported as a regression (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    choc.QUERY_BACKEND = args.backend
+    history = read_history(args.history)
+    found = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        for scale in [int(scale) for scale in args.scales.split(",")]:
+            record = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "scale": scale,
+                      "backend": args.backend, "repeat": args.repeat}
+            record.update(run_scale(directory, scale, args.repeat, args.seed))
+            print_report(record)
+
+            previous = previous_run(history, scale, args.backend)
+            if previous is not None:
+                for (name, before, after) in regressions(previous, record, args.tolerance):
+                    print("  REGRESSION {}: {:.3f} -> {:.3f}".format(name, before, after))
+                    found.append(name)
+
+            with open(args.history, "a") as history_f:
+                history_f.write(json.dumps(record) + "\n")
+
+    return 1 if found else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
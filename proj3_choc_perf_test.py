@@ -0,0 +1,896 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import unittest
+from proj3_choc import *
+
+# proj3_choc_perf_test.py
+# Tests for the loading, caching and execution paths around
+# process_command. Like proj3_choc_test.py, these run against the prebuilt
+# choc.db; the loading tests build their own database (TempDatabase).
+
+# Points DBNAME at a database in a temporary directory for each test.
+class TempDatabase(unittest.TestCase):
+
+    def setUp(self):
+        import proj3_choc
+        import tempfile
+        self.directory = tempfile.TemporaryDirectory()
+        self.dbname = proj3_choc.DBNAME
+        proj3_choc.DBNAME = os.path.join(self.directory.name, "choc.db")
+
+    def tearDown(self):
+        import proj3_choc
+        close_connections()
+        invalidate_result_cache()
+        proj3_choc.DBNAME = self.dbname
+        self.directory.cleanup()
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        invalidate_result_cache()
+
+    def test_normalized_command_hits(self):
+        before = result_cache_stats()
+        results = process_command('bars top=10')
+        self.assertEqual(process_command('Bars Top=10'), results)
+        self.assertEqual(process_command('bars ratings top=010'), results)
+        after = result_cache_stats()
+        self.assertEqual(after["misses"] - before["misses"], 1)
+        self.assertEqual(after["hits"] - before["hits"], 2)
+
+    def test_invalidation(self):
+        process_command('regions sources bars_sold top=5')
+        self.assertEqual(result_cache_stats()["size"], 1)
+        invalidate_result_cache()
+        self.assertEqual(result_cache_stats()["size"], 0)
+        results = process_command('regions sources bars_sold top=5')
+        self.assertEqual(results[0][0], 'Americas')
+
+# the cache and commits through another connection
+class TestCacheDataVersion(TempDatabase):
+
+    def test_new_thread_after_commit(self):
+        import proj3_choc
+        import shutil
+        import threading
+        shutil.copy(self.dbname, proj3_choc.DBNAME)
+        command_dic = parse_command('regions sellers bars_sold top=1')
+        before = cached_query(command_dic)
+
+        conn = sqlite3.connect(proj3_choc.DBNAME)
+        with conn:
+            conn.execute("UPDATE RegionSummary SET BarCount = BarCount + 1000")
+        conn.close()
+
+        # a thread whose connection opens after the commit must not get the
+        # results cached before it
+        answers = []
+        thread = threading.Thread(target=lambda: answers.append(cached_query(command_dic)))
+        thread.start()
+        thread.join()
+        self.assertEqual(answers[0][0][1], before[0][1] + 1000)
+        self.assertEqual(cached_query(command_dic), answers[0])
+
+class TestSummaryTables(unittest.TestCase):
+
+    def test_company_summary(self):
+        conn = sqlite3.connect(DBNAME)
+        cur = conn.cursor()
+
+        sql = '''
+            SELECT AVG(Rating), AVG(CocoaPercent), COUNT(*)
+            FROM Bars
+            WHERE Company = "Soma"
+        '''
+        expected = cur.execute(sql).fetchone()
+
+        sql = '''
+            SELECT AvgRating, AvgCocoa, BarCount
+            FROM CompanySummary
+            WHERE Located = 0 AND Company = "Soma"
+        '''
+        self.assertEqual(cur.execute(sql).fetchone(), expected)
+
+        conn.close()
+
+    def test_region_summary(self):
+        conn = sqlite3.connect(DBNAME)
+        cur = conn.cursor()
+
+        sql = '''
+            SELECT BarCount
+            FROM RegionSummary
+            WHERE Side = "sellers"
+        '''
+        count = sum(row[0] for row in cur.execute(sql).fetchall())
+        self.assertEqual(count, 1795)
+
+        conn.close()
+
+class TestColumnarBackend(unittest.TestCase):
+
+    def test_same_results_as_sqlite(self):
+        commands = [
+            'bars ratings top=10', 'bars cocoa bottom=10', 'bars sellcountry=CA ratings top=5',
+            'bars sourceregion=Africa cocoa top=20', 'companies region=Europe ratings top=5',
+            'companies country=US bars_sold top=5', 'companies cocoa bottom=10',
+            'countries sources ratings bottom=5', 'countries region=Asia sellers cocoa top=5',
+            'regions sellers ratings top=10', 'regions sources bars_sold bottom=3',
+            'bars sellregion=Europe sourcecountry=VE cocoa=70..80 top=50', 'bars cocoa=70..80 top=20',
+            'bars sellcountry=US rating=3.5.. year=..2010 cocoa bottom=20', 'bars year=2012 rating=..2.5 top=-1',
+        ]
+        store = load_column_store()
+        without_numpy = ColumnStore({name: getattr(store, name) for name in STORE_COLUMNS}, None)
+        for command in commands:
+            command_dic = parse_command(command)
+            with self.subTest(command=command):
+                self.assertEqual(store.query(command_dic), run_query(command_dic))
+                self.assertEqual(without_numpy.query(command_dic), run_query(command_dic))
+
+    def test_groups_computed_once(self):
+        store = load_column_store()
+        store.query(parse_command('companies ratings top=10'))
+        grouping = store.group_cache["companies"]
+        order = grouping["orders"]["ratings"]
+        store.query(parse_command('companies ratings bottom=3'))
+        store.query(parse_command('companies cocoa top=5'))
+        self.assertIs(store.group_cache["companies"], grouping)
+        self.assertIs(grouping["orders"]["ratings"], order)
+        self.assertEqual(sorted(grouping["orders"]), ["cocoa", "ratings"])
+
+class TestConnectionPool(unittest.TestCase):
+
+    # file descriptors of this process open on choc.db
+    def open_files(self):
+        count = 0
+        for fd in os.listdir("/proc/self/fd"):
+            try:
+                count += os.readlink(os.path.join("/proc/self/fd", fd)) == os.path.abspath(DBNAME)
+            except OSError:
+                pass
+        return count
+
+    def test_read_only(self):
+        conn = get_connection()
+        self.assertIs(get_connection(), conn)
+        with self.assertRaises(sqlite3.OperationalError):
+            conn.execute("CREATE TABLE Scratch (Id INTEGER)")
+        close_connections()
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")
+        self.assertIsNot(get_connection(), conn)
+
+    @unittest.skipUnless(os.path.isdir("/proc/self/fd"), "lists the open files through /proc")
+    def test_finished_threads(self):
+        import threading
+        close_connections()
+        before = self.open_files()
+        for _ in range(3):
+            thread = threading.Thread(target=get_connection)
+            thread.start()
+            thread.join()
+            self.assertEqual(self.open_files(), before + 1)
+        close_connections()
+        self.assertEqual(self.open_files(), before)
+
+    @unittest.skipUnless(os.path.isdir("/proc/self/fd"), "lists the open files through /proc")
+    def test_service_closes_connections(self):
+        close_connections()
+        before = self.open_files()
+        commands = ['bars ratings top={}'.format(limit) for limit in range(1, 9)]
+        for _ in range(5):
+            invalidate_result_cache()
+            service = QueryService(workers=4)
+
+            async def client():
+                return await asyncio.gather(*[service.run_command(command) for command in commands])
+
+            asyncio.run(client())
+            self.assertGreater(self.open_files(), before)
+            service.close()
+            self.assertEqual(self.open_files(), before)
+
+class TestBatchMode(unittest.TestCase):
+
+    commands = [
+        'bars ratings top=5', 'bars ratings top=1', 'Bars Ratings Top=5', 'not a command',
+        'companies country=US bars_sold top=5', 'regions sources bars_sold top=5',
+    ]
+
+    def run_batch(self, **kwargs):
+        out = io.StringIO()
+        count = process_commands(self.commands, out=out, **kwargs)
+        self.assertEqual(count, len(self.commands))
+        return [json.loads(line) for line in out.getvalue().splitlines()]
+
+    def test_jsonl(self):
+        records = self.run_batch()
+        self.assertEqual([record["command"] for record in records], self.commands)
+        self.assertEqual(records[1]["rows"][0][0], 'Chuao')
+        self.assertEqual(records[0]["rows"], records[2]["rows"])
+        self.assertEqual(records[1]["rows"], records[0]["rows"][:1])
+        self.assertIn("error", records[3])
+        self.assertEqual(records[4]["rows"][0][2], 26)
+
+    def test_process_pool(self):
+        invalidate_result_cache()
+        self.assertEqual(self.run_batch(workers=2, pool_chunksize=1), self.run_batch())
+
+class TestQueryService(unittest.TestCase):
+
+    def test_run_command(self):
+        service = QueryService(workers=2, max_in_flight=2)
+
+        async def client():
+            commands = ['bars ratings top=1'] * 10 + ['regions sources bars_sold top=5', 'companies cocoa top=5']
+            return await asyncio.gather(*[service.run_command(command) for command in commands])
+
+        results = asyncio.run(client())
+        service.close()
+        self.assertEqual(results[0][0][0], 'Chuao')
+        self.assertEqual(results[9], results[0])
+        self.assertEqual(results[10][0][0], 'Americas')
+        self.assertEqual(results[11][0][0], 'Videri')
+        self.assertEqual(service.stats["executed"], 3)
+        self.assertEqual(service.stats["coalesced"], 9)
+
+    def test_cancelled_caller(self):
+        service = QueryService(workers=1)
+
+        async def client():
+            first = asyncio.ensure_future(service.run_command('bars top=3'))
+            second = asyncio.ensure_future(service.run_command('bars top=3'))
+            # both are waiting on the shared execution
+            await asyncio.sleep(0)
+            first.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await first
+            return await second
+
+        results = asyncio.run(client())
+        service.close()
+        self.assertEqual(results, run_query(parse_command('bars top=3')))
+        self.assertEqual((service.stats["executed"], service.stats["coalesced"]), (1, 1))
+
+    def test_unknown_command(self):
+        with self.assertRaises(ValueError):
+            asyncio.run(run_command('chocolate please'))
+
+class TestParameterBinding(unittest.TestCase):
+
+    def test_quoted_keyword(self):
+        for command in ["bars sellcountry=U'S ratings top=5", "bars sourceregion=x'--", "companies region=Eu'rope top=5",
+                        "companies sourcecountry=V'E", "countries region=x');DROP_TABLE_Bars;--", "bars search=o'brien"]:
+            command_dic = parse_command(command)
+            (statement, params) = command_statement(command_dic)
+            keyword = command_dic.keyword or command_dic.search
+            with self.subTest(command=command):
+                self.assertNotIn(keyword, statement)
+                self.assertTrue(any(keyword in str(param) for param in params))
+                self.assertEqual(run_query(command_dic), [])
+
+    def test_limit(self):
+        (statement, params) = command_statement(parse_command('bars ratings top=7'))
+        self.assertNotIn("7", statement)
+        self.assertEqual(params[-1], 7)
+
+class TestRenderers(unittest.TestCase):
+
+    def test_execute_does_not_print(self):
+        out = io.StringIO()
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            result = execute_command('regions sources bars_sold top=5')
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(out.getvalue(), "")
+        self.assertEqual(result.columns, ["Region", "BarCount"])
+        self.assertEqual(result[0][0], 'Americas')
+        self.assertIsNone(execute_command('not a command'))
+
+    def test_formats(self):
+        result = execute_command('companies country=US bars_sold top=5')
+        self.assertEqual(result.render("text").splitlines()[0].split()[0], 'Fresco')
+        self.assertEqual(result.render("csv").splitlines()[0], "Company,CompanyLocation,BarCount")
+        self.assertEqual(json.loads(result.render("json"))[0]["BarCount"], 26)
+        self.assertEqual(result.render("dicts")[0]["CompanyLocation"], 'United States of America')
+        with self.assertRaises(ValueError):
+            result.render("xml")
+
+class TestStreaming(unittest.TestCase):
+
+    def test_stream_command(self):
+        out = io.StringIO()
+        count = stream_command('bars sourceregion=Africa cocoa top=100000', out, fetch_size=7)
+        listing = execute_command('bars sourceregion=Africa cocoa top=100000')
+        self.assertEqual(count, len(listing))
+        self.assertEqual(out.getvalue(), listing.render("text"))
+        self.assertIsNone(stream_command('not a command', out))
+
+    def test_bars_pages(self):
+        for (criteria, sorting_order) in [("ratings", "top"), ("cocoa", "bottom")]:
+            rows = []
+            after = None
+            while True:
+                (page, after) = bars_page("c1.Region", "Europe", criteria, sorting_order, 50, after)
+                self.assertLessEqual(len(page), 50)
+                rows += page
+                if after is None:
+                    break
+            self.assertEqual(rows, bars_query("c1.Region", "Europe", criteria, sorting_order, 100000))
+
+    def test_page_uses_index(self):
+        statement = bars_statement("", "ratings", "top", keyset=True, after=True)
+        self.assertEqual(full_table_scans(statement, [3.5, 3.5, 100, 10]), [])
+
+class TestInstrumentation(unittest.TestCase):
+
+    def run_command(self, command):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return process_command(command)
+
+    def test_trace(self):
+        invalidate_result_cache()
+        reset_query_stats()
+        self.run_command('bars sellcountry=US ratings top=5')
+        self.run_command('bars sellcountry=US ratings top=5')
+        (first, second) = RECENT_TRACES
+        self.assertEqual(list(first.stages), ["parse", "connect", "execute", "fetch", "format", "write"])
+        self.assertEqual(first.rows, 5)
+        # the country counts and IDs of the filter, then one statement per
+        # country (bars_top)
+        ((counts, counts_params), (ids, ids_params), (bars, bars_params)) = first.statements
+        self.assertIn("FROM CountrySummary", counts)
+        self.assertEqual(counts_params, [5, "sellers", "US"])
+        self.assertIn("FROM CountrySummary", ids)
+        self.assertEqual(ids_params, ["sellers", "US"])
+        self.assertIn("WHERE CompanyLocationId = ?", bars)
+        us = get_connection().execute("SELECT Id FROM Countries WHERE Alpha2 = 'US'").fetchone()[0]
+        self.assertEqual(bars_params, [us, 5])
+        self.assertEqual(len(first.plans()), 3)
+        self.assertTrue(all(first.plans()))
+        self.assertTrue(second.cached)
+        self.assertNotIn("execute", second.stages)
+
+        stats = query_stats()["bars"]
+        self.assertEqual((stats["count"], stats["cached"], stats["rows"]), (2, 1, 10))
+        self.assertEqual(sum(count for (_, count) in stats["histogram"]), 2)
+
+    def test_slow_query_log(self):
+        import proj3_choc
+        threshold = proj3_choc.SLOW_QUERY_THRESHOLD
+        proj3_choc.SLOW_QUERY_THRESHOLD = 0
+        try:
+            with self.assertLogs("proj3_choc.slow_queries") as logs:
+                self.run_command('regions sources ratings top=3')
+        finally:
+            proj3_choc.SLOW_QUERY_THRESHOLD = threshold
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record["event"], "slow_query")
+        self.assertEqual(record["rows"], 3)
+        self.assertEqual(len(record["statements"]), 1)
+        self.assertIn("FROM RegionSummary", record["statements"][0]["sql"])
+        self.assertEqual(len(record["plans"]), 1)
+
+class TestParser(unittest.TestCase):
+
+    def test_query_spec(self):
+        spec = parse_command('companies region=europe bars_sold bottom=12')
+        self.assertEqual(spec, QuerySpec("companies", "Region", "Europe", "bars_sold", "bottom", 12, "sellers", False, "", (), ()))
+        self.assertEqual(spec["criteria"], "bars_sold")
+        self.assertEqual(parse_command('Companies  Bottom=12 BARS_SOLD Region=Europe'), spec)
+        self.assertEqual(hash(parse_command('regions')), hash(DEFAULT_SPEC._replace(query_type="regions")))
+
+    def test_grammar_fields(self):
+        for (field, _) in COMMAND_WORDS.values():
+            self.assertIn(field, QUERY_SPEC_FIELDS)
+        for (field, _, option_field, _) in COMMAND_OPTIONS.values():
+            self.assertIn(field, QUERY_SPEC_FIELDS)
+            self.assertIn(option_field, QUERY_SPEC_FIELDS + [None])
+
+    def test_invalid(self):
+        with contextlib.redirect_stdout(io.StringIO()) as out:
+            for command in ['exit', 'ratings top=5', 'bars top=ten', '']:
+                self.assertIsNone(parse_command(command))
+        self.assertEqual(out.getvalue().splitlines()[0], "Command not recognized:  exit")
+        self.assertEqual(len(out.getvalue().splitlines()), 3)
+
+class TestStartup(unittest.TestCase):
+
+    def run_python(self, code):
+        return subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+
+    def test_lazy_imports(self):
+        loaded = self.run_python(
+            "import sys, proj3_choc\n"
+            "print([name for name in ['csv', 'json', 'hashlib', 'asyncio', 'concurrent.futures', 'argparse'] if name in sys.modules])")
+        self.assertEqual(loaded.strip(), "[]")
+
+    def test_fast_start(self):
+        stats = json.loads(self.run_python(
+            "import json, sys, proj3_choc\n"
+            "proj3_choc.start(fast_start=True)\n"
+            "print(json.dumps(dict(proj3_choc.STARTUP_STATS, csv='csv' in sys.modules)))"))
+        # (how long it took is left to the startup log and the benchmark)
+        self.assertEqual(stats["mode"], "snapshot")
+        self.assertFalse(stats["csv"])
+        self.assertIn("build_seconds", stats)
+
+    def test_help_text(self):
+        self.assertIn("Commands available", load_help_text())
+        self.assertIs(load_help_text(), load_help_text())
+
+class TestReports(unittest.TestCase):
+
+    commands = [
+        'companies report bars_sold top=10', 'companies region=Europe report ratings bottom=5',
+        'companies sourcecountry=VE report cocoa top=5', 'countries sources report stddev_rating top=5',
+        'countries region=Americas sellers report max_cocoa bottom=5', 'regions report min_rating top=5',
+    ]
+
+    def test_metrics_match_single_commands(self):
+        for command in self.commands:
+            with self.subTest(command=command):
+                report = execute_command(command)
+                labels = len(RESULT_COLUMNS[report.query_type])
+                self.assertEqual(len(report.columns), labels + len(SUMMARY_METRICS))
+                for (index, criteria) in enumerate(["ratings", "cocoa", "bars_sold"]):
+                    single = run_query(parse_command(command.replace("report", "").replace(report.criteria, criteria)))
+                    values = {row[:labels]: row[labels] for row in single}
+                    for row in report:
+                        if row[:labels] in values:
+                            self.assertAlmostEqual(row[labels + index], values[row[:labels]])
+
+    def test_sorted_on_any_metric(self):
+        report = execute_command('companies report bars_sold top=10')
+        listing = execute_command('companies bars_sold top=10')
+        self.assertEqual([row[:2] + (row[4],) for row in report], list(listing))
+
+        report = execute_command('countries sources report stddev_cocoa top=50')
+        deviations = [row[-1] for row in report]
+        self.assertEqual(deviations, sorted(deviations, reverse=True))
+        self.assertTrue(all(low <= high for (low, high) in ((row[5], row[6]) for row in report)))
+
+    def test_columnar(self):
+        store = load_column_store()
+        for command in self.commands:
+            command_dic = parse_command(command)
+            with self.subTest(command=command):
+                expected = run_query(command_dic)
+                rows = store.query(command_dic)
+                self.assertEqual([row[:2] for row in rows], [row[:2] for row in expected])
+                for (row, expected_row) in zip(rows, expected):
+                    for (value, expected_value) in zip(row[2:], expected_row[2:]):
+                        self.assertAlmostEqual(value, expected_value)
+
+    def test_not_for_bars(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertIsNone(parse_command('bars report'))
+            self.assertIsNone(parse_command('bars stddev_rating top=5'))
+
+class TestSearch(unittest.TestCase):
+
+    def test_search_bars(self):
+        rows = run_query(parse_command('bars search=company:val* top=100'))
+        self.assertTrue(rows)
+        self.assertTrue(all(any(word.startswith("val") for word in row[1].lower().replace("(", " ").split()) for row in rows))
+        rows = run_query(parse_command('bars sellcountry=US search=origin:peru top=100'))
+        self.assertTrue(rows)
+        self.assertTrue(all("peru" in row[5].lower() and row[2] == "United States of America" for row in rows))
+
+    def test_search_companies(self):
+        rows = run_query(parse_command('companies search=company:valrhona bars_sold'))
+        self.assertEqual(sorted(row[0] for row in rows), ['La Maison du Chocolat (Valrhona)', 'Valrhona'])
+
+    def test_match_fallback(self):
+        import proj3_choc
+        # whole words, word starts, accents and words inside punctuation
+        commands = ['bars search=madagascar top=500', 'bars search=company:val* top=500',
+                    'companies region=Europe search=madagascar top=500', 'bars search=bar:ago* top=500',
+                    'bars search=bar:lago top=500', 'bars search=origin:cote top=500',
+                    'bars search=type:criollo top=500', 'bars search=bar:s* top=500']
+        with_index = [sorted(run_query(parse_command(command))) for command in commands]
+        proj3_choc.SEARCH_INDEX[proj3_choc.DBNAME] = False
+        try:
+            without_index = [sorted(run_query(parse_command(command))) for command in commands]
+        finally:
+            proj3_choc.SEARCH_INDEX.clear()
+        self.assertEqual(with_index, without_index)
+        self.assertEqual(with_index[3], [])
+
+    def test_search_match(self):
+        self.assertTrue(search_match("Sur del Lago", "lago", False))
+        self.assertFalse(search_match("Sur del Lago", "ago", True))
+        self.assertTrue(search_match("La Maison du Chocolat (Valrhona)", "val", True))
+        self.assertTrue(search_match("C\u00f4te d'Ivoire", "cote", False))
+        self.assertTrue(search_match("Sur del Lago", "del-la", True))
+        self.assertFalse(search_match("Sur del Lago", "del-la", False))
+        self.assertFalse(search_match(None, "lago", False))
+
+    def test_index_follows_bars(self):
+        import proj3_choc
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            copy = os.path.join(directory, "choc.db")
+            source = sqlite3.connect(DBNAME)
+            target = sqlite3.connect(copy)
+            source.backup(target)
+            source.close()
+            count = lambda term: target.execute("SELECT COUNT(*) FROM BarsSearch WHERE BarsSearch MATCH ?", [term]).fetchone()[0]
+            chuao = count("SpecificBeanBarName : chuao")
+            with target:
+                target.execute("INSERT INTO Bars(Company, SpecificBeanBarName, REF, Rating, CocoaPercent) VALUES ('Zyx', 'Quuxberry', '1', 4.0, 70)")
+                target.execute("UPDATE Bars SET SpecificBeanBarName = 'Blorpberry' WHERE SpecificBeanBarName = 'Chuao'")
+            self.assertEqual(count("quuxberry"), 1)
+            self.assertEqual(count("blorpberry"), 19)
+            self.assertEqual(count("SpecificBeanBarName : chuao"), chuao - 19)
+            with target:
+                target.execute("DELETE FROM Bars WHERE Company = 'Zyx'")
+            self.assertEqual(count("quuxberry"), 0)
+            target.close()
+
+    def test_invalid(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            for command in ['regions search=peru', 'bars search=flavor:x', 'bars search=*',
+                            'companies sourcecountry=VE search=peru']:
+                self.assertIsNone(parse_command(command))
+
+class TestTopK(unittest.TestCase):
+
+    def test_same_as_one_statement(self):
+        for (specification, keyword) in [("c1.Alpha2", "us"), ("c2.Alpha2", "VE"), ("c1.Region", "Europe"),
+                                         ("c2.Region", "Americas"), ("c1.Region", "Nowhere")]:
+            for criteria in ["ratings", "cocoa"]:
+                for sorting_order in ["top", "bottom"]:
+                    for limit in [1, 7, 50, 5000, -1]:
+                        statement = bars_statement(specification, criteria, sorting_order)
+                        expected = execute_query(statement, bars_params(specification, keyword, limit))
+                        with self.subTest(specification=specification, criteria=criteria, sorting_order=sorting_order, limit=limit):
+                            self.assertEqual(bars_top(specification, keyword, criteria, sorting_order, limit), expected)
+
+    def test_invalid_specification(self):
+        # checked before the planner reads the country counts
+        with self.assertRaises(ValueError):
+            run_query(parse_command('bars country=US'))
+        with self.assertRaises(ValueError):
+            bars_top("Alpha2", "US")
+
+    def test_planner(self):
+        # one country with many bars: per country; a region of small ones: one statement
+        self.assertTrue(per_country_cheaper(country_bar_counts("c1.Alpha2", "US", 10)))
+        self.assertFalse(per_country_cheaper(country_bar_counts("c1.Region", "Europe", 10)))
+        self.assertFalse(per_country_cheaper(country_bar_counts("c1.Alpha2", "US", 1000)))
+
+    def test_stops_in_index_order(self):
+        for side in ["CompanyLocationId", "BroadBeanOriginId"]:
+            for criteria in ["ratings", "cocoa"]:
+                for sorting_order in ["top", "bottom"]:
+                    statement = bars_statement(side, criteria, sorting_order, keyset=True)
+                    details = [detail for (_, _, detail) in query_plan(statement, [1, 10])]
+                    self.assertTrue(details[0].startswith("SEARCH Bars USING "))
+                    self.assertNotIn("USE TEMP B-TREE FOR ORDER BY", details)
+
+class TestColumnSnapshot(unittest.TestCase):
+
+    commands = [
+        'bars ratings top=10', 'bars sellregion=Europe cocoa bottom=10', 'bars sourcecountry=VE ratings top=5',
+        'companies country=US bars_sold top=5', 'companies region=Europe max_rating top=5 report',
+        'countries sources cocoa bottom=5', 'regions sellers ratings top=10',
+        'bars sellregion=Europe sourcecountry=VE ratings top=10', 'bars year=2010..2012 cocoa=..60 top=10',
+    ]
+
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "choc.columns")
+        write_column_snapshot(self.filename)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_same_results(self):
+        store = open_column_snapshot(self.filename)
+        self.assertIsInstance(store.rating, memoryview)
+        for command in self.commands:
+            command_dic = parse_command(command)
+            with self.subTest(command=command):
+                self.assertEqual(store.query(command_dic), run_query(command_dic))
+
+    def test_rejects_corrupt_file(self):
+        with open(self.filename, "r+b") as snapshot_f:
+            snapshot_f.seek(-1, os.SEEK_END)
+            last = snapshot_f.read(1)
+            snapshot_f.seek(-1, os.SEEK_END)
+            snapshot_f.write(bytes([last[0] ^ 1]))
+        with self.assertRaises(ValueError):
+            open_column_snapshot(self.filename)
+        open_column_snapshot(self.filename, verify=False)
+
+    def test_rejects_other_schema(self):
+        import proj3_choc
+        version = proj3_choc.SCHEMA_VERSION
+        proj3_choc.SCHEMA_VERSION = version + 1
+        try:
+            with self.assertRaises(ValueError):
+                open_column_snapshot(self.filename)
+        finally:
+            proj3_choc.SCHEMA_VERSION = version
+
+    def test_without_database(self):
+        # answered from the snapshot alone, in a directory without choc.db
+        for command in ['bars sellcountry=CA ratings top=5', 'bars sellregion=europe sourcecountry=ve', 'bars cocoa=70..80']:
+            output = subprocess.run(
+                [sys.executable, os.path.abspath("proj3_choc.py"), "--column-snapshot", self.filename, "--batch", "-"],
+                input=command + "\n", cwd=self.directory.name,
+                capture_output=True, text=True, check=True).stdout
+            with self.subTest(command=command):
+                self.assertEqual(json.loads(output)["rows"], [list(row) for row in run_query(parse_command(command))])
+        self.assertFalse(os.path.exists(os.path.join(self.directory.name, "choc.db")))
+
+class TestCompoundFilters(unittest.TestCase):
+
+    def every_bar(self, command):
+        return run_query(parse_command(command + " ratings top=5000"))
+
+    def test_same_as_intersection(self):
+        europe = self.every_bar("bars sellregion=Europe")
+        venezuela = self.every_bar("bars sourcecountry=VE")
+        expected = [row for row in europe if row in venezuela and 70 <= row[4] <= 80]
+        for command in ['bars sellregion=Europe sourcecountry=VE cocoa=70..80 top=5000',
+                        'bars cocoa=70..80 sourcecountry=ve sellregion=europe top=5000']:
+            with self.subTest(command=command):
+                self.assertEqual(run_query(parse_command(command)), expected)
+
+        rows = run_query(parse_command('bars sellcountry=US rating=3.5.. year=..2010 cocoa bottom=5000'))
+        self.assertTrue(rows)
+        self.assertTrue(all(row[2] == "United States of America" and row[3] >= 3.5 for row in rows))
+        self.assertEqual(rows, sorted(rows, key=lambda row: row[4]))
+
+    def test_query_spec(self):
+        spec = parse_command('bars sourcecountry=VE sellregion=Europe year=2014.. cocoa=70%..80')
+        self.assertEqual((spec.specification, spec.keyword, spec.filters), ("c1.Region", "Europe", (("c2.Alpha2", "Ve"),)))
+        self.assertEqual(spec.ranges, (("CocoaPercent", 70.0, 80.0), ("ReviewDate", "2014", None)))
+
+    def test_planner(self):
+        # the smallest country: looked up through its index
+        filters = (("c1.Region", "Europe"), ("c2.Alpha2", "VE"))
+        self.assertEqual(bars_plan(filters, (("CocoaPercent", 70.0, 80.0),), "ratings", 10), 1)
+        # a narrow range
+        self.assertEqual(bars_plan(filters, (("Rating", 5.0, None),), "ratings", 10), 2)
+        # a loose filter: listed in rating order until the limit is reached
+        self.assertIsNone(bars_plan((), (("CocoaPercent", 50.0, None),), "ratings", 10))
+
+        (statement, params) = bars_filter(filters, (("Rating", 5.0, None),))
+        self.assertIn(" Bars.Rating >= ?", statement)
+        self.assertIn("+Bars.CompanyLocationId", statement)
+        self.assertEqual(full_table_scans(statement, params), [])
+
+    def test_invalid(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            for command in ['companies region=Europe country=US', 'countries cocoa=70', 'bars search=peru year=2015',
+                            'bars cocoa=..', 'bars year=20x5', 'bars rating=a..b']:
+                self.assertIsNone(parse_command(command))
+
+class TestLoader(TempDatabase):
+
+    def test_batches(self):
+        self.assertEqual([len(batch) for batch in batched(range(12), 5)], [5, 5, 2])
+        self.assertEqual(list(batched([], 5)), [])
+
+        import proj3_choc
+        sizes = []
+        def spy(iterable, batch_size):
+            for batch in unspied(iterable, batch_size):
+                sizes.append(len(batch))
+                yield batch
+        (unspied, proj3_choc.batched) = (proj3_choc.batched, spy)
+        try:
+            init_db_tables(indexes=False)
+            stats = read_csv_file_and_insert_data(BARSCSV, batch_size=100)
+        finally:
+            proj3_choc.batched = unspied
+        self.assertEqual(sizes, [100] * 17 + [95])
+        self.assertEqual(stats["rows"], 1795)
+        self.assertIs(LOAD_STATS[BARSCSV], stats)
+
+    def test_pragmas(self):
+        conn = connect_for_load()
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 0)
+        self.assertEqual(conn.execute("PRAGMA cache_size").fetchone()[0], -65536)
+        conn.close()
+
+        conn = connect_for_load({"synchronous": "NORMAL"})
+        self.assertEqual(conn.execute("PRAGMA synchronous").fetchone()[0], 1)
+        conn.close()
+
+class TestJsonArray(unittest.TestCase):
+
+    document = ' [ {"name": "A, [B]", "area": 1.5e3, "codes": ["x", "y"]},\n\t-12 , "\\"]\\u00e9" ,true,null,[],{} ] \n'
+
+    def elements(self, document, chunk_size=JSON_CHUNK_SIZE):
+        return list(iter_json_array(io.StringIO(document), chunk_size))
+
+    def test_chunk_boundaries(self):
+        expected = json.loads(self.document)
+        for chunk_size in [1, 2, 3, 7, JSON_CHUNK_SIZE]:
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(self.elements(self.document, chunk_size), expected)
+        for document in ['[]', ' [ ] ', '[1]', '[123456]']:
+            for chunk_size in [1, 2, 3]:
+                with self.subTest(document=document, chunk_size=chunk_size):
+                    self.assertEqual(self.elements(document, chunk_size), json.loads(document))
+
+    def test_malformed(self):
+        for document in ['', '  ', '{"a": 1}', '[', '[1', '[1,', '[1 2]', '[,,1,,]', '[,1]', '[1,]',
+                         '[1,,2]', '[,]', '[1] 2', '[1]]', '[1] [2]', '[{"a": 1]', '[tru]', '[1.]']:
+            for chunk_size in [1, 2, 3, JSON_CHUNK_SIZE]:
+                with self.subTest(document=document, chunk_size=chunk_size):
+                    with self.assertRaises(ValueError):
+                        self.elements(document, chunk_size)
+
+    def test_same_as_json_load(self):
+        with open(COUNTRIESJSON) as json_f:
+            expected = json.load(json_f)
+        for chunk_size in [97, 4096, JSON_CHUNK_SIZE]:
+            with open(COUNTRIESJSON) as json_f:
+                with self.subTest(chunk_size=chunk_size):
+                    self.assertEqual(list(iter_json_array(json_f, chunk_size)), expected)
+
+class TestIncrementalBuild(TempDatabase):
+
+    commands = [
+        'bars ratings top=2000', 'bars cocoa bottom=2000', 'bars sellcountry=US ratings top=100',
+        'bars sourceregion=Africa cocoa top=100', 'companies ratings top=500', 'companies country=AU bars_sold top=50',
+        'companies sourcecountry=VE ratings top=50', 'companies region=Europe report cocoa bottom=50',
+        'countries sources report ratings top=100', 'regions sellers report bars_sold top=10',
+    ]
+
+    def setUp(self):
+        import csv
+        import proj3_choc
+        import shutil
+        super().setUp()
+        self.sources = (proj3_choc.BARSCSV, proj3_choc.COUNTRIESJSON)
+        proj3_choc.BARSCSV = os.path.join(self.directory.name, "bars.csv")
+        proj3_choc.COUNTRIESJSON = os.path.join(self.directory.name, "countries.json")
+        shutil.copy(self.sources[1], proj3_choc.COUNTRIESJSON)
+        with open(self.sources[0]) as csv_f:
+            self.rows = list(csv.reader(csv_f))
+        # the REF values, newest first
+        self.refs = sorted({row[2] for row in self.rows[1:]}, key=int, reverse=True)
+
+    def tearDown(self):
+        import proj3_choc
+        (proj3_choc.BARSCSV, proj3_choc.COUNTRIESJSON) = self.sources
+        super().tearDown()
+
+    # the CSV without the rows of the given review batches
+    def write_csv(self, without=()):
+        import csv
+        import proj3_choc
+        with open(proj3_choc.BARSCSV, "w", newline="") as csv_f:
+            csv.writer(csv_f).writerows(row for row in self.rows if row[2] not in without)
+
+    # the results of the commands, and the location of every company
+    def answers(self):
+        close_connections()
+        invalidate_result_cache()
+        locations = get_connection().execute(
+            "SELECT Located, Company, CompanyLocation, Alpha2, Region FROM CompanySummary ORDER BY Located, Company").fetchall()
+        return [run_query(parse_command(command)) for command in self.commands] + [locations]
+
+    def test_build_modes(self):
+        import proj3_choc
+        self.write_csv()
+        self.assertEqual(build_db(), "rebuilt")
+        self.assertEqual(build_db(), "unchanged")
+        os.utime(proj3_choc.BARSCSV, (0, 0))
+        self.assertEqual(build_db(), "unchanged")
+
+        self.write_csv(without=self.refs[:5])
+        self.assertEqual(build_db(), "rebuilt")
+        self.write_csv()
+        self.assertEqual(build_db(), "appended")
+
+        # a loaded batch lost a row
+        del self.rows[1]
+        self.write_csv()
+        self.assertEqual(build_db(), "rebuilt")
+
+        # a loaded row was edited, but kept its REF
+        self.rows[10][6] = "1.0"
+        self.write_csv()
+        self.assertEqual(build_db(), "rebuilt")
+        self.assertEqual(build_db(), "unchanged")
+        close_connections()
+        ratings = [rating for (rating,) in get_connection().execute("SELECT Rating FROM Bars ORDER BY Id")]
+        self.assertEqual(ratings[9], 1.0)
+
+    def test_load_into_loaded_bars(self):
+        import proj3_choc
+        self.write_csv()
+        build_db()
+        count = len(self.rows) - 1
+        # without ids, a load appends after the loaded bars
+        read_csv_file_and_insert_data(proj3_choc.BARSCSV)
+        close_connections()
+        ids = [bar_id for (bar_id,) in get_connection().execute("SELECT Id FROM Bars ORDER BY Id")]
+        self.assertEqual(len(set(ids)), 2 * count)
+        self.assertEqual(ids[count], count * BAR_ID_SPACING + 1)
+
+    def test_append_same_as_rebuild(self):
+        import proj3_choc
+        (dbname, proj3_choc.DBNAME) = (proj3_choc.DBNAME, self.dbname)
+        try:
+            expected = self.answers()
+        finally:
+            proj3_choc.DBNAME = dbname
+
+        # the 60 newest batches in two appends, and then the 5 oldest
+        self.write_csv(without=self.refs[:60] + self.refs[-5:])
+        self.assertEqual(build_db(), "rebuilt")
+        self.write_csv(without=self.refs[:30] + self.refs[-5:])
+        self.assertEqual(build_db(), "appended")
+        self.write_csv(without=self.refs[-5:])
+        self.assertEqual(build_db(), "appended")
+        self.write_csv()
+        self.assertEqual(build_db(), "appended")
+
+        for (command, rows, expected_rows) in zip(self.commands + ["locations"], self.answers(), expected):
+            with self.subTest(command=command):
+                self.assertEqual(rows, expected_rows)
+
+    def test_new_bar_ids(self):
+        spacing = BAR_ID_SPACING
+        loaded = [(spacing, "1"), (2 * spacing, "2")]
+        ids = new_bar_ids(["3", "1", "4", "4", "2", "5"], loaded)
+        self.assertEqual(sorted(ids.items()), sorted(ids.items(), key=lambda item: item[1]))
+        self.assertLess(ids[0], spacing)
+        self.assertTrue(spacing < ids[2] < ids[3] < 2 * spacing < ids[5])
+        # reordered, missing or repeated rows
+        self.assertIsNone(new_bar_ids(["2", "1"], loaded))
+        self.assertIsNone(new_bar_ids(["1"], loaded))
+        self.assertIsNone(new_bar_ids(["1", "2", "2"], loaded))
+        # no Ids left between two loaded bars
+        self.assertIsNone(new_bar_ids(["1", "3", "3", "2"], [(1, "1"), (3, "2")]))
+
+class TestCountryLookup(TempDatabase):
+
+    def country_id(self, conn, alpha2):
+        return conn.execute("SELECT Id FROM Countries WHERE Alpha2 = ?", [alpha2]).fetchone()[0]
+
+    def test_aliases(self):
+        init_db_tables(indexes=False)
+        read_json_file_and_insert_data(COUNTRIESJSON)
+        conn = get_connection()
+        lookup = country_id_lookup(conn.cursor())
+        us = self.country_id(conn, "US")
+        self.assertEqual(lookup[country_name_key("U.S.A.")], us)
+        self.assertEqual(lookup[country_name_key(" u.s.a. ")], us)
+        self.assertEqual(lookup[country_name_key("United States of America")], us)
+        self.assertEqual(lookup[country_name_key("Eucador")], self.country_id(conn, "EC"))
+        self.assertNotIn(country_name_key("Atlantis"), lookup)
+
+    def test_bars_resolved(self):
+        init_db_tables(indexes=False)
+        read_json_file_and_insert_data(COUNTRIESJSON)
+        filename = os.path.join(self.directory.name, "bars.csv")
+        with open(filename, "w") as csv_f:
+            csv_f.write("Company,SpecificBeanBarName,REF,ReviewDate,CocoaPercent,CompanyLocation,Rating,BeanType,BroadBeanOrigin\n")
+            csv_f.write("Acme,Bar,1,2016,70%,U.S.A.,3.5,,Eucador\n")
+            csv_f.write("Acme,Other bar,1,2016,70%,Atlantis,3.5,,Venezuela\n")
+        read_csv_file_and_insert_data(filename)
+        update_tables()
+
+        conn = get_connection()
+        rows = conn.execute("SELECT CompanyLocationId, BroadBeanOriginId FROM Bars ORDER BY Id").fetchall()
+        self.assertEqual(rows, [(self.country_id(conn, "US"), self.country_id(conn, "EC")), (None, self.country_id(conn, "VE"))])
+
+unittest.main()
@@ -0,0 +1,106 @@
+import unittest
+import proj3_choc_plans
+from proj3_choc import *
+
+# proj3_choc_plan_test.py
+# Checks the query plans of the supported commands against choc.db: every
+# command has to be answered through an index, never a full table scan,
+# and no SQL shape may scan or sort where its plan in plan_baseline.json
+# did not (see proj3_choc_plans.py).
+
+def supported_commands():
+    commands = []
+    for specification in ["", "sellcountry=US", "sourcecountry=VE", "sellregion=Europe", "sourceregion=Africa"]:
+        for criteria in ["ratings", "cocoa"]:
+            for sorting_order in ["top=10", "bottom=10"]:
+                commands.append(" ".join(["bars", specification, criteria, sorting_order]))
+    for specification in ["", "country=US", "region=Europe"]:
+        for criteria in ["ratings", "cocoa", "bars_sold"]:
+            for sorting_order in ["top=10", "bottom=10"]:
+                commands.append(" ".join(["companies", specification, criteria, sorting_order]))
+    for specification in ["", "region=Europe"]:
+        for sellers_or_sources in ["sellers", "sources"]:
+            for criteria in ["ratings", "cocoa", "bars_sold"]:
+                for sorting_order in ["top=10", "bottom=10"]:
+                    commands.append(" ".join(["countries", specification, sellers_or_sources, criteria, sorting_order]))
+    for sellers_or_sources in ["sellers", "sources"]:
+        for criteria in ["ratings", "cocoa", "bars_sold"]:
+            for sorting_order in ["top=10", "bottom=10"]:
+                commands.append(" ".join(["regions", sellers_or_sources, criteria, sorting_order]))
+    return commands
+
+class TestIndexes(unittest.TestCase):
+
+    def test_index_set(self):
+        conn = sqlite3.connect(DBNAME)
+        cur = conn.cursor()
+
+        sql = "SELECT name FROM sqlite_master WHERE type = 'index' AND name NOT LIKE 'sqlite_%'"
+        result_list = [row[0] for row in cur.execute(sql).fetchall()]
+        for name in ['BarsByRating', 'BarsByCocoa', 'BarsByLocation', 'BarsByOrigin', 'BarsByCompany',
+                     'CountriesByAlpha2', 'CountriesByRegion', 'CountriesByEnglishName']:
+            self.assertIn(name, result_list)
+
+        conn.close()
+
+class TestQueryPlans(unittest.TestCase):
+
+    def test_no_full_table_scans(self):
+        for command in supported_commands():
+            (statement, params) = command_statement(parse_command(command))
+            with self.subTest(command=command):
+                self.assertEqual(full_table_scans(statement, params), [])
+
+    def test_full_table_scan_detected(self):
+        scans = full_table_scans("SELECT * FROM Bars WHERE BeanType = 'Criollo'")
+        self.assertEqual(scans, ['SCAN Bars'])
+
+class TestPlanBaseline(unittest.TestCase):
+
+    def test_no_regressions(self):
+        baseline = proj3_choc_plans.read_baseline()
+        found = proj3_choc_plans.regressions(baseline, proj3_choc_plans.capture_plans())
+        self.assertEqual(found, [])
+
+    def test_every_kind_of_shape(self):
+        keys = [key for (key, _, _) in proj3_choc_plans.all_shapes()]
+        for prefix in ["bars ", "companies ", "countries ", "regions ", "bars_top ", "bars_page "]:
+            self.assertTrue(any(key.startswith(prefix) for key in keys), prefix)
+        self.assertTrue(any(key.endswith(" [match]") for key in keys))
+        self.assertTrue(any(" [condition " in key for key in keys))
+
+    def test_regression_detected(self):
+        baseline = {"a": ["SEARCH Bars USING INDEX BarsByLocation (CompanyLocationId=?)"], "b": ["SCAN Bars USING INDEX BarsByRating"]}
+        plans = {
+            "a": ["SCAN Bars", "USE TEMP B-TREE FOR ORDER BY"],
+            "b": ["SCAN Bars USING INDEX BarsByRating"],
+            "c": ["SEARCH Bars USING INTEGER PRIMARY KEY (rowid=?)"],
+        }
+        found = proj3_choc_plans.regressions(baseline, plans)
+        self.assertEqual(found, [("a", ["SCAN Bars", "USE TEMP B-TREE FOR ORDER BY"]), ("c", plans["c"])])
+
+    def test_other_sqlite_versions(self):
+        normalize_step = proj3_choc_plans.normalize_step
+        self.assertEqual(normalize_step("SCAN TABLE Bars USING INDEX BarsByRating"), "SCAN Bars USING INDEX BarsByRating")
+        self.assertEqual(normalize_step("SEARCH TABLE Bars USING INDEX BarsByLocation (CompanyLocationId=? AND Rating>?)"), "SEARCH Bars USING INDEX BarsByLocation")
+        self.assertEqual(normalize_step("SCAN BarsSearch VIRTUAL TABLE INDEX 32:M4"), "SCAN BarsSearch VIRTUAL TABLE INDEX")
+        self.assertEqual(normalize_step("LIST SUBQUERY 2"), "LIST SUBQUERY")
+        self.assertEqual(normalize_step("USE TEMP B-TREE FOR ORDER BY"), "USE TEMP B-TREE FOR ORDER BY")
+        # a baseline written by another SQLite version still matches, and a
+        # new scan is still a regression
+        baseline = {"a": ["SCAN TABLE Bars USING INDEX BarsByRating", "SCAN BarsSearch VIRTUAL TABLE INDEX 0:M4"]}
+        plans = {"a": ["SCAN Bars USING INDEX BarsByRating", "SCAN BarsSearch VIRTUAL TABLE INDEX"]}
+        self.assertEqual(proj3_choc_plans.regressions(baseline, plans), [])
+        plans = {"a": ["SCAN BarsSearch VIRTUAL TABLE INDEX", "SCAN Bars"]}
+        self.assertEqual(proj3_choc_plans.regressions(baseline, plans), [("a", ["SCAN Bars"])])
+
+    def test_origin_filter_in_where(self):
+        # the companies of a bean origin are found through BarsByOrigin
+        # before grouping, instead of grouping every company
+        for command in ['companies sourcecountry=VE ratings top=10', 'companies sourceregion=Africa max_cocoa top=10']:
+            (statement, params) = command_statement(parse_command(command))
+            details = [detail for (_, _, detail) in query_plan(statement, params)]
+            with self.subTest(command=command):
+                self.assertFalse([detail for detail in details if detail.startswith("SCAN Bars")])
+
+unittest.main()
@@ -0,0 +1,219 @@
+import argparse
+import itertools
+import json
+import re
+import sqlite3
+import sys
+import proj3_choc as choc
+
+# proj3_choc_plans.py
+# Query plan regression check of every SQL shape the commands can run.
+#
+# The shapes are enumerated from the command grammar: every query type with
+# every filter option, criteria, sorting order, sellers/sources, report and
+# search= form (with the search index, and with the LIKE fallback), and
+# compound bars filters. They also include the statements that do not come
+# from command_statement(): the per-country statements of bars_top(), every
+# indexed condition of a compound bars filter, and the keyset pages of
+# bars_page(). Commands whose statements are the same are checked once.
+#
+# The EXPLAIN QUERY PLAN of each shape is compared with the baseline file: a
+# step that scans (SCAN) or sorts (USE TEMP B-TREE) where the baseline plan
+# of the shape did not is a regression, and so is a shape the baseline does
+# not have yet (the exit status is then 1). Steps are compared by their
+# access kind and the table and index they go through only (see
+# normalize_step), so the baseline holds across SQLite versions.
+#
+#   python proj3_choc_plans.py           # check against the baseline
+#   python proj3_choc_plans.py --update  # make the current plans the baseline
+BASELINE = "plan_baseline.json"
+
+# the keyword of each filter option, and the search= terms
+SAMPLE_KEYWORDS = {
+    "sellcountry": "US",
+    "sourcecountry": "VE",
+    "sellregion": "Europe",
+    "sourceregion": "Africa",
+    "country": "US",
+    "region": "Europe",
+}
+SAMPLE_SEARCHES = ["search=chuao", "search=company:val*"]
+
+# filter and range sets of the compound bars filters
+COMPOUND_FILTERS = [
+    [],
+    ["sellcountry=US"],
+    ["sourceregion=Africa"],
+    ["sellregion=Europe", "sourcecountry=VE"],
+    ["sellcountry=US", "sourceregion=Americas"],
+]
+COMPOUND_RANGES = [
+    [],
+    ["cocoa=70..80"],
+    ["rating=3.5.."],
+    ["year=..2010"],
+    ["cocoa=70..80", "year=2014.."],
+]
+
+# --- shapes ---
+def grammar_commands():
+    for query_type in choc.QUERY_TYPES:
+        sides = choc.SELLERS_OR_SOURCES if query_type in ("countries", "regions") else [""]
+        searches = [""] + SAMPLE_SEARCHES if query_type in ("bars", "companies") else [""]
+        for (option, criteria, sorting_order, side, report, search) in itertools.product(
+                [""] + list(SAMPLE_KEYWORDS), choc.SORTING_CRITERIA, choc.SORTING_ORDERS, sides, ["", "report"], searches):
+            words = [query_type, side, criteria, sorting_order + "=10", report, search]
+            if option != "":
+                words.insert(1, "{}={}".format(option, SAMPLE_KEYWORDS[option]))
+            yield " ".join(word for word in words if word)
+
+    for (filters, ranges, criteria, sorting_order) in itertools.product(
+            COMPOUND_FILTERS, COMPOUND_RANGES, ["ratings", "cocoa"], choc.SORTING_ORDERS):
+        if len(filters) > 1 or ranges:
+            yield " ".join(["bars"] + filters + ranges + [criteria, sorting_order + "=10"])
+
+# (key, statement, params) of the shapes of the commands that are valid
+# and can be prepared
+def command_shapes(commands):
+    for command in commands:
+        spec = choc.parse_command(command, report_errors=False)
+        if spec is None:
+            continue
+        try:
+            (statement, params) = choc.command_statement(spec)
+        except ValueError:
+            continue
+        yield (command, statement, params)
+
+        # every condition of a compound filter, whatever the planner picks
+        if spec.query_type == "bars" and (spec.filters or spec.ranges):
+            filters = spec.filters
+            if spec.specification != "":
+                filters = ((spec.specification, spec.keyword),) + filters
+            shape = (tuple(specification for (specification, _) in filters),
+                     tuple((column, low is not None, high is not None) for (column, low, high) in spec.ranges))
+            for driver in [None] + list(range(len(filters) + len(spec.ranges))):
+                statement = choc.bars_filter_statement(shape[0], shape[1], driver, spec.criteria, spec.sorting_order)
+                params = choc.bars_filter_params(filters, spec.ranges, spec.limit)
+                yield ("{} [condition {}]".format(command, driver), statement, params)
+
+def internal_shapes():
+    for (side, criteria, sorting_order) in itertools.product(choc.BARS_SIDES, choc.BARS_COLUMNS, choc.SORTING_ORDERS):
+        column = dict(choc.SUMMARY_SIDES)[choc.BARS_SIDES[side]]
+        statement = choc.bars_statement(column, criteria, sorting_order, keyset=True)
+        yield ("bars_top {} {} {}".format(column, criteria, sorting_order), statement, [1, 10])
+
+    for (option, criteria, sorting_order) in itertools.product(
+            ["", "sellcountry", "sourceregion"], choc.BARS_COLUMNS, choc.SORTING_ORDERS):
+        specification = choc.SPECIFICATION_OPTIONS.get(option, "")
+        params = choc.bars_params(specification, SAMPLE_KEYWORDS.get(option, ""), 100)
+        statement = choc.bars_statement(specification, criteria, sorting_order, keyset=True, after=True)
+        params[-1:-1] = [3.5, 3.5, 100]
+        yield ("bars_page {} {} {}".format(option or "all", criteria, sorting_order), statement, params)
+
+# every (key, statement, params), with the commands' search= shapes both with
+# the search index and with the SEARCH_MATCH fallback
+def all_shapes():
+    commands = list(grammar_commands())
+    shapes = list(command_shapes(commands))
+    if choc.search_index_available():
+        choc.SEARCH_INDEX[choc.DBNAME] = False
+        try:
+            shapes += [(key + " [match]", statement, params) for (key, statement, params)
+                       in command_shapes(command for command in commands if "search=" in command)]
+        finally:
+            choc.SEARCH_INDEX.clear()
+    shapes += list(internal_shapes())
+
+    seen = set()
+    for (key, statement, params) in shapes:
+        if statement not in seen:
+            seen.add(statement)
+            yield (key, statement, params)
+
+# --- plans ---
+# A plan step without what SQLite versions write differently: "TABLE "
+# after SCAN/SEARCH (older versions), the constraints of an index search,
+# the arguments of a virtual table index, and the numbers of subqueries.
+#   SCAN TABLE Bars USING INDEX BarsByRating -> SCAN Bars USING INDEX BarsByRating
+#   SEARCH c1 USING INTEGER PRIMARY KEY (rowid=?) -> SEARCH c1 USING INTEGER PRIMARY KEY
+#   SCAN BarsSearch VIRTUAL TABLE INDEX 32:M4 -> SCAN BarsSearch VIRTUAL TABLE INDEX
+def normalize_step(step):
+    step = re.sub(r"^(SCAN|SEARCH) TABLE ", r"\1 ", step)
+    step = re.sub(r" \(.*\)$", "", step)
+    step = re.sub(r" VIRTUAL TABLE INDEX .*$", " VIRTUAL TABLE INDEX", step)
+    step = re.sub(r"(SUBQUERY) \d+$", r"\1", step)
+    return step
+
+def is_flagged(step):
+    return step.startswith("SCAN ") or "USE TEMP B-TREE" in step
+
+# key -> EXPLAIN QUERY PLAN steps
+def capture_plans(shapes=None):
+    if shapes is None:
+        shapes = all_shapes()
+    plans = {}
+    for (key, statement, params) in shapes:
+        try:
+            plans[key] = [normalize_step(detail) for (_, _, detail) in choc.query_plan(statement, params)]
+        except sqlite3.Error:
+            # (a filter option the query type has no column for)
+            continue
+    return plans
+
+# (key, steps) of every shape with a scan or sort its baseline plan does
+# not have, and of every shape the baseline has no plan of
+def regressions(baseline, plans):
+    found = []
+    for (key, steps) in plans.items():
+        before = baseline.get(key)
+        if before is None:
+            found.append((key, steps))
+            continue
+        before = [normalize_step(step) for step in before]
+        new = [step for step in steps if is_flagged(step) and normalize_step(step) not in before]
+        if new:
+            found.append((key, new))
+    return found
+
+def read_baseline(filename=BASELINE):
+    with open(filename) as baseline_f:
+        return json.load(baseline_f)
+
+def write_baseline(plans, filename=BASELINE):
+    with open(filename, "w") as baseline_f:
+        baseline_f.write("{\n")
+        baseline_f.write(",\n".join("{}: {}".format(json.dumps(key), json.dumps(steps)) for (key, steps) in sorted(plans.items())))
+        baseline_f.write("\n}\n")
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Check the query plans of every SQL shape against a baseline.")
+    parser.add_argument("--baseline", default=BASELINE,
+                        help="JSON file of the baseline plans (default: %(default)s)")
+    parser.add_argument("--update", action="store_true",
+                        help="write the current plans as the baseline instead of checking them")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    plans = capture_plans()
+    if args.update:
+        write_baseline(plans, args.baseline)
+        print("{} shapes written to {}".format(len(plans), args.baseline))
+        return 0
+
+    baseline = read_baseline(args.baseline)
+    found = regressions(baseline, plans)
+    for (key, steps) in found:
+        if key in baseline:
+            print("REGRESSION {}: {}".format(key, "; ".join(steps)))
+        else:
+            print("NEW SHAPE {} (run with --update): {}".format(key, "; ".join(steps)))
+    gone = [key for key in baseline if key not in plans]
+    if gone:
+        print("{} baseline shapes no longer reachable".format(len(gone)))
+    print("{} shapes checked, {} regressions".format(len(plans), len(found)))
+    return 1 if found else 0
+
+if __name__ == "__main__":
+    sys.exit(main())